@@ -0,0 +1,244 @@
+"""
+module ckbot.aioport2port
+
+This module provides asyncio versions of the ckbot.port2port connections.
+An async connection wraps a port2port Connection, created from the same
+specification dictionaries used by port2port.newConnection, and registers
+its file descriptor with an asyncio event loop using loop.add_reader().
+Incoming data is read into a buffer as soon as it arrives, so coroutines
+can wait for input without polling, and a single event loop can serve
+many connections concurrently.
+
+Async connections also provide the synchronous Connection interface
+(inWaiting, read, readinto, write), operating on the buffered data, so
+code written for port2port connections, e.g. the packet parsers of the
+Bus classes, can be used with them unchanged.
+
+Typical use:
+  >>> conn = newAsyncConnection(dict(TYPE='tcp',host='localhost',port=6666))
+  >>> conn.write(b'hello')
+  >>> dat = await conn.recv(100)
+"""
+
+from asyncio import get_event_loop, Event, wait_for, TimeoutError as AsyncTimeoutError
+from socket import error as SocketError
+from errno import EAGAIN
+
+from .port2port import (
+  Connection, SerialConnection, TCPConnection, UDPConnection, newConnection
+)
+
+class AsyncConnection( Connection ):
+  """
+  Abstract superclass of asyncio connections
+
+  Subclasses implement ._pull(), which reads all data available from the
+  underlying connection without blocking, and returns it.
+
+  ATTRIBUTES:
+    conn -- port2port.Connection -- the underlying connection
+    loop -- asyncio event loop the connection is registered with
+    rxq -- bytearray -- data received and not yet read
+    maxlen -- int -- maximal number of bytes buffered
+  """
+  def __init__(self, conn, loop=None, maxlen=1<<16):
+    """
+    INPUT:
+      conn -- port2port.Connection -- connection to wrap; must have a
+        file descriptor
+      loop -- asyncio event loop, or None to use the current one
+      maxlen -- int -- maximal number of bytes buffered; when the buffer
+        is full, reading from the underlying connection pauses
+    """
+    if loop is None:
+      loop = get_event_loop()
+    self.conn = conn
+    self.loop = loop
+    self.maxlen = maxlen
+    self.rxq = bytearray()
+    self.rxEvent = Event()
+    self.fd = conn.fileno()
+    if self.fd is None:
+      raise ValueError("Connection %s has no file descriptor" % repr(conn))
+    self._reading = False
+    self._startReading()
+
+  def _startReading( self ):
+    if not self._reading:
+      self.loop.add_reader( self.fd, self._onReadable )
+      self._reading = True
+
+  def _stopReading( self ):
+    if self._reading:
+      self.loop.remove_reader( self.fd )
+      self._reading = False
+
+  def _pull( self ):
+    """(pure) read and return all data available without blocking"""
+    raise RuntimeError("Pure method called")
+
+  def _onReadable( self ):
+    """(private) event loop callback for a readable file descriptor"""
+    dat = self._pull()
+    if dat:
+      self.rxq.extend(dat)
+      self.rxEvent.set()
+    if len(self.rxq) >= self.maxlen:
+      self._stopReading()
+
+  def _consumed( self ):
+    """(private) resume reading once buffer space was freed"""
+    if len(self.rxq) < self.maxlen and self.conn.isOpen():
+      self._startReading()
+
+  def isOpen( self ):
+    return self.conn.isOpen()
+
+  def fileno( self ):
+    return self.fd
+
+  def flush( self ):
+    self.conn.flush()
+
+  def inWaiting( self ):
+    # Pull in new data here too, so that the synchronous interface works
+    #   when the event loop is not running
+    if self._reading:
+      self._onReadable()
+    return len(self.rxq)
+
+  def waitInput( self, timeout ):
+    """Wait at most timeout seconds for input (see Connection.waitInput)"""
+    if self.rxq:
+      return True
+    return Connection.waitInput( self, timeout )
+
+  def write( self, msg ):
+    return self.conn.write(msg)
+
+  def read( self, length ):
+    """
+    Read at most length bytes of buffered data, without waiting
+    """
+    pkt = bytes(self.rxq[:length])
+    del self.rxq[:length]
+    self._consumed()
+    return pkt
+
+  def readinto( self, buf ):
+    """
+    Read at most len(buf) bytes of buffered data into buf, without waiting
+    """
+    n = min(len(buf),len(self.rxq))
+    buf[:n] = self.rxq[:n]
+    del self.rxq[:n]
+    self._consumed()
+    return n
+
+  async def wait( self, timeout=None ):
+    """
+    Wait until there is buffered data, for at most timeout seconds
+
+    OUTPUT:
+      True if there is data to read, False if timed out
+    """
+    if self.rxq:
+      return True
+    self.rxEvent.clear()
+    try:
+      await wait_for( self.rxEvent.wait(), timeout )
+    except AsyncTimeoutError:
+      return False
+    return True
+
+  async def recv( self, length, timeout=None ):
+    """
+    Wait for data (see .wait()), then read at most length bytes of it
+
+    OUTPUT:
+      the data read; empty if timed out
+    """
+    await self.wait(timeout)
+    return self.read(length)
+
+  def close( self ):
+    """Unregister from the event loop and close the underlying connection"""
+    self._stopReading()
+    self.conn.close()
+
+  def reconnect( self, **changes ):
+    """Reconnect the underlying connection and register its new descriptor"""
+    self._stopReading()
+    self.conn.reconnect(**changes)
+    self.fd = self.conn.fileno()
+    self.rxq = bytearray()
+    self._startReading()
+
+class AsyncSerialConnection( AsyncConnection ):
+  """
+  Async wrapper of a port2port.SerialConnection
+  """
+  def _pull( self ):
+    n = self.conn.inWaiting()
+    if not n:
+      return b''
+    return self.conn.read(n)
+
+class AsyncTCPConnection( AsyncConnection ):
+  """
+  Async wrapper of a port2port.TCPConnection
+  """
+  def _pull( self ):
+    # Data already buffered by the connection comes first
+    dat = self.conn.rxq
+    self.conn.rxq = b''
+    try:
+      rd = self.conn.sock.recv(self.conn.mxl)
+    except SocketError as err:
+      if err.errno != EAGAIN:
+        raise
+      return dat
+    # Readable with no data means the peer closed the connection
+    if not rd:
+      self._stopReading()
+    return dat + rd
+
+class AsyncUDPConnection( AsyncConnection ):
+  """
+  Async wrapper of a port2port.UDPConnection
+
+  Datagrams are buffered back to back, as a byte stream; as with the
+  underlying connection, writes go to the configured dst, or to the most
+  recent peer.
+  """
+  def _pull( self ):
+    dat = bytearray()
+    while self.conn.inWaiting():
+      dat.extend(self.conn.read(self.conn.cfg['maxlen']))
+    return dat
+
+def newAsyncConnection( spec=None, loop=None, **_spec ):
+  """
+  Factory method for creating an AsyncConnection
+
+  INPUT:
+    spec -- dict or Connection -- connection specification, as for
+      port2port.newConnection, or an already open Connection to wrap
+    loop -- asyncio event loop, or None to use the current one
+    **_spec -- additional specification entries
+  OUTPUT:
+    AsyncConnection subclass instance
+  """
+  if isinstance(spec,AsyncConnection):
+    return spec
+  if isinstance(spec,Connection):
+    conn = spec
+  else:
+    conn = newConnection(spec,**_spec)
+  if isinstance(conn,SerialConnection):
+    return AsyncSerialConnection(conn,loop)
+  if isinstance(conn,TCPConnection):
+    return AsyncTCPConnection(conn,loop)
+  if isinstance(conn,UDPConnection):
+    return AsyncUDPConnection(conn,loop)
+  raise ValueError("No asyncio support for connection %s" % repr(conn))
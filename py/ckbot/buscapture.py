@@ -0,0 +1,285 @@
+"""
+module ckbot.buscapture
+
+This module provides capture and replay of the raw traffic of a bus.
+
+A CaptureConnection wraps any port2port Connection, and appends every
+chunk of bytes written to it (TX) or read from it (RX) to a binary capture
+file, with a timestamp. Records are written through a large file buffer,
+so capturing costs a few microseconds per read or write, and nothing is
+formatted or printed while the bus is running (unlike PYCKBOTDEBUG=x).
+Capture files are append-only; captures of several runs, or of a bus
+that reconnected, follow each other in the same file.
+
+A ReplayConnection reads a capture file, and plays back its RX bytes
+through the Connection interface, at the recorded pace, sped up, or as
+fast as they are read. TX bytes written to it are counted and discarded.
+In lockstep mode, the RX bytes that followed each recorded TX chunk are
+only released after a corresponding write(), so the protocol code reading
+the replay sees replies in the same order relative to its requests as in
+the recording.
+
+Both are available through port2port.newConnection: any connection spec
+can have a capture=<filename> entry, and {TYPE='replay', fn=<filename>}
+creates a replay. Buses can also start and stop capturing with
+AbstractBus.capture().
+
+Typical use:
+  >>> c = Cluster(arch=dynamixel, port=dict(TYPE='tty', glob='/dev/ttyUSB0',
+  ...   baudrate=1000000, capture='gait.ckcap'), count=4)
+  >>> ... run the robot ...
+  and later, offline:
+  >>> b = dynamixel.Bus(dict(TYPE='replay', fn='gait.ckcap', speed=0))
+  >>> while not b.ser.done: b.recv()
+"""
+
+from struct import Struct
+from time import time as now, sleep
+from collections import deque
+from sys import argv
+
+from .port2port import Connection
+
+#: Record directions
+TX, RX = 0, 1
+
+#: Capture file magic number, at the start of every capture file
+MAGIC = b'CKBCAP01'
+#: Record header: time, direction, number of data bytes that follow
+REC = Struct('<dBI')
+
+def readCapture( fn ):
+  """
+  Iterate over the records of a capture file
+
+  OUTPUT:
+    iterator of (t, direction, data) tuples, with direction TX or RX
+  """
+  with open(fn,'rb') as f:
+    dat = f.read()
+  if dat[:len(MAGIC)] != MAGIC:
+    raise ValueError("'%s' is not a bus capture file" % fn)
+  k = len(MAGIC)
+  while k+REC.size <= len(dat):
+    t,d,n = REC.unpack_from(dat,k)
+    k += REC.size
+    if k+n > len(dat):
+      break # truncated last record, e.g. capturing process was killed
+    yield t, d, dat[k:k+n]
+    k += n
+
+class CaptureConnection( Connection ):
+  """
+  Concrete Connection wrapper recording all traffic of a connection
+
+  All Connection methods are passed to the wrapped connection; other
+  attributes (e.g. baudrate) are read from it.
+
+  ATTRIBUTES:
+    conn -- Connection -- the wrapped connection
+    fn -- str -- capture file name
+    records -- int -- number of records captured
+  """
+  def __init__( self, conn, fn, bufsize=1<<16 ):
+    """
+    INPUT:
+      conn -- Connection -- connection to capture
+      fn -- str -- capture file; appended to if it exists
+      bufsize -- int -- size of the file buffer
+    """
+    self.conn = conn
+    self.fn = fn
+    self.records = 0
+    self.f = open(fn,'ab',bufsize)
+    if self.f.tell() == 0:
+      self.f.write(MAGIC)
+
+  def __getattr__( self, attr ):
+    # Only called for attributes not found on the wrapper
+    if attr == 'conn':
+      raise AttributeError(attr)
+    return getattr(self.conn,attr)
+
+  def _record( self, d, dat ):
+    """(private) append a record to the capture file"""
+    f = self.f
+    f.write(REC.pack(now(),d,len(dat)))
+    f.write(dat)
+    self.records += 1
+
+  def open( self ):
+    self.conn.open()
+
+  def isOpen( self ):
+    return self.conn.isOpen()
+
+  def flush( self ):
+    self.conn.flush()
+    self.f.flush()
+
+  def inWaiting( self ):
+    return self.conn.inWaiting()
+
+  def fileno( self ):
+    return self.conn.fileno()
+
+  def waitInput( self, timeout ):
+    return self.conn.waitInput(timeout)
+
+  def write( self, msg ):
+    self._record(TX,msg)
+    return self.conn.write(msg)
+
+  def read( self, length ):
+    dat = self.conn.read(length)
+    if dat:
+      self._record(RX,dat)
+    return dat
+
+  def readinto( self, buf ):
+    n = self.conn.readinto(buf)
+    if n:
+      self._record(RX,buf[:n])
+    return n
+
+  def close( self ):
+    """Close the wrapped connection and the capture file"""
+    self.conn.close()
+    if not self.f.closed:
+      self.f.close()
+
+  def reconnect( self, **changes ):
+    self.f.flush()
+    self.conn.reconnect(**changes)
+
+class ReplayConnection( Connection ):
+  """
+  Concrete Connection playing back the RX traffic of a capture file
+
+  ATTRIBUTES:
+    frames -- list -- (t, direction, data) records of the capture
+    pos -- int -- index of the next record to play
+    speed -- float -- playback speed relative to the recording; 0 to
+      play everything as soon as it is read
+    lockstep -- bool -- gate RX bytes on writes (see module docstring)
+    rxq -- bytearray -- RX bytes played back and not read yet
+    txCount -- int -- bytes written
+    baudrate -- int or None -- baudrate reported to bus users
+  """
+  def __init__( self, fn, speed=1.0, lockstep=False, baudrate=None ):
+    """
+    INPUT:
+      fn -- str -- capture file name
+      speed -- float -- playback speed; e.g. 10 plays ten times faster
+        than recorded, 0 plays without any delays
+      lockstep -- bool -- release the replies to each recorded TX only
+        after a write to this connection
+      baudrate -- int -- baudrate to report, e.g. for bustrace
+    """
+    self.fn = fn
+    self.frames = list(readCapture(fn))
+    self.speed = float(speed or 0)
+    self.lockstep = lockstep
+    self.baudrate = baudrate
+    self.rewind()
+
+  def rewind( self ):
+    """Restart playback from the beginning of the capture"""
+    self.pos = 0
+    self.rxq = bytearray()
+    self.txCount = 0
+    self.writes = deque()
+    self.t0 = None
+    self.base = self.frames[0][0] if self.frames else 0
+
+  @property
+  def done( self ):
+    """True when all of the capture was played back and read"""
+    return self.pos >= len(self.frames) and not self.rxq
+
+  def _due( self, t ):
+    """(private) wall clock time at which a record of time t is due"""
+    if self.t0 is None:
+      self.t0 = now()
+    return self.t0 + (t-self.base)/self.speed
+
+  def _pump( self ):
+    """
+    (private) move RX records that are due into .rxq
+
+    OUTPUT:
+      wall clock time at which the next record is due, or None if the
+      next record is not timed (end of capture, or waiting for a write)
+    """
+    fr = self.frames
+    while self.pos < len(fr):
+      t,d,dat = fr[self.pos]
+      if d == TX:
+        if self.lockstep:
+          if not self.writes:
+            return None
+          # Replies are timed relative to the write that requested them
+          self.t0 = self.writes.popleft()
+          self.base = t
+        self.pos += 1
+        continue
+      if self.speed:
+        due = self._due(t)
+        if due > now():
+          return due
+      self.rxq.extend(dat)
+      self.pos += 1
+    return None
+
+  def isOpen( self ):
+    return True
+
+  def inWaiting( self ):
+    self._pump()
+    return len(self.rxq)
+
+  def waitInput( self, timeout ):
+    """Wait at most timeout seconds for the next RX record to be due"""
+    due = self._pump()
+    if self.rxq:
+      return True
+    if timeout <= 0:
+      return False
+    if due is None:
+      sleep(min(timeout,0.0005))
+      return False
+    sleep(max(0,min(timeout,due-now())))
+    return True
+
+  def write( self, msg ):
+    self.txCount += len(msg)
+    if self.lockstep:
+      self.writes.append(now())
+    return len(msg)
+
+  def read( self, length ):
+    self._pump()
+    pkt = bytes(self.rxq[:length])
+    del self.rxq[:length]
+    return pkt
+
+  def readinto( self, buf ):
+    self._pump()
+    n = min(len(buf),len(self.rxq))
+    buf[:n] = self.rxq[:n]
+    del self.rxq[:n]
+    return n
+
+  def reconnect( self, **changes ):
+    """Apply configuration changes and restart playback"""
+    for k,v in changes.items():
+      setattr(self,k,v)
+    self.rewind()
+
+if __name__=="__main__":
+  # Print a capture file as a hex dump, one line per record
+  recs = list(readCapture(argv[1]))
+  t0 = recs[0][0] if recs else 0
+  for t,d,dat in recs:
+    print("%10.6f %s %4d %s" % (t-t0, ('TX','RX')[d], len(dat),
+      " ".join("%02X" % b for b in bytearray(dat))))
@@ -0,0 +1,309 @@
+"""
+module ckbot.busthread
+
+This module provides the BusThread class, which runs all communication of
+a Cluster's Protocol on a dedicated thread, so that slow bus I/O does not
+delay the thread running the application (e.g. the JoyApp main loop).
+
+The application thread and the bus thread exchange information through:
+  - a bounded command queue. Commands are keyed, typically by (node ID,
+    property), and a command posted while an older command with the same
+    key is still queued replaces it, keeping its place in the queue. Thus
+    a setter called faster than the bus can keep up only ever has its
+    latest value sent.
+  - a telemetry table, holding the latest value of each watched getter
+    with its timestamp. The bus thread polls the getters periodically,
+    and the application reads the table without waiting for the bus.
+  - synchronous calls, which are executed on the bus thread while the
+    calling thread waits for their result.
+
+While a BusThread is running, the methods of the protocol that perform bus
+transactions (listed in BusThread.MARSHAL) are routed through synchronous
+calls when invoked from other threads, so existing module code keeps
+working unchanged. The methods of the bus that send data (listed in
+BusThread.MARSHAL_BUS) are routed the same way, which protects the
+architectures (e.g. pololu, polowixel) whose node adaptors write to the
+bus directly rather than through protocol methods.
+
+Typical use:
+  >>> c = Cluster(count=3)
+  >>> bt = c.startBusThread()
+  >>> setPos = c.setterOf('Nx01/@set_pos') # posts coalesced commands
+  >>> getPos = c.getterOf('Nx01/@get_pos') # reads the telemetry table
+  >>> setPos(1000); getPos()
+  >>> c.stopBusThread()
+"""
+
+from threading import Thread, Event, Lock, current_thread
+from collections import deque
+from time import time as now
+
+from .ckmodule import AbstractProtocolError, progress
+
+class BusThreadError( AbstractProtocolError ):
+  """Raised when the bus thread cannot accept or complete an operation"""
+  def __init__(self,*arg,**kw):
+    AbstractProtocolError.__init__(self,*arg,**kw)
+
+class BusThread( Thread ):
+  """
+  Concrete class running the protocol communication of a Cluster on
+  its own thread.
+
+  The thread loop repeatedly:
+    - executes queued commands, oldest first
+    - executes pending synchronous calls
+    - polls watched getters that are due, publishing their values
+    - runs the update() of all objects in the cluster's update queue
+    - waits for up to .period seconds, or until new work is posted
+
+  ATTRIBUTES:
+    cluster -- Cluster -- the cluster whose protocol is run
+    period -- float -- maximal time between loop iterations
+    maxlen -- int -- capacity of the command queue
+    telemetry -- dict -- key to (timestamp, value) of latest getter results
+    errors -- deque -- (timestamp, key, exception) of recent failures
+    stats -- dict -- counters of posted, coalesced and executed commands
+  """
+  #: Names of protocol methods that are executed on the bus thread
+  MARSHAL = ( 'mem_read_sync', 'mem_write_sync', 'mem_write', 'mem_write_many',
+    'mem_read_many', 'send_cmd', 'scan', 'off', 'reset_nid', 'hintNodes',
+    'generatePNA', 'set_target', 'flushTargets' )
+
+  #: Names of bus methods that are executed on the bus thread
+  MARSHAL_BUS = ( 'write', 'write_many', 'flushTx' )
+
+  def __init__(self, cluster, period=0.005, maxlen=256, name=None ):
+    """
+    INPUT:
+      cluster -- Cluster -- cluster whose protocol is run by this thread
+      period -- float -- maximal time between loop iterations
+      maxlen -- int -- capacity of the command queue
+      name -- str -- thread name
+    """
+    Thread.__init__(self, name=name or "BusThread")
+    self.daemon = True
+    self.cluster = cluster
+    self.period = period
+    self.maxlen = maxlen
+    self.telemetry = {}
+    self.errors = deque((),32)
+    self.stats = dict( posted=0, coalesced=0, executed=0, calls=0, polls=0 )
+    self._cmds = {}
+    self._order = deque()
+    self._cmdLock = Lock()
+    self._calls = deque()
+    self._watch = {}
+    self._wake = Event()
+    self._running = False
+    self._marshalled = []
+
+  def isBusThread( self ):
+    """True if called from the bus thread itself"""
+    return current_thread() is self
+
+  def post( self, key, func, *args ):
+    """
+    Queue a command to be executed on the bus thread
+
+    If a command with the same key is already queued, it is replaced by
+    this one, which takes its place in the queue.
+
+    INPUT:
+      key -- hashable -- coalescing key, e.g. (node ID, property)
+      func -- callable -- called as func(*args) on the bus thread
+    """
+    with self._cmdLock:
+      if key in self._cmds:
+        self.stats['coalesced'] += 1
+      elif len(self._cmds) >= self.maxlen:
+        raise BusThreadError("Command queue full (%d commands)" % self.maxlen)
+      else:
+        self._order.append(key)
+      self._cmds[key] = (func,args)
+      self.stats['posted'] += 1
+    self._wake.set()
+
+  def call( self, func, *args, **kw ):
+    """
+    Execute func(*args,**kw) on the bus thread and return its result,
+    re-raising any exception it raised. If called from the bus thread,
+    or if the thread is not running, func is called directly.
+    """
+    if self.isBusThread() or not self._running:
+      return func(*args,**kw)
+    done = Event()
+    res = [None,None]
+    self._calls.append((func,args,kw,res,done))
+    self._wake.set()
+    while not done.wait(0.5):
+      if not self.is_alive():
+        raise BusThreadError("Bus thread died during call to %s" % repr(func))
+    if res[1] is not None:
+      raise res[1]
+    return res[0]
+
+  def watch( self, key, getter, period=0.1, default=None ):
+    """
+    Poll getter() on the bus thread every period seconds, publishing the
+    result as .telemetry[key]
+
+    OUTPUT:
+      function returning the latest value of the getter; until the first
+      poll completed, it returns default rather than waiting for the bus.
+    """
+    self._watch[key] = [getter,period,0]
+    self._wake.set()
+    none = (None,default)
+    def latest():
+      return self.telemetry.get(key,none)[1]
+    return latest
+
+  def unwatch( self, key ):
+    """Stop polling the getter watched with key"""
+    self._watch.pop(key,None)
+    self.telemetry.pop(key,None)
+
+  def postContext( self, ctx ):
+    """
+    Wrap context manager ctx so that entering and exiting it are posted
+    as commands, and thus happen on the bus thread in order with the
+    commands posted between them.
+
+    OUTPUT:
+      context manager
+    """
+    return PostedContext( self, ctx )
+
+  def _marshal( self ):
+    """(private)
+    Route protocol methods listed in MARSHAL, and bus methods listed in
+    MARSHAL_BUS, through .call() when invoked from other threads, by
+    shadowing them with instance attributes
+    """
+    p = self.cluster.p
+    todo = [ (p,nm) for nm in self.MARSHAL ]
+    bus = getattr(p,'bus',None)
+    if bus is not None:
+      todo.extend( (bus,nm) for nm in self.MARSHAL_BUS )
+    for obj,nm in todo:
+      meth = getattr(obj,nm,None)
+      if meth is None or nm in obj.__dict__:
+        continue
+      setattr(obj,nm,self._wrap(meth))
+      self._marshalled.append((obj,nm))
+
+  def _wrap( self, meth ):
+    """(private) wrap meth so that it is always called on the bus thread"""
+    def marshalled(*args,**kw):
+      return self.call(meth,*args,**kw)
+    marshalled.__doc__ = meth.__doc__
+    return marshalled
+
+  def _unmarshal( self ):
+    """(private)
+    Undo the effects of _marshal
+    """
+    for obj,nm in self._marshalled:
+      delattr(obj,nm)
+    self._marshalled = []
+
+  def start( self ):
+    self._running = True
+    self._marshal()
+    Thread.start(self)
+
+  def stop( self, timeout=1.0 ):
+    """
+    Stop the thread, after it completes the commands already queued
+    """
+    self._running = False
+    self._wake.set()
+    if self.is_alive() and not self.isBusThread():
+      self.join(timeout)
+    self._unmarshal()
+
+  def _fail( self, key, exc ):
+    """(private) record a failure of a command or poll"""
+    self.errors.append((now(),key,exc))
+    progress("BusThread: %s failed: %s" % (repr(key),str(exc)))
+
+  def _runCommands( self ):
+    """(private) execute all queued commands"""
+    while True:
+      with self._cmdLock:
+        if not self._order:
+          return
+        key = self._order.popleft()
+        func,args = self._cmds.pop(key)
+      try:
+        func(*args)
+      except Exception as exc:
+        self._fail(key,exc)
+      self.stats['executed'] += 1
+
+  def _runCalls( self ):
+    """(private) execute all pending synchronous calls"""
+    while self._calls:
+      func,args,kw,res,done = self._calls.popleft()
+      try:
+        res[0] = func(*args,**kw)
+      except Exception as exc:
+        res[1] = exc
+      self.stats['calls'] += 1
+      done.set()
+
+  def _poll( self, t ):
+    """(private) poll all watched getters that are due"""
+    for key,w in list(self._watch.items()):
+      getter,period,last = w
+      if t-last < period:
+        continue
+      w[2] = t
+      try:
+        self.telemetry[key] = (t,getter())
+      except Exception as exc:
+        self._fail(key,exc)
+      self.stats['polls'] += 1
+
+  def run( self ):
+    while True:
+      self._wake.clear()
+      self._runCommands()
+      self._runCalls()
+      if not self._running:
+        break
+      t = now()
+      self._poll(t)
+      for m in self.cluster._updQ:
+        try:
+          m.update(t)
+        except Exception as exc:
+          self._fail(m,exc)
+      self._wake.wait(self.period)
+    # Fail any calls that arrived too late
+    while self._calls:
+      func,args,kw,res,done = self._calls.popleft()
+      res[1] = BusThreadError("Bus thread stopped")
+      done.set()
+
+class PostedContext( object ):
+  """
+  Context manager whose entry and exit are posted as commands to a
+  BusThread (see BusThread.postContext)
+
+  Commands posted inside the context that replace (coalesce with) commands
+  queued before it keep their earlier place, and thus run before the
+  context is entered on the bus thread.
+  """
+  def __init__(self, bt, ctx):
+    self.bt = bt
+    self.ctx = ctx
+
+  def __enter__( self ):
+    self.bt.post( (id(self),'enter'), self.ctx.__enter__ )
+    return self.ctx
+
+  def __exit__( self, typ, val, tb ):
+    self.bt.post( (id(self),'exit'), self.ctx.__exit__, typ, val, tb )
+    return False
@@ -0,0 +1,258 @@
+"""
+module ckbot.bustrace
+
+This module provides the BusTrace class, a transaction recorder that can
+be plugged into a dynamixel.Bus (and the Protocol using it) to find out
+what the bus was doing, e.g. when a gait stutters.
+
+Each transaction -- a command sent, and its reply or lack thereof -- is
+recorded with its timestamp, node ID, command, bytes sent and received,
+round trip time, number of retries and outcome. Records are packed into a
+preallocated ring buffer, so recording allocates nothing and the most
+recent .size transactions are always available.
+
+From the ring, a BusTrace computes:
+  - bus utilization: bits on the wire over a time window, relative to the
+    bit rate the bus can carry at its baudrate
+  - per-node latency histograms, with logarithmic bins
+and it can export the recorded transactions as:
+  - a compact binary file (see .save() and BusTrace.load())
+  - Chrome trace JSON, viewable in chrome://tracing or Perfetto, with one
+    track per node
+
+Typical use:
+  >>> tr = BusTrace(baudrate=1000000)
+  >>> tr.attach(c.p.bus)  # c is a dynamixel Cluster
+  >>> ... run the robot ...
+  >>> print("\\n".join(tr.statsMsg()))
+  >>> tr.saveChrome('gait.json')
+"""
+
+from struct import Struct
+from json import dump as json_dump
+from math import log
+from time import time as now
+
+#: Transaction outcomes
+OK, TIMEOUT, ERROR, SENT = range(4)
+OUTCOME_NAMES = ('ok','timeout','error','sent')
+
+#: Names of dynamixel commands, for exports
+CMD_NAMES = {
+  0x01 : 'PING', 0x02 : 'READ', 0x03 : 'WRITE', 0x04 : 'REG_WRITE',
+  0x05 : 'ACTION', 0x06 : 'RESET', 0x83 : 'SYNC_WRITE', 0x92 : 'BULK_READ'
+}
+
+class BusTrace( object ):
+  """
+  Concrete class recording bus transactions in a ring buffer
+
+  ATTRIBUTES:
+    size -- int -- capacity of the ring, in transactions
+    count -- int -- number of transactions recorded so far
+    baudrate -- int -- bus baudrate, used to compute utilization
+    ring -- bytearray -- the records, each packed with REC
+  """
+  #: Record format: time, rtt, nid, cmd, bytes out, bytes in, retries, outcome
+  REC = Struct('<dfBBHHBB')
+  #: Binary file header: magic, record size, count of records that follow
+  MAGIC = b'CKBTRC01'
+  HDR = Struct('<8sHI')
+  #: Histogram bins are logarithmic, two per octave, starting at H0
+  H0 = 50e-6
+  NBINS = 28
+  #: Bits on the wire per byte: start bit, 8 data bits, stop bit
+  BITS_PER_BYTE = 10
+
+  def __init__(self, size=8192, baudrate=None):
+    """
+    INPUT:
+      size -- int -- number of transactions kept
+      baudrate -- int -- bus baudrate; if None, taken from the bus the
+        trace is attached to (see .attach())
+    """
+    self.size = size
+    self.baudrate = baudrate
+    self.ring = bytearray(size*self.REC.size)
+    self.count = 0
+
+  def attach( self, bus ):
+    """
+    Start recording transactions of a dynamixel.Bus, taking the baudrate
+    from its connection if none was given.
+    """
+    if self.baudrate is None:
+      spec = getattr(bus.ser,'newConnection_spec',None) or {}
+      self.baudrate = getattr(bus.ser,'baudrate',None) or spec.get('baudrate',None)
+    bus.trace = self
+    return self
+
+  def record( self, t, nid, cmd, tx, rx=0, rtt=0.0, retries=0, outcome=OK ):
+    """
+    Record a transaction
+
+    INPUT:
+      t -- float -- time at which the transaction started
+      nid -- int -- node ID
+      cmd -- int -- command code
+      tx -- int -- bytes sent, including retries
+      rx -- int -- bytes received
+      rtt -- float -- time from the last send to the reply (or giving up)
+      retries -- int -- number of times the command was re-sent
+      outcome -- int -- one of OK, TIMEOUT, ERROR, SENT
+    """
+    k = self.count % self.size
+    self.REC.pack_into( self.ring, k*self.REC.size, t, rtt, nid & 0xFF,
+      cmd & 0xFF, min(tx,0xFFFF), min(rx,0xFFFF), min(retries,0xFF), outcome )
+    self.count += 1
+
+  def __len__( self ):
+    return min(self.count,self.size)
+
+  def __iter__( self ):
+    """
+    Iterate over recorded transactions, oldest first, as tuples
+    (t, rtt, nid, cmd, tx, rx, retries, outcome)
+    """
+    n = len(self)
+    rs = self.REC.size
+    for k in range(self.count-n,self.count):
+      yield self.REC.unpack_from( self.ring, (k % self.size)*rs )
+
+  def clear( self ):
+    self.count = 0
+
+  def utilization( self, window=1.0, t=None ):
+    """
+    Fraction of the bus capacity used in the window seconds before time t
+
+    OUTPUT:
+      float, or None if the baudrate is unknown
+    """
+    if not self.baudrate:
+      return None
+    if t is None:
+      t = now()
+    t0 = t-window
+    nb = 0
+    for r in self:
+      if t0 <= r[0] <= t:
+        nb += r[4]+r[5]
+    return nb * self.BITS_PER_BYTE / float(self.baudrate*window)
+
+  @classmethod
+  def edge( cls, b ):
+    """Upper edge of histogram bin b"""
+    return cls.H0 * 2**(b/2.0)
+
+  def histogram( self, nid=None ):
+    """
+    Histogram of round trip times of successful transactions
+
+    INPUT:
+      nid -- int -- node ID, or None for all nodes
+    OUTPUT:
+      list of NBINS counts; bin b counts RTTs up to .edge(b)
+    """
+    h = [0]*self.NBINS
+    for r in self:
+      if r[7] != OK or (nid is not None and r[2] != nid):
+        continue
+      dt = r[1]
+      if dt <= self.H0:
+        h[0] += 1
+      else:
+        h[min(self.NBINS-1,int(2*log(dt/self.H0,2))+1)] += 1
+    return h
+
+  def histograms( self ):
+    """
+    Per-node latency histograms
+
+    OUTPUT:
+      dict mapping node ID to its histogram (see .histogram())
+    """
+    return dict( (nid,self.histogram(nid)) for nid in set( r[2] for r in self ) )
+
+  def statsMsg( self, window=1.0 ):
+    """
+    returns a summary of the trace
+
+    OUTPUTS:
+      -- list -- strings with outcome counts, utilization and the
+         non-empty bins of each node's latency histogram
+    """
+    oc = [0]*len(OUTCOME_NAMES)
+    for r in self:
+      oc[r[7]] += 1
+    res = [ 'transactions %d (%d kept)' % (self.count,len(self)) ]
+    res.append( ", ".join( '%s %d' % (nm,n) for nm,n in zip(OUTCOME_NAMES,oc) ) )
+    u = self.utilization(window)
+    if u is not None:
+      res.append( 'utilization %.1f%% of %d baud over %gs' % (100*u,self.baudrate,window) )
+    for nid,h in sorted(self.histograms().items()):
+      if not any(h):
+        continue
+      res.append( 'rtt 0x%02x ' % nid + " ".join(
+        '<%.0fus:%d' % (self.edge(b)*1e6,n) for b,n in enumerate(h) if n ) )
+    return res
+
+  def save( self, fn ):
+    """
+    Save the recorded transactions, oldest first, to a binary file
+    """
+    n = len(self)
+    with open(fn,'wb') as f:
+      f.write( self.HDR.pack( self.MAGIC, self.REC.size, n ) )
+      k = (self.count-n) % self.size
+      rs = self.REC.size
+      if k+n <= self.size:
+        f.write( self.ring[k*rs:(k+n)*rs] )
+      else:
+        f.write( self.ring[k*rs:] )
+        f.write( self.ring[:(k+n-self.size)*rs] )
+
+  @classmethod
+  def load( cls, fn, **kw ):
+    """
+    Load a trace saved by .save()
+
+    OUTPUT:
+      BusTrace with the transactions from the file
+    """
+    with open(fn,'rb') as f:
+      magic,rs,n = cls.HDR.unpack( f.read(cls.HDR.size) )
+      if magic != cls.MAGIC or rs != cls.REC.size:
+        raise ValueError("'%s' is not a bus trace file" % fn)
+      dat = f.read(n*rs)
+    kw.setdefault('size',max(n,1))
+    tr = cls(**kw)
+    for k in range(0,len(dat),rs):
+      t,rtt,nid,cmd,tx,rx,retries,outcome = cls.REC.unpack_from(dat,k)
+      tr.record(t,nid,cmd,tx,rx,rtt,retries,outcome)
+    return tr
+
+  def chromeEvents( self ):
+    """
+    Recorded transactions as Chrome trace events; each node is a thread
+    of the bus 'process', and each transaction a complete ('X') event
+    spanning its round trip time.
+    """
+    evts = []
+    for t,rtt,nid,cmd,tx,rx,retries,outcome in self:
+      evts.append(dict(
+        name=CMD_NAMES.get(cmd,'0x%02x' % cmd), cat=OUTCOME_NAMES[outcome],
+        ph='X', ts=t*1e6, dur=rtt*1e6, pid=0, tid=nid,
+        args=dict(tx=tx,rx=rx,retries=retries)
+      ))
+    for nid in set( e['tid'] for e in evts ):
+      evts.append(dict( name='thread_name', ph='M', pid=0, tid=nid,
+        args=dict(name='node 0x%02x' % nid) ))
+    return evts
+
+  def saveChrome( self, fn ):
+    """
+    Save the recorded transactions as Chrome trace JSON
+    """
+    with open(fn,'w') as f:
+      json_dump( dict(traceEvents=self.chromeEvents(),displayTimeUnit='ms'), f )
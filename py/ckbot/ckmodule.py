@@ -18,6 +18,7 @@ from time import time as now
 from warnings import warn
 from glob import glob as GLOB_GLOB
 from os import sep, getenv
+from heapq import heappush, heappop
 
 # Support functions ###################################################
 
@@ -42,6 +43,92 @@ if not GLOB_GLOB(PYCKBOTPATH+"py%sckbot%sckmodule.py" % (sep,sep)):
 
 # Organizational superclasses #########################################
 
+class HeartbeatTable( dict ):
+  """
+  Dictionary mapping node ID to its latest heartbeat, a tuple (or list)
+  whose first entry is the timestamp at which the node was last heard.
+
+  In addition to the heartbeats, a HeartbeatTable maintains the set of
+  live nodes -- nodes heard within the last limit seconds -- incrementally:
+  storing a heartbeat of a node not in the live set marks it for addition
+  (in a set, so pending work is bounded by the number of nodes),
+  and the live nodes are kept in a heap ordered by the timestamp at which
+  they were last known to be alive. Thus .live() only processes nodes that
+  appeared or may have expired since it was last called. Deleting a node
+  removes it from the live set at once.
+
+  Heartbeats may be stored from any thread; .live() should be called from
+  one thread at a time.
+  """
+  def __init__(self,*args,**kw):
+    dict.__init__(self,*args,**kw)
+    self._fresh = set(self.keys())
+    self._live = set()
+    self._heap = []
+    self._limit = None
+    self._snap = frozenset()
+    self._gone = False
+
+  def __delitem__( self, nid ):
+    dict.__delitem__( self, nid )
+    self._fresh.discard(nid)
+    if nid in self._live:
+      # Its heap entry is dropped when it comes up
+      self._live.discard(nid)
+      self._gone = True
+
+  def __setitem__( self, nid, hb ):
+    dict.__setitem__( self, nid, hb )
+    if nid not in self._live:
+      self._fresh.add(nid)
+
+  def update( self, *args, **kw ):
+    for nid,hb in dict(*args,**kw).items():
+      self[nid] = hb
+
+  def live( self, limit, t ):
+    """
+    Set of nodes whose latest heartbeat is less than limit seconds old
+
+    INPUT:
+      limit -- float -- maximal age of heartbeats
+      t -- float -- current time
+    OUTPUT:
+      frozenset of node IDs; a new one is made only when the set changed
+    """
+    live = self._live
+    heap = self._heap
+    n = len(live)
+    changed = self._gone
+    self._gone = False
+    # If the age limit changed, start from scratch
+    if limit != self._limit:
+      self._limit = limit
+      live.clear()
+      del heap[:]
+      changed = True
+      self._fresh.update(self.keys())
+    # Add nodes heard since last call
+    while self._fresh:
+      nid = self._fresh.pop()
+      hb = self.get(nid,None)
+      if nid in live or hb is None or hb[0]+limit <= t:
+        continue
+      live.add(nid)
+      heappush( heap, (hb[0],nid) )
+    # Expire nodes not heard from since their heap entry was made
+    while heap and heap[0][0]+limit <= t:
+      _,nid = heappop(heap)
+      hb = self.get(nid,None)
+      if hb is not None and hb[0]+limit > t:
+        heappush( heap, (hb[0],nid) )
+      else:
+        live.discard(nid)
+        changed = True
+    if changed or len(live) != n:
+      self._snap = frozenset(live)
+    return self._snap
+
 class AbstractProtocol( object ):
   """abstract superclass of all Protocol classes
   
@@ -57,14 +144,16 @@ class AbstractProtocol( object ):
     p.generatePNA( nid )
   
   AbstractProtocol instances must have the following data attributes:
-    p.heartbeats -- dict -- nid to last heartbeat
+    p.heartbeats -- dict -- nid to last heartbeat; preferably a
+      HeartbeatTable, which allows the set of live nodes to be
+      maintained incrementally
   """
   def __init__(self,bus=None):
     """
     Allow a bus parameter to be passed to all AbstractProtocol subclass
     constructors
     """
-    self.heartbeats = {}
+    self.heartbeats = HeartbeatTable()
 
   def update( self, t=None ):
     """
@@ -100,6 +189,30 @@ class AbstractBus( object ):
     """
     pass
 
+  def capture( self, fn=None ):
+    """
+    Start or stop capturing the raw traffic of the bus connection .ser
+    (see ckbot.buscapture)
+
+    INPUT:
+      fn -- str -- capture file to append to, or None to stop capturing
+    """
+    from .buscapture import CaptureConnection
+    ser = self.ser
+    spec = getattr(ser,'newConnection_spec',None)
+    if isinstance(ser,CaptureConnection):
+      ser.f.close()
+      ser = ser.conn
+      if spec is not None:
+        spec.pop('capture',None)
+    if fn:
+      ser = CaptureConnection(ser,fn)
+      if spec is not None:
+        spec['capture'] = fn
+    if spec is not None:
+      ser.newConnection_spec = spec
+    self.ser = ser
+
 class AbstractNodeAdaptor( object ):
   """abstract superclass of all ProtocolNodeAdaptor classes
   
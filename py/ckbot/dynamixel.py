@@ -32,18 +32,25 @@
  - ckbot.port2port
    - newConnection
 """
-from os import getenv
+from os import getenv, replace as os_replace
+from os.path import expanduser
+from json import load as json_load, dump as json_dump
 from sys import version_info
 from time import time as now, sleep
-from struct import pack, unpack, calcsize
-from collections import deque
+from struct import pack, unpack, Struct
+from collections import deque, namedtuple
+from heapq import heappush, heappop
+from asyncio import Lock
+from math import log
 
 from .ckmodule import (
     AbstractNodeAdaptor, AbstractProtocol, AbstractBus, progress,
-    AbstractServoModule, AbstractProtocolError, AbstractBusError,
+    HeartbeatTable, AbstractServoModule, AbstractProtocolError, AbstractBusError,
     MemInterface, MissingModule
 )
 from .port2port import newConnection
+from .aioport2port import newAsyncConnection
+from .bustrace import OK, TIMEOUT, ERROR, SENT
 
 DEFAULT_PORT = dict(TYPE='tty', baudrate=115200, timeout=0.01)
 
@@ -64,14 +71,15 @@ else:
 
 def addBytes(orig, *args):
   return orig+bytes(args)
-
-def byteUnpack(orig):
-  return str(orig)
 #########################
 
 # DEBUG flags
 DEBUG = (getenv("PYCKBOTDEBUG",'')).split(",")
 
+# Cache file for bus topologies found by Protocol.scan, from the
+#   PYCKBOTTOPOLOGY environment variable; None (no caching) if it is unset
+TOPOLOGY_CACHE = expanduser(getenv("PYCKBOTTOPOLOGY")) if getenv("PYCKBOTTOPOLOGY") else None
+
 class Dynamixel( object ):
   """
   DESCRIPTION:
@@ -92,6 +100,7 @@ class Dynamixel( object ):
   CMD_ACTION = 0x05 #: from command table EX-106 section 3-2
   CMD_RESET = 0x06 #: from command table EX-106 section 3-2
   CMD_SYNC_WRITE = 0x83 #: from command table EX-106 section 3-2
+  CMD_BULK_READ = 0x92 #: from MX-series e-manual, "Instruction Packet"
   MEM_LEN = 0x39 #: length of control table EX-106 section 3-4
   SYNC = b'\xff\xff' #: synchronization pattern at start of packets EX-106 section 3-2
   MAX_ID = 0xFD #: maximal value of ID field EX-106 section 3-2
@@ -114,6 +123,11 @@ class DynamixelMemMap:
     THEORY:
       -- create a dictionary _ADDR_DCR_ that holds the memory location, name, and type (B, >H)
          generate a set of properties with the commmand name and it equivalent location
+      -- each class has its own _ADDR_DCR, and its own precompiled codecs:
+         _CODEC maps each address to a struct.Struct for its register, and
+         _RANGES lists the contiguous spans of registers. Spans of the
+         control table are decoded in one call by RegisterBlock codecs,
+         made by block() and cached in _BLOCKS.
     """
 
     _ADDR_DCR = {
@@ -121,14 +135,25 @@ class DynamixelMemMap:
     }
     MODEL_ADDR = pack('B',0) #: Address of model number, shared for all models
     MODEL_ADDR_LEN = 2 #: Length of model number
+    BULK_READ = False #: True if the model supports CMD_BULK_READ
+    EEPROM_END = 0x18 #: Addresses below this are in EEPROM
+    #: Names of read-only registers updated by the servo itself
+    SENSORS = frozenset([
+      "present_position", "present_speed", "present_load",
+      "present_voltage", "present_temperature", "registered_instruction",
+      "moving", "current", "sense_current"
+    ])
 
     @classmethod
     def _prepare( cls, ADDR={} ):
       """ (protected)
-      Set up all the _ADDR_DCR names as class attributes
+      Set up all the _ADDR_DCR names as class attributes, and precompile
+      the codecs of the registers
       This classmethod must be called on every subclass after it is declared
       """
       if ADDR:
+        # Copy the superclass table, so that models don't share registers
+        cls._ADDR_DCR = dict(DynamixelMemMap._ADDR_DCR)
         cls._ADDR_DCR.update({
           b'\x02' : ("version", "B"),
           b'\x03' : ("ID", "B"),
@@ -159,8 +184,52 @@ class DynamixelMemMap:
           b'\x30' : ("punch", "<H")
         })
         cls._ADDR_DCR.update(ADDR)
+      cls._CODEC = {}
       for adr,(nm,fmt) in cls._ADDR_DCR.items():
           setattr(cls,nm,adr)
+          cls._CODEC[adr] = Struct(fmt)
+      # Contiguous spans of registers, as (start address, length)
+      cls._RANGES = []
+      for adr in sorted(cls._ADDR_DCR):
+          a = bytearray(adr)[0]
+          n = cls._CODEC[adr].size
+          if cls._RANGES and sum(cls._RANGES[-1]) == a:
+              cls._RANGES[-1][1] += n
+          else:
+              cls._RANGES.append([a,n])
+      cls._RANGES = [ tuple(r) for r in cls._RANGES ]
+      cls._BLOCKS = {}
+
+    @classmethod
+    def block( cls, first, last=None ):
+      """
+      Codec for the span of the control table from register first through
+      register last (both given by address or name), cached per class
+
+      OUTPUT:
+        RegisterBlock
+      """
+      if not isinstance(first,bytes):
+        first = getattr(cls,first)
+      if last is None:
+        last = first
+      elif not isinstance(last,bytes):
+        last = getattr(cls,last)
+      blk = cls._BLOCKS.get((first,last),None)
+      if blk is None:
+        blk = RegisterBlock(cls,first,last)
+        cls._BLOCKS[(first,last)] = blk
+      return blk
+
+    @classmethod
+    def ranges( cls ):
+      """
+      Contiguous spans of registers in the control table
+
+      OUTPUT:
+        list of (start address, length) pairs, in address order
+      """
+      return list(cls._RANGES)
 
 DynamixelMemMap._prepare()
 
@@ -176,26 +245,124 @@ class MemMapOpsMixin:
       """ Parse the message bytes returned when reading address addr """
       if isinstance(val,Exception):
         raise val
-      val_bytes_object = bytesHelper(val)
-
-      return unpack( cls._ADDR_DCR[addr][1], val_bytes_object)[0]
+      return cls._CODEC[addr].unpack_from(val)[0]
 
     @classmethod
     def val2pkt( cls, addr, val ):
       """ Build the message bytes sent when writing address addr with value val"""
-      return pack( cls._ADDR_DCR[addr][1], val )
+      return cls._CODEC[addr].pack( val )
 
     @classmethod
     def val2len( cls, addr ):
       """ Number of message bytes returned when writing address addr """
-      return calcsize( cls._ADDR_DCR[addr][1] )
+      return cls._CODEC[addr].size
+
+    @classmethod
+    def access( cls, addr ):
+      """
+      Classify the register at address addr as one of:
+        'static' -- EEPROM; changes only when written
+        'volatile' -- RAM control register; may change without being written,
+           e.g. torque_en is cleared by alarm shutdown and a power cycle
+           restores all RAM defaults
+        'sensor' -- read-only value updated by the servo
+      """
+      if cls._ADDR_DCR[addr][0] in cls.SENSORS:
+        return 'sensor'
+      if bytearray(addr)[0] < cls.EEPROM_END:
+        return 'static'
+      return 'volatile'
 
     @classmethod
     def show( cls, addr, val ):
       """ Provide human readable representation of a value from address addr"""
-      nm,fmt = cls._ADDR_DCR[addr]
-      nm_bytes_object = bytesHelper(nm)
-      return "%s = %d" % (nm, unpack(fmt, nm_bytes_object)[0])
+      return "%s = %d" % (cls._ADDR_DCR[addr][0], cls.pkt2val(addr,val))
+
+class RegisterBlock( object ):
+    """ ( concrete )
+    DESCRIPTION:
+      -- A RegisterBlock decodes a span of a control table, covering several
+         registers, with a single precompiled struct.Struct
+    RESPONSIBILITIES:
+      -- describe the span: start address, length, registers in it
+      -- decode a read of the span into a named tuple, and many reads into
+         a NumPy record array
+    OWNERSHIP:
+      -- created and cached by DynamixelMemMap.block()
+    THEORY:
+      -- bytes between registers (e.g. reserved addresses) are skipped with
+         pad bytes in the Struct format, and with offsets in the NumPy dtype
+    """
+    def __init__(self, mm, first, last):
+        """
+        INPUTS:
+          mm -- DynamixelMemMap subclass
+          first, last -- bytes -- addresses of first and last register
+        ATTRIBUTES:
+          addr -- bytes -- start address, as used by mem_read_sync
+          length -- int -- number of bytes in the span
+          names -- tuple -- names of registers in the span
+          offsets -- tuple -- offset of each register in the span
+          formats -- tuple -- struct format of each register
+          codec -- struct.Struct -- decoder of the span
+          Record -- namedtuple class of decoded values
+        """
+        a0 = bytearray(first)[0]
+        a1 = bytearray(last)[0] + mm._CODEC[last].size
+        if a1 <= a0:
+          raise ValueError("Register block must start before it ends")
+        fmt = ['<']
+        names = []
+        offsets = []
+        formats = []
+        a = a0
+        for adr in sorted(mm._ADDR_DCR):
+          b = bytearray(adr)[0]
+          if b < a0 or b >= a1:
+            continue
+          if b < a:
+            raise ValueError("Register '%s' overlaps its predecessor" % mm._ADDR_DCR[adr][0])
+          fmt.append( 'x'*(b-a) + mm._ADDR_DCR[adr][1].lstrip('<') )
+          names.append(mm._ADDR_DCR[adr][0])
+          offsets.append(b-a0)
+          formats.append(mm._ADDR_DCR[adr][1])
+          a = b + mm._CODEC[adr].size
+        fmt.append( 'x'*(a1-a) )
+        self.addr = pack('B',a0)
+        self.length = a1-a0
+        self.names = tuple(names)
+        self.offsets = tuple(offsets)
+        self.formats = tuple(formats)
+        self.codec = Struct(''.join(fmt))
+        self.Record = namedtuple(mm.__name__+'Block',names)
+
+    def decode( self, dat ):
+        """
+        Decode a read of the block into a Record named tuple
+        """
+        if isinstance(dat,Exception):
+          raise dat
+        return self.Record._make( self.codec.unpack_from(dat) )
+
+    def dtype( self ):
+        """
+        NumPy dtype of a block record
+        """
+        from numpy import dtype
+        return dtype(dict( names=self.names, formats=self.formats,
+          offsets=self.offsets, itemsize=self.length ))
+
+    def decode_many( self, dats ):
+        """
+        Decode many reads of the block into a NumPy record array
+        """
+        from numpy import frombuffer
+        buf = bytearray()
+        for dat in dats:
+          if isinstance(dat,Exception):
+            raise dat
+          buf.extend(dat)
+        return frombuffer( bytes(buf), dtype=self.dtype() )
 
 class MX64Mem( DynamixelMemMap):
     """
@@ -203,7 +370,7 @@ class MX64Mem( DynamixelMemMap):
       -- The MX64Mem class provides a mapping of the dynamixel control table:
          as per the MX-64 manual pp. 2-3, section title "Control Table"
     """
-    pass
+    BULK_READ = True
 
 ##ADDED b
 MX64Mem._prepare({
@@ -224,7 +391,7 @@ class MX28Mem( DynamixelMemMap):
       -- The MX28Mem class provides a mapping of the dynamixel control table:
          http://support.robotis.com/en/product/dynamixel/mx_series/mx-28.htm
     """
-    pass
+    BULK_READ = True
 MX28Mem._prepare({
     b'\x14' : ("multi_turn_offset","<H"),
     b'\x16' : ("resolution_divider","B"),
@@ -275,7 +442,7 @@ class MX106RMem( DynamixelMemMap ):
       -- The MX106RMem class provides a mapping of the dynamixel control table:
          as per the MX-106R e-manual, section title "Control Table"
     """
-    pass
+    BULK_READ = True
 MX106RMem._prepare({
     b'\x0a' : ("drive_mode", "B"),
     b'\x14' : ("multi_turn_offset", "<H"),
@@ -317,6 +484,312 @@ class AX12MemWithOps( RX64Mem, MemMapOpsMixin ):
   # NOTE: the table is identical to that of the RX64
   memMapParent = RX64Mem
 
+class PacketTemplate( object ):
+    """ ( internal concrete )
+    DESCRIPTION:
+      -- A PacketTemplate encodes instruction packets that share a layout:
+         the same command, optional register address and parameter format
+    RESPONSIBILITIES:
+      -- precompile a struct.Struct for the variable part of the packet
+      -- hold a preallocated output buffer with the constant bytes in place
+      -- patch only node ID, value and checksum for each packet encoded
+    OWNERSHIP:
+      -- owned by a PacketEncoder
+    THEORY:
+      -- packets are laid out as per EX-106 section 3-2 pp. 16:
+           0xFF 0xFF ID LEN CMD [ADDR] PARAMETERS CHECKSUM
+         SYNC, LEN, CMD and ADDR never change, so they are written into the
+         buffer once, and their contribution to the checksum is precomputed
+    CONSTRAINTS:
+      -- the buffer returned by .encode() is overwritten by the next call
+    """
+    def __init__(self, cmd, fmt, addr=None):
+        """
+        INPUTS:
+          cmd -- int -- command value. ie: CMD_PING, CMD_WRITE_DATA, etc ...
+          fmt -- string -- struct format of the parameters (after ADDR), e.g.
+            '<H' for a 2 byte register or '3s' for 3 bytes of raw parameters
+          addr -- int -- register address, or None if the packet has none
+        """
+        self.cmd = cmd
+        self.addr = addr
+        self.value = Struct('<'+fmt.lstrip('<>=!@'))
+        self.ofs = 5 if addr is None else 6
+        plen = self.ofs-5 + self.value.size
+        self.size = plen+6
+        self.buf = bytearray(self.size)
+        self.buf[:2] = Dynamixel.SYNC
+        self.buf[3] = plen+2
+        self.buf[4] = cmd
+        if addr is not None:
+          self.buf[5] = addr
+        self.vview = memoryview(self.buf)[self.ofs:-1]
+        self.base = sum(self.buf[3:self.ofs])
+        self.batch = bytearray()
+
+    def encode( self, nid, *val ):
+        """
+        Encode a packet to node nid with parameters val
+
+        OUTPUTS:
+          buf -- bytearray -- the preallocated buffer holding the packet
+        """
+        buf = self.buf
+        buf[2] = nid
+        self.value.pack_into( buf, self.ofs, *val )
+        buf[-1] = 0xFF ^ (0xFF & (self.base + nid + sum(self.vview)))
+        return buf
+
+    def encode_many( self, items ):
+        """
+        Encode a packet for each (nid, val...) tuple in items, back to back
+
+        OUTPUTS:
+          buf -- memoryview -- contiguous buffer holding all packets
+        """
+        items = list(items)
+        n = self.size*len(items)
+        if len(self.batch) < n:
+          self.batch = bytearray(n)
+        out = memoryview(self.batch)[:n]
+        for k,item in enumerate(items):
+          out[k*self.size:(k+1)*self.size] = self.encode( *item )
+        return out
+
+class SyncWriteTemplate( object ):
+    """ ( internal concrete )
+    DESCRIPTION:
+      -- A SyncWriteTemplate encodes SYNC_WRITE packets that write a given
+         number of nodes with values of the same format at the same address
+    THEORY:
+      -- packet layout as per EX-106 section 3-5-7 pp. 39:
+           0xFF 0xFF BROADCAST_ID LEN SYNC_WRITE ADDR L (ID DATA)*N CHECKSUM
+         only the (ID DATA) entries and checksum are patched per packet
+    CONSTRAINTS:
+      -- the buffer returned by .encode() is overwritten by the next call
+    """
+    def __init__(self, addr, fmt, count):
+        self.entry = Struct('<B'+fmt.lstrip('<>=!@'))
+        L = self.entry.size-1
+        plen = 2 + count*self.entry.size
+        if plen+2 > 0xFF:
+          raise ValueError('SYNC_WRITE of %d nodes x %d bytes is too long' % (count,L))
+        self.count = count
+        self.size = plen+6
+        self.buf = bytearray(self.size)
+        self.buf[:2] = Dynamixel.SYNC
+        self.buf[2:7] = bytearray((Dynamixel.BROADCAST_ID, plen+2, Dynamixel.CMD_SYNC_WRITE, addr, L))
+        self.vview = memoryview(self.buf)[7:-1]
+        self.base = sum(self.buf[2:7])
+
+    def encode( self, items ):
+        """
+        Encode a SYNC_WRITE packet from a sequence of (nid, val) pairs
+
+        OUTPUTS:
+          buf -- bytearray -- the preallocated buffer holding the packet
+        """
+        buf = self.buf
+        sz = self.entry.size
+        ofs = 7
+        for nid,val in items:
+          self.entry.pack_into( buf, ofs, nid, val )
+          ofs += sz
+        if ofs != self.size-1:
+          raise ValueError('SYNC_WRITE template for %d nodes got %d' % (self.count,(ofs-7)//sz))
+        buf[-1] = 0xFF ^ (0xFF & (self.base + sum(self.vview)))
+        return buf
+
+class PacketEncoder( object ):
+    """ ( concrete )
+    DESCRIPTION:
+      -- The PacketEncoder builds Dynamixel instruction packets from
+         precompiled templates
+    RESPONSIBILITIES:
+      -- cache PacketTemplate and SyncWriteTemplate instances by layout
+      -- encode single packets, batches of packets, and SYNC_WRITE packets
+    OWNERSHIP:
+      -- owned by a dynamixel.Bus
+    THEORY:
+      -- templates are created on first use of each layout, i.e. each
+         (command, register, format) combination; subsequent packets with
+         that layout only patch their variable bytes
+    """
+    def __init__(self):
+        self.templates = {}
+
+    def template( self, cmd, fmt, addr=None ):
+        """
+        Obtain the PacketTemplate for a (command, format, register) layout
+        """
+        key = (cmd,fmt,addr)
+        tpl = self.templates.get(key,None)
+        if tpl is None:
+          tpl = PacketTemplate(cmd,fmt,addr)
+          self.templates[key] = tpl
+        return tpl
+
+    def sync_write_template( self, addr, fmt, count ):
+        """
+        Obtain the SyncWriteTemplate for count nodes written at addr with fmt
+        """
+        key = (Dynamixel.CMD_SYNC_WRITE,fmt,addr,count)
+        tpl = self.templates.get(key,None)
+        if tpl is None:
+          tpl = SyncWriteTemplate(addr,fmt,count)
+          self.templates[key] = tpl
+        return tpl
+
+    def encode( self, nid, cmd, pars=b'' ):
+        """
+        Encode a packet with raw (marshalled) parameters pars
+
+        OUTPUTS:
+          buf -- bytearray -- packet; overwritten by the next packet of same layout
+        """
+        return self.template( cmd, '%ds' % len(pars) ).encode( nid, bytes(pars) )
+
+    def encode_many( self, cmd, items ):
+        """
+        Encode a batch of packets with the same command into one buffer
+
+        INPUTS:
+          cmd -- int -- command value
+          items -- sequence of (nid, pars) -- node IDs and raw parameters;
+            all parameters must have the same length
+        OUTPUTS:
+          buf -- memoryview -- all packets, back to back
+        """
+        items = [ (nid,bytes(pars)) for nid,pars in items ]
+        return self.template( cmd, '%ds' % len(items[0][1]) ).encode_many( items )
+
+    def encode_sync_write( self, addr, items ):
+        """
+        Encode a SYNC_WRITE packet
+
+        INPUTS:
+          addr -- int -- register address
+          items -- sequence of (nid, pars) -- node IDs and raw values;
+            all values must have the same length
+        OUTPUTS:
+          buf -- bytearray -- packet; overwritten by the next packet of same layout
+        """
+        items = [ (nid,bytes(pars)) for nid,pars in items ]
+        L = len(items[0][1])
+        for nid,pars in items:
+          if len(pars) != L:
+            raise ValueError('SYNC_WRITE value for node 0x%02x has length %d, expected %d' % (nid,len(pars),L))
+        return self.sync_write_template( addr, '%ds' % L, len(items) ).encode( items )
+
+class RTTStats( object ):
+    """ ( concrete )
+    DESCRIPTION:
+      -- RTTStats tracks the round trip times of request/reply exchanges
+         with a single node, and derives reply timeouts from them
+    RESPONSIBILITIES:
+      -- maintain a smoothed RTT and RTT deviation
+      -- maintain a histogram of RTTs, for percentile estimates
+      -- count replies that did not arrive in time
+    OWNERSHIP:
+      -- owned by a dynamixel.Bus, in its .rtt dictionary
+    THEORY:
+      -- the smoothed RTT and deviation are EWMA-s, updated as in TCP
+         (RFC 6298) with gains ALPHA and BETA
+      -- the histogram has logarithmic bins, two per octave, starting
+         at H0; counts are halved when they total AGE, so that the
+         percentiles follow changes in bus conditions
+      -- the timeout is the larger of SRTT + 4*RTTVAR and the 99th
+         percentile, doubled for every retry of the same request
+         (exponential backoff). Only replies to a first attempt are
+         sampled (Karn's algorithm), since a late reply to an earlier
+         attempt would be mistaken for a fast reply to the retry.
+    """
+    ALPHA = 0.125 #: EWMA gain of smoothed RTT
+    BETA = 0.25 #: EWMA gain of RTT deviation
+    H0 = 50e-6 #: Upper edge of the lowest histogram bin
+    NBINS = 28 #: Number of histogram bins; the top bin is open ended
+    AGE = 1024 #: Histogram count at which counts are halved
+    MIN_SAMPLES = 8 #: Number of samples needed before timeouts adapt
+    MIN_TIMEOUT = 0.002 #: Smallest timeout ever used
+
+    def __init__(self):
+        self.n = 0
+        self.lost = 0
+        self.srtt = None
+        self.rttvar = 0.0
+        self.hist = [0]*self.NBINS
+        self.hn = 0
+
+    @classmethod
+    def _bin( cls, dt ):
+        if dt <= cls.H0:
+          return 0
+        return min( cls.NBINS-1, int(2*log(dt/cls.H0,2))+1 )
+
+    @classmethod
+    def edge( cls, b ):
+        """Upper edge of histogram bin b"""
+        return cls.H0 * 2**(b/2.0)
+
+    def add( self, dt ):
+        """
+        Add an RTT sample of dt seconds
+        """
+        self.n += 1
+        if self.srtt is None:
+          self.srtt = dt
+          self.rttvar = dt/2.0
+        else:
+          self.rttvar += self.BETA * (abs(self.srtt-dt) - self.rttvar)
+          self.srtt += self.ALPHA * (dt - self.srtt)
+        self.hist[self._bin(dt)] += 1
+        self.hn += 1
+        if self.hn >= self.AGE:
+          self.hist = [ c//2 for c in self.hist ]
+          self.hn = sum(self.hist)
+
+    def percentile( self, q ):
+        """
+        Estimate the q-th quantile (0<q<=1) of the RTT, as an upper
+        edge of a histogram bin; None if there are no samples
+        """
+        if not self.hn:
+          return None
+        goal = q * self.hn
+        acc = 0
+        for b,c in enumerate(self.hist):
+          acc += c
+          if acc >= goal:
+            return self.edge(b)
+        return self.edge(self.NBINS-1)
+
+    def timeout( self, tmax, attempt=0 ):
+        """
+        Compute the time to wait for a reply
+
+        INPUTS:
+          tmax -- float -- maximal timeout; used until there are enough samples
+          attempt -- int -- number of previous attempts of this request
+        """
+        if self.n < self.MIN_SAMPLES:
+          return tmax
+        t = max( self.MIN_TIMEOUT, self.srtt + 4*self.rttvar, self.percentile(0.99) )
+        return min( tmax, t * (1<<attempt) )
+
+    def histogram( self ):
+        """
+        Return the non-empty histogram bins as a list of (upper edge, count)
+        """
+        return [ (self.edge(b),c) for b,c in enumerate(self.hist) if c ]
+
+    def __str__( self ):
+        if self.srtt is None:
+          return "n 0 lost %d" % self.lost
+        return "n %d lost %d srtt %.2fms dev %.2fms p50 %.2fms p99 %.2fms hist %s" % (
+          self.n, self.lost, self.srtt*1e3, self.rttvar*1e3,
+          self.percentile(0.5)*1e3, self.percentile(0.99)*1e3,
+          " ".join([ "<%.2f:%d" % (e*1e3,c) for e,c in self.histogram() ]) )
+
 class Bus( AbstractBus ):
     """ ( concrete )
     DESCRIPTION:
@@ -346,7 +819,8 @@ class Bus( AbstractBus ):
 
         ATTRIBUTES:
           ser -- serial handle
-          buf -- buffer string '
+          rxbuf -- bytearray -- preallocated receive buffer
+          rxHead, rxTail -- int -- the unparsed bytes are rxbuf[rxHead:rxTail]
           expect -- number of expected bytes. default: 6
           eSync -- number of SYNC errors
           eChksum -- number of checksum errors
@@ -355,12 +829,27 @@ class Bus( AbstractBus ):
           count -- a count of bytes received
           rxPkts -- a count of valid packets received
           txPkts -- a count of packets sent
-        """
+          encoder -- PacketEncoder -- precompiled packet templates
+          rtt -- dict -- node ID to RTTStats of its replies
+          heartbeats -- dict or None -- if set, every valid packet received
+            is stored in it as a heartbeat of its node (see recv())
+          trace -- bustrace.BusTrace or None -- if set, records transactions
+            of this bus and the Protocol using it
+          batch -- bool -- if set, packets that get no reply (broadcasts)
+            are held in .txq and written together by flushTx(); see _write()
+          txq -- bytearray -- packets held for writing in batch mode
+          txWrites -- a count of writes to the connection
+        """
+        batch = kw.pop('batch',False)
         AbstractBus.__init__(self,*args,**kw)
         if port is None:
           port = DEFAULT_PORT
         self.ser = newConnection(port)
         self.DEBUG = DEBUG
+        self.encoder = PacketEncoder()
+        self.heartbeats = None
+        self.trace = None
+        self.batch = batch
         self.reset()
 
     def getSupportedBaudrates(self):
@@ -369,11 +858,17 @@ class Bus( AbstractBus ):
         """
         return self.ser.getSupportedBaudrates()
 
+    #: Size of the receive buffer; must exceed the longest packet
+    RXBUF_LEN = 4096
+
     def reset( self ):
         """
         The purpose of this method is to reset the state of the Bus to initial values
         """
-        self.buf = b''
+        self.rxbuf = bytearray(self.RXBUF_LEN)
+        self.rxview = memoryview(self.rxbuf)
+        self.rxHead = 0
+        self.rxTail = 0
         self.expect = 6
         self.eSync = 0
         self.eChksum = 0
@@ -384,14 +879,18 @@ class Bus( AbstractBus ):
         self.rxEcho = 0
         self.txPkts = 0
         self.txBytes = 0
+        self.txWrites = 0
+        self.txq = bytearray()
         self.suppress = {}
+        self.rtt = {}
         self.ser.flush()
 
     def flush( self ):
         """
         Flush software and hardware buffers
         """
-        self.buf = b''
+        self.rxHead = self.rxTail = 0
+        self.expect = 6
         self.ser.flush()
         if 'x' in self.DEBUG:
           progress('[Dynamixel] flush bus\n')
@@ -407,17 +906,60 @@ class Bus( AbstractBus ):
             'bytes in %d' % self.count,
             'bytes out %d' % self.txBytes,
             'packets out %d' % self.txPkts,
+            'writes out %d' % self.txWrites,
             'packets in %d' % self.rxPkts,
             'echos in %d' % self.rxEcho,
             'sync errors %d' % self.eSync,
             'id errors %d' % self.eID,
             'length errors %d' % self.eLen,
             'crc errors %d' % self.eChksum,
-            'buffer %d expecting %d' % (len(self.buf),self.expect)
+            'buffer %d expecting %d' % (self.rxTail-self.rxHead,self.expect)
             ]
 
+    def rttMsg( self ):
+        """
+        returns the per-node round trip time statistics
+
+        OUTPUTS:
+          -- list -- strings with RTT summary and histogram of each node
+        """
+        return [ 'rtt 0x%02x %s' % (nid,self.rtt[nid]) for nid in sorted(self.rtt) ]
+
+    def replyTimeout( self, nid, tmax, attempt=0 ):
+        """
+        Time to wait for a reply from node nid (see RTTStats.timeout)
+        """
+        st = self.rtt.get(nid,None)
+        if st is None:
+          return tmax
+        return st.timeout( tmax, attempt )
+
+    def noteRTT( self, nid, dt ):
+        """
+        Record a round trip time of dt seconds for node nid
+        """
+        st = self.rtt.get(nid,None)
+        if st is None:
+          st = self.rtt[nid] = RTTStats()
+        st.add(dt)
+
+    def noteLost( self, nid ):
+        """
+        Record that a reply from node nid did not arrive in time
+        """
+        st = self.rtt.get(nid,None)
+        if st is None:
+          st = self.rtt[nid] = RTTStats()
+        st.lost += 1
+
+    @property
+    def buf( self ):
+        "Copy of the received bytes that were not parsed yet"
+        return bytes(self.rxview[self.rxHead:self.rxTail])
+
     def reconnect( self, **changes ):
         " Close the connection and reopen with modified parameters "
+        self.flushTx()
         self.ser.close()
         spec = self.ser.newConnection_spec
         spec.update( changes )
@@ -464,19 +1006,58 @@ class Bus( AbstractBus ):
         if err & 0x40:
           msg.append("Unknown instruction in message")
         if len(msg)>1 and not noRaise:
-          raise DynamixelServoError("; ".join(msg))
+          err = DynamixelServoError("; ".join(msg))
+          err.pkt = pkt
+          raise err
         return "; ".join(msg)
 
     def _dropByte( self, error=None ):
         """ (private)
-        Drop a single byte from the input buffer .buf and reset .expect
+        Drop a single byte from the input buffer and reset .expect
         If error is provided, increment that error counter
         """
-        self.buf = self.buf[1:]
+        self.rxHead += 1
         self.expect = 6
         if error is not None:
           setattr(self,error,getattr(self,error)+1)
 
+    def _resync( self ):
+        """ (private)
+        Skip to the next SYNC pattern in the input buffer, counting every
+        byte skipped as a sync error. If there is no SYNC pattern, keeps
+        only a trailing 0xFF, which may be the start of the next SYNC.
+        """
+        h = self.rxHead
+        t = self.rxTail
+        k = self.rxbuf.find(Dynamixel.SYNC, h+1, t)
+        if k<0:
+          k = t-1 if self.rxbuf[t-1] == 0xFF else t
+        self.eSync += k-h
+        self.rxHead = k
+        self.expect = 6
+
+    def _fill( self ):
+        """ (private)
+        Read all available data into the receive buffer.
+        Compacts the buffer if there is not enough space at its end.
+        """
+        n = self.ser.inWaiting()
+        if n<=0:
+          return 0
+        if self.rxHead == self.rxTail:
+          self.rxHead = self.rxTail = 0
+        if self.rxTail+n > len(self.rxbuf):
+          # Move the unparsed bytes to the front of the buffer
+          l = self.rxTail-self.rxHead
+          self.rxbuf[:l] = self.rxview[self.rxHead:self.rxTail]
+          self.rxHead = 0
+          self.rxTail = l
+          n = min(n,len(self.rxbuf)-l)
+        n = self.ser.readinto(self.rxview[self.rxTail:self.rxTail+n])
+        self.rxTail += n
+        self.count += n
+        return n
+
     @classmethod
     def dump( cls, msg ):
         """
@@ -535,7 +1116,6 @@ class Bus( AbstractBus ):
             if tbl[key] < n - SWEEP_EVERY:
               del tbl[key]
         # should packet be suppressed?
-        pkt = byteUnpack(pkt)
         if pkt in tbl:
           # yes; don't suppress if seen again
           del tbl[pkt]
@@ -549,7 +1129,8 @@ class Bus( AbstractBus ):
         INPUTS:
           None
         OUTPUTS:
-          pkt -- string -- valid packet from Dynamixel hardware bus
+          pkt -- memoryview -- payload of valid packet from Dynamixel hardware bus,
+            i.e. the packet without SYNC and checksum
         PRECONDITIONS:
           existence of serial object
           reset() has been called at least once
@@ -558,63 +1139,70 @@ class Bus( AbstractBus ):
 
         THEORY OF OPERATION:
           Parse for valid packets as per EX-106 section 3-3 pp. 17
-          - While there are bytes to be read from serial buffer or from buf
-            - Read in expected number of bytes if available
-            - Check for start frame, otherwise drop byte
-            - Check for valid ID, otherwise drop byte
-            - Check for valid Length, otherwise drop byte
+          - While there are unparsed bytes in .rxbuf[.rxHead:.rxTail]
+            - If fewer than expected, read all available bytes into .rxbuf
+            - Check for start frame, otherwise skip to next SYNC
+            - Check for valid ID and Length; if invalid, consume it if it is
+              an echo of a packet we sent, otherwise drop byte
             - Once Length bytes arrive, check if CRC is valid, otherwise drop byte
           - If there are no more bytes to read or parse then return None
+
+          Dropping a byte moves the start of the unparsed region and copies
+          nothing; loss of sync is recovered by searching for the next SYNC,
+          so recovering from line noise is linear in the number of bytes.
+          Each valid packet is copied once out of the buffer, into an immutable
+          bytes object which is also used for echo detection. The payload
+          returned is a view into that object, and remains valid indefinitely.
+
+          Any valid packet that is not an echo shows its node is alive, so it
+          is stored as a heartbeat in .heartbeats (if set), regardless of
+          who is reading the bus.
         """
-        SYNC = Dynamixel.SYNC
         MAX_ID = Dynamixel.MAX_ID
         assert self.expect >= 6
+        buf = self.rxbuf
         while True:
-            # Read all available data
-            n = self.ser.inWaiting()
-            if n>0:
-              rd = bytes(self.ser.read(n))
-              self.buf += rd
-              self.count += len(rd)
+            h = self.rxHead
             # Expecting at least self.expect bytes
-            if len(self.buf)<self.expect:
-              # --> if not available then done with loop
-              return None
+            if self.rxTail-h<self.expect:
+              # --> if not available then try to read more
+              if not self._fill():
+                return None
+              continue
             # Expecting sync byte
-            if not self.buf.startswith(SYNC):
-              # --> didn't find sync; drop the first byte
-              self._dropByte('eSync')
+            if buf[h] != 0xFF or buf[h+1] != 0xFF:
+              # --> didn't find sync; skip to next candidate
+              self._resync()
               continue
-            ## assert self.buf.startswith(SYNC)
-            # Make sure that our nid makes sense
-            ID = self.buf[2]
-            if ID > MAX_ID: # Where 0xFD is the maximum ID
-                self._dropByte('eID')
-                continue
             # Pull out the length byte and compute total length
-            L = 4+self.buf[3]
-            # Ensure that length is within valid range. 6 is minimum possible packet length
-            if L > maxlen or L < 6:
-              self._dropByte('eLen')
+            L = 4+buf[h+3]
+            # Make sure that our nid makes sense, and that length is within
+            #   valid range. 6 is minimum possible packet length
+            if buf[h+2] > MAX_ID or L > maxlen or L < 6:
+              # Broadcasts and long packets may be echoes of our own (e.g. SYNC_WRITE)
+              if L >= 6 and self.rxTail-h >= L and self._testForEcho(bytes(self.rxview[h:h+L])):
+                self.rxHead = h+L
+                self.rxEcho += 1
+                continue
+              # Where 0xFD is the maximum ID
+              self._dropByte('eID' if buf[h+2] > MAX_ID else 'eLen')
               continue
             # If there isn't enough data for length in packet
-            if len(self.buf)<L:
+            if self.rxTail-h<L:
               # --> record that as the expected length and try again
               self.expect = L
               continue
-            assert len(self.buf)>=L
-            chk = self._chksum(self.buf[2:L-1])
-            ##print ">>"," ".join([ "%02x" % (ord(b)) for b in self.buf[:6] ]),"chk",hex(chk),hex(ord(self.buf[L-1])),L
-            if self.buf[L-1] != chk[0]:
+            # Copy out the candidate packet; the checksum covers all but
+            #   the two SYNC bytes (0xFF each) and the checksum byte itself
+            fl_pkt = bytes(self.rxview[h:h+L])
+            if fl_pkt[-1] != 0xFF ^ (0xFF & (sum(fl_pkt) - 0x1FE - fl_pkt[-1])):
               self._dropByte('eChksum')
               continue
             # At this point we have a packet that passed the checksum in
-            #   positions buf[:L+1]. We peel the wrapper and return the
-            #   payload portion
-            pkt = self.buf[2:L-1]
-            fl_pkt = self.buf[:L]
-
-            self.buf = self.buf[L:]
+            #   positions buf[h:h+L]. We consume it, and return a view of
+            #   the payload portion
+            self.rxHead = h+L
+            self.expect = 6 # Reset expect value
             # Check if this is an echo
             if self._testForEcho(fl_pkt):
               self.rxEcho += 1
@@ -624,10 +1212,12 @@ class Bus( AbstractBus ):
             self.rxPkts += 1
             if 'x' in self.DEBUG:
               progress('[Dynamixel] recv --> [%s] %s\n' % (self.dump(fl_pkt),repr(fl_pkt)))
+            pkt = memoryview(fl_pkt)[2:L-1]
+            if self.heartbeats is not None:
+              self.heartbeats[fl_pkt[2]] = (now(), pkt)
             # Run error check
-            self.parseErr(pkt)
-            #print("PKT TYPE: ", type(pkt))
-            self.expect = 6 # Reset expect value
+            if fl_pkt[4]:
+              self.parseErr(pkt)
             return pkt
         # ends parsing loop
         # Function terminates returning a valid packet payload or None
@@ -649,25 +1239,135 @@ class Bus( AbstractBus ):
           None
 
         THEORY OF OPERATION:
-          Assemble packet as per EX-106 section 3-2 pp. 16,
-          Compute checksum, transmit and then return string
+          Assemble packet as per EX-106 section 3-2 pp. 16 using the
+          encoder's template for this command and parameter length,
+          transmit and then return string
+        """
+        return self._transmit( self.encoder.encode(nid, cmd, pars), 'send' )
 
+    def send_many( self, cmd, items ):
         """
-        #TODO: make sure that this change is valid.
+        Transmit a batch of packets with the same command in a single write
 
-        ##PROFESSOR REVZEN CHANGES
-        body = bytearray([nid,len(pars)+2, cmd] + list(pars))
-        crc = self._chksum(body)
-        msg = Dynamixel.SYNC + body + crc
+        INPUTS:
+          cmd -- int -- command value
+          items -- sequence of (nid, pars) -- node IDs and parameter strings;
+            all parameter strings must have the same length
+        OUTPUTS:
+          msgs -- list -- transmitted packets minus sync
+        """
+        items = list(items)
+        if not items:
+          return []
+        buf = bytes(self.encoder.encode_many( cmd, items ))
+        sz = len(buf)//len(items)
+        if 'x' in self.DEBUG:
+          progress('[Dynamixel] send_many --> [%s] %s\n' % (self.dump(buf),repr(buf)))
+        self._write(buf, items[0][0] != Dynamixel.BROADCAST_ID
+                         or cmd in self.BROADCAST_REPLIES)
+        res = []
+        for k in range(0,len(buf),sz):
+          msg = buf[k:k+sz]
+          self.txPkts+=1
+          self.suppress[msg] = self.txPkts
+          res.append(msg[2:])
+        self.txBytes+=len(buf)
+        return res
+
+    def _transmit( self, msg, what ):
+        """ (private)
+        Write out an encoded packet and update transmit statistics
+        and echo suppression
 
+        INPUTS:
+          msg -- bytearray -- complete packet, including SYNC and checksum
+          what -- string -- name of operation, for debug messages
+        OUTPUTS:
+          msg -- string -- transmitted packet minus sync
+        """
+        msg = bytes(msg)
         if 'x' in self.DEBUG:
-          progress('[Dynamixel] send --> [%s] %s\n' % (self.dump(msg),repr(msg)))
-        self.ser.write(msg)
+          progress('[Dynamixel] %s --> [%s] %s\n' % (what,self.dump(msg),repr(msg)))
+        self._write(msg, msg[2] != Dynamixel.BROADCAST_ID
+                         or msg[4] in self.BROADCAST_REPLIES)
         self.txPkts+=1
         self.txBytes+=len(msg)
-        self.suppress[bytes(msg)] = self.txPkts
+        self.suppress[msg] = self.txPkts
+        # Broadcasts get no reply, so they are complete transactions
+        if self.trace is not None and msg[2] == Dynamixel.BROADCAST_ID:
+          self.trace.record( now(), msg[2], msg[4], len(msg), outcome=SENT )
         return msg[2:]
 
+    #: Broadcast commands that servos answer (each in turn), so that they
+    #:   must not be held in batch mode
+    BROADCAST_REPLIES = (Dynamixel.CMD_PING, Dynamixel.CMD_BULK_READ)
+
+    #: In batch mode, held packets are written once .txq reaches this size.
+    #:   Must stay well below what the echo suppression table keeps (see
+    #:   _testForEcho), so that echoes of held packets are still recognized
+    TXQ_MAX = 512
+
+    def _write( self, msg, reply ):
+        """ (private)
+        Write bytes to the connection, or hold them in batch mode
+
+        INPUTS:
+          msg -- bytes -- one or more complete packets
+          reply -- bool -- true if a reply is expected; such packets are
+            written immediately, together with any held packets before them
+
+        THEORY OF OPERATION:
+          In batch mode, packets that get no reply are appended to .txq,
+          and reach the connection in a single write when flushTx() is
+          called (Protocol.update does this at its end), when a packet that
+          needs a reply is sent, or when .txq grows past TXQ_MAX. Packets
+          keep their order, and are entered in the echo suppression table
+          when queued, so echo suppression and statistics are unaffected.
+        """
+        if not self.batch:
+          self.ser.write(msg)
+          self.txWrites += 1
+          return
+        self.txq.extend(msg)
+        if reply or len(self.txq) >= self.TXQ_MAX:
+          self.flushTx()
+
+    def flushTx( self ):
+        """
+        Write out all packets held in batch mode (see _write())
+
+        OUTPUTS:
+          -- int -- number of bytes written
+        """
+        n = len(self.txq)
+        if n:
+          self.ser.write(bytes(self.txq))
+          self.txWrites += 1
+          del self.txq[:]
+        return n
+
+    #: WRITE_DATA parameters clearing torque_en; its address is the same
+    #:   in all the memory maps
+    TORQUE_OFF = b'\x18\x00'
+
+    def off( self ):
+        """
+        Turn off all servos on the bus with a single broadcast packet
+
+        OUTPUTS:
+          msg -- string -- transmitted packet minus sync
+
+        THEORY OF OPERATION:
+          Broadcast a WRITE_DATA clearing torque_en (as per section 3-4-2
+          pp. 27); broadcasts get no status packet, so this returns as soon
+          as the packet is written. Packets held in batch mode go out first,
+          in the same write.
+        """
+        msg = self.send( Dynamixel.BROADCAST_ID, Dynamixel.CMD_WRITE_DATA,
+                         self.TORQUE_OFF )
+        self.flushTx()
+        return msg
+
     def send_sync_write( self, nid, addr, pars ):
         """
         Build a SYNC_WRITE message writing a value
@@ -686,24 +1386,63 @@ class Bus( AbstractBus ):
         THEORY OF OPERATION:
           Set a value remotely, without expecting a reply
         """
+        return self.send_sync_write_many( addr, [(nid,pars)] )
 
-        body = bytearray([Dynamixel.BROADCAST_ID, len(pars)+5, Dynamixel.CMD_SYNC_WRITE] + list(addr) + [len(pars), nid] + list(pars))
+    def send_sync_write_many( self, addr, items ):
+        """
+        Build a single SYNC_WRITE message writing the same address on
+        multiple nodes
 
-        #body = ( pack('BBB', Dynamixel.BROADCAST_ID, len(pars)+5, Dynamixel.CMD_SYNC_WRITE)
-        #        +addr
-        #        +pack('BB', len(pars), nid)
-        #        +pars
+        INPUTS:
+          addr -- string -- address
+          items -- sequence of (nid, pars) pairs -- node ID and value (after
+            marshalling) for each node. All values must have the same length
+        OUTPUTS:
+          msg -- string -- transmitted packet minus sync
+        PRECONDITIONS:
+          existance of serial object
+        POSTCONDITIONS:
+          None
 
-        crc = self._chksum(body)
-        msg = Dynamixel.SYNC + body + crc
+        THEORY OF OPERATION:
+          Assemble packet as per EX-106 section 3-5-7 pp. 39:
+            BROADCAST_ID, LEN, SYNC_WRITE, addr, L, nid1, data1, nid2, data2 ...
+          where L is the length of each value and LEN = (L+1)*N+4 for N nodes.
+          No reply is expected. Packets longer than a single LEN byte allows
+          raise ValueError; use Protocol.mem_write_many to split them.
+        """
+        items = list(items)
+        if not items:
+          raise ValueError('SYNC_WRITE requires at least one node')
+        msg = self.encoder.encode_sync_write( bytearray(addr)[0], items )
+        return self._transmit( msg, 'sync_write' )
 
-        if 'x' in self.DEBUG:
-          progress('[Dynamixel] sync_write --> [%s] %s\n' % (self.dump(msg),repr(msg)))
-        self.ser.write(msg)
-        self.suppress[bytes(msg)] = self.txPkts
-        self.txPkts+=1
-        self.txBytes+=len(msg)
-        return msg[2:]
+    def send_bulk_read( self, items ):
+        """
+        Send a BULK_READ broadcast, requesting a read from many nodes
+
+        INPUTS:
+          items -- sequence of (nid, addr, length) -- node ID, address (as
+            a one byte string) and number of bytes to read from each node
+        OUTPUTS:
+          msg -- string -- transmitted packet minus sync
+
+        THEORY OF OPERATION:
+          Assemble a BULK_READ packet as per the MX-series e-manual:
+            BROADCAST_ID, LEN, BULK_READ, 0x00, L1, nid1, addr1, L2, nid2, ...
+          Each node answers with a normal status packet, in the order the
+          nodes were listed; a node waits for the reply of the node listed
+          before it, so a missing node silences all nodes that follow it.
+        """
+        items = list(items)
+        if not items:
+          raise ValueError('BULK_READ requires at least one node')
+        if 3*len(items)+3 > 0xFF:
+          raise ValueError('BULK_READ of %d nodes is too long' % len(items))
+        pars = bytearray(1)
+        for nid,addr,length in items:
+          pars.extend((length,nid,bytearray(addr)[0]))
+        return self._transmit( self.encoder.encode( Dynamixel.BROADCAST_ID, Dynamixel.CMD_BULK_READ, pars ), 'bulk_read' )
 
     def ping( self, nid ):
         """
@@ -739,6 +1478,17 @@ class Bus( AbstractBus ):
         """
         return self.write(nid, Dynamixel.CMD_RESET)
 
+    @staticmethod
+    def replyMaxlen( cmd, pars ):
+        """
+        Maximal length of a valid reply to command cmd with parameters
+        pars, for use as the maxlen of recv(); reads may return more than
+        the 4 bytes of payload recv() accepts by default
+        """
+        if cmd == Dynamixel.CMD_READ_DATA:
+          return max( 10, 6+bytearray(pars)[1] )
+        return 10
+
     def send_cmd_sync( self, nid, cmd, pars, timeout=0.1, retries=5 ):
         """
         Send a command in synchronous form, waiting for reply
@@ -747,37 +1497,57 @@ class Bus( AbstractBus ):
           nid, cmd, pars -- same as for .send()
           timeout -- float-- maximal wait per retry
           retries -- number of allowed retries until giving up
-          rate -- wait time between retries
         OUTPUTS:
           pkt -- string -- response packet's payload
 
         THEORY OF OPERATION:
-          Plan out sending times for all retries. When a retry goal time is passed
-          sends out the message. In between, poll for a reply for that message at a
-          hard coded rate (currently 100Hz)
+          Send the message, then wait for a reply from the node until a
+          deadline given by the node's RTT statistics (see RTTStats), or
+          by timeout until enough of them were collected. The wait blocks
+          on the connection's file descriptor where it has one, so replies
+          are seen as soon as they arrive. When the deadline passes, the
+          message is re-sent, with the deadline doubled, up to timeout.
+          Transactions are recorded in .trace, if set.
         """
         if nid==Dynamixel.BROADCAST_ID:
           raise ValueError('Broadcasts get no replies -- cannot send_cmd_sync')
+        ts = now()
+        maxlen = self.replyMaxlen( cmd, pars )
         for k in range(retries+1):
-          #print("NID TYPE1: ", type(nid))
-          #print("NID1: ", nid)
-
           hdr0 = self.send(nid, cmd, pars)[0]
           t0 = now()
-          # Put a sensible amount of time to wait for a response in
-          sleep( 0.003 )
-          while now()-t0<timeout:
-            pkt = self.recv()
-            # If read() got nothing --> we sleep a little
+          t1 = t0 + self.replyTimeout( nid, timeout, k )
+          while True:
+            try:
+              pkt = self.recv( maxlen )
+            except DynamixelServoError as err:
+              if self.trace is not None and err.pkt[0]==hdr0:
+                self.trace.record( ts, nid, cmd, (k+1)*(6+len(pars)),
+                  len(err.pkt)+3, now()-t0, k, ERROR )
+              raise
+            # If read() got nothing --> wait for input until the deadline
             if pkt is None:
-              sleep( 0.001 )
+              dt = t1 - now()
+              if dt <= 0:
+                self.noteLost( nid )
+                break
+              self.ser.waitInput( dt )
             # If got reply --> done
             elif pkt[0]==hdr0:
+              # Only replies to first attempts give reliable RTTs
+              if k == 0:
+                self.noteRTT( nid, now()-t0 )
+              if self.trace is not None:
+                self.trace.record( ts, nid, cmd, (k+1)*(6+len(pars)),
+                  len(pkt)+3, now()-t0, k, OK )
               if 't' in self.DEBUG:
                 progress("[Dynamixel] send_cmd_sync dt: %2.5f " % (now()-t0))
                 progress("[Dynamixel] send_cmd_sync send attempts: %d " % (k+1))
               return pkt
             # if neither condition was true, we read as fast as we can
+        if self.trace is not None:
+          self.trace.record( ts, nid, cmd, (retries+1)*(6+len(pars)),
+            0, now()-t0, retries, TIMEOUT )
         return None
 
     @staticmethod
@@ -796,17 +1566,201 @@ class Bus( AbstractBus ):
 
       return reply[0],reply[1],reply[2],reply[3:]
 
+class AsyncBus( Bus ):
+    """ ( concrete )
+    DESCRIPTION:
+      -- The AsyncBus class is a dynamixel.Bus whose commands are coroutines,
+         driven by an asyncio event loop
+    RESPONSIBILITIES:
+      -- everything a Bus does
+      -- send commands and await their replies without blocking the loop
+    OWNERSHIP:
+      -- owned by the application's asyncio tasks
+    THEORY:
+      -- the connection is wrapped in an aioport2port.AsyncConnection, which
+         reads incoming data as soon as the event loop sees it arrive; the
+         Bus packet parser then operates on the buffered data. Waiting for
+         replies is an await on the connection, so many buses (and other
+         I/O) can share one event loop, with no sleep polling.
+    CONSTRAINTS:
+      -- a Dynamixel bus is half duplex, so commands on the same bus are
+         serialized by an asyncio.Lock; commands on different buses
+         proceed concurrently
+    """
+    def __init__(self, port=None, loop=None, *args, **kw):
+        """
+        Initialize asynchronous Dynamixel Bus
+
+        INPUT:
+          port -- connection specification (see port2port.newConnection),
+            or a port2port.Connection; None to autoconfig
+          loop -- asyncio event loop, or None to use the current one
+        """
+        Bus.__init__(self, port, *args, **kw)
+        self.ser = newAsyncConnection(self.ser, loop)
+        self.lock = None
+
+    async def send_cmd( self, nid, cmd, pars=b'', timeout=0.1, retries=5 ):
+        """
+        Send a command and await its reply
+
+        INPUTS:
+          nid, cmd, pars -- same as for .send()
+          timeout -- float-- maximal wait per retry
+          retries -- number of allowed retries until giving up
+        OUTPUTS:
+          pkt -- string -- response packet's payload, or None if no reply
+
+        THEORY OF OPERATION:
+          Same as send_cmd_sync, except that waiting for input awaits the
+          connection instead of blocking.
+        """
+        if nid==Dynamixel.BROADCAST_ID:
+          raise ValueError('Broadcasts get no replies -- cannot send_cmd')
+        if self.lock is None:
+          self.lock = Lock()
+        maxlen = self.replyMaxlen( cmd, pars )
+        async with self.lock:
+          for k in range(retries+1):
+            hdr0 = self.send(nid, cmd, pars)[0]
+            t0 = now()
+            t1 = t0 + self.replyTimeout( nid, timeout, k )
+            while True:
+              pkt = self.recv( maxlen )
+              if pkt is None:
+                dt = t1 - now()
+                if dt <= 0:
+                  self.noteLost( nid )
+                  break
+                await self.ser.wait( dt )
+              elif pkt[0]==hdr0:
+                if k == 0:
+                  self.noteRTT( nid, now()-t0 )
+                return pkt
+          return None
+
+    async def ping( self, nid, **kw ):
+        """
+        Ping a node; returns the reply, or None if there was none
+        """
+        return await self.send_cmd( nid, Dynamixel.CMD_PING, **kw )
+
+    async def mem_read( self, nid, addr, length, **kw ):
+        """
+        Read length bytes at address addr (one byte string) of node nid
+
+        OUTPUTS:
+          the bytes read, or None if there was no reply
+        """
+        pkt = await self.send_cmd( nid, Dynamixel.CMD_READ_DATA, addr+pack('B',length), **kw )
+        if pkt is None:
+          return None
+        return self.splitReply(pkt)[-1]
+
+    async def mem_write( self, nid, addr, pars, **kw ):
+        """
+        Write the bytes pars at address addr (one byte string) of node nid
+
+        OUTPUTS:
+          the reply, or None if there was none
+        """
+        return await self.send_cmd( nid, Dynamixel.CMD_WRITE_DATA, addr+pars, **kw )
+
 class ProtocolError( AbstractProtocolError ):
   def __init__(self,*arg, **kw):
     AbstractProtocolError.__init__(self,*arg, **kw)
 
+class ControlTableShadow( object ):
+    """ ( concrete )
+    DESCRIPTION:
+      -- A ControlTableShadow holds the last known values of the control
+         table registers of one node
+    RESPONSIBILITIES:
+      -- answer reads of static (EEPROM) registers without bus traffic
+      -- track values written, and whether the node acknowledged them
+      -- count cache hits, misses and suppressed writes
+    OWNERSHIP:
+      -- owned by a ProtocolNodeAdaptor, as its .shadow
+    THEORY:
+      -- registers are classified by the memory map (see
+         MemMapOpsMixin.access). All values read or written are recorded,
+         but only 'static' registers are ever served from the shadow,
+         since the servo may change the others on its own.
+      -- a value is "clean" once the node confirmed it, either by returning
+         it in a read, or by acknowledging its write. Values written without
+         acknowledgement (SYNC_WRITE) are "dirty" until then, and are never
+         served or used to suppress writes.
+      -- a write of a static register whose clean value is already the
+         value being written is suppressed
+    """
+    def __init__(self, mm):
+        self.mm = mm
+        self.val = {}
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.suppressed = 0
+
+    def invalidate( self, addr=None ):
+        """
+        Forget the value of register addr, or of all registers if addr is None
+        """
+        if addr is None:
+          self.val.clear()
+          self.dirty.clear()
+          return
+        self.val.pop(addr,None)
+        self.dirty.discard(addr)
+
+    def lookup( self, addr ):
+        """
+        Look up the value of register addr
+
+        OUTPUTS:
+          val -- value, or None if the register must be read from the node
+        """
+        if (addr in self.val and addr not in self.dirty
+            and self.mm.access(addr) == 'static'):
+          self.hits += 1
+          return self.val[addr]
+        self.misses += 1
+        return None
+
+    def isRedundant( self, addr, val ):
+        """
+        Test whether writing val to register addr can be suppressed
+        """
+        if (self.val.get(addr,None) == val and addr not in self.dirty
+            and self.mm.access(addr) == 'static'):
+          self.suppressed += 1
+          return True
+        return False
+
+    def store( self, addr, val, clean=True ):
+        """
+        Record val as the value of register addr; clean if confirmed by the node
+        """
+        self.val[addr] = val
+        if clean:
+          self.dirty.discard(addr)
+        else:
+          self.dirty.add(addr)
+
+    def statsMsg( self ):
+        """
+        Return a string with shadow statistics
+        """
+        return "shadow: %d regs (%d dirty), %d hits, %d misses, %d writes suppressed" % (
+          len(self.val), len(self.dirty), self.hits, self.misses, self.suppressed )
+
 class ProtocolNodeAdaptor( AbstractNodeAdaptor ):
-    def __init__(self, protocol, nid = None, mm=DynamixelMemWithOps):
+    def __init__(self, protocol, nid = None, mm=DynamixelMemWithOps, model=None):
         AbstractNodeAdaptor.__init__(self)
         self.p = protocol
         self.nid = nid
         self.mm = mm
-        self.model = None
+        self.model = model
+        self.shadow = ControlTableShadow(mm)
         self._adaptMem()
 
     def _adaptMem( self ):
@@ -818,6 +1772,7 @@ class ProtocolNodeAdaptor( AbstractNodeAdaptor ):
           self.mm = (MODELS[tc][0])
         except KeyError as ke:
           raise KeyError('Unknown module typecode "%s"' % tc)
+        self.shadow.mm = self.mm
 
     def reset(self):
         """
@@ -825,6 +1780,7 @@ class ProtocolNodeAdaptor( AbstractNodeAdaptor ):
         NOTE: this is a FACTORY RESET code. It is very likely to change the
           node's baud-rate and make it unreachable.
         """
+        self.shadow.invalidate()
         return self.p.reset_nid(self.nid)
 
     def mem_write_fast( self, addr, val ):
@@ -838,34 +1794,65 @@ class ProtocolNodeAdaptor( AbstractNodeAdaptor ):
         OUTPUTS:
           msg -- string -- transmitted packet minus SYNC
 
-        <<BROKEN AS OF RECENT FIRMWARE; REPLACED WITH REGULAR WRITE>>
         THEORY OF OPERATION:
           Call write command with BROADCAST_ID as id, SYNC_WRITE as cmd, and params
           as ( start_address, length_of_data, nid, data1, data2, ... ) as per
           section 3-5-7 pp. 39
         """
-        return self.mem_write_sync( addr, val )
-        ### return self.p.mem_write( self.nid, addr, self.mm.val2pkt( addr, val ) )
+        self.shadow.store( addr, val, clean=False )
+        return self.p.mem_write( self.nid, addr, self.mm.val2pkt( addr, val ) )
 
     def mem_write_sync( self, addr, val ):
         """
-        Send a memory write command and wait for response, returning it
+        Send a memory write command and wait for response, returning it.
+        Writes that would not change a static register are suppressed
+        (see ControlTableShadow)
 
         INPUTS:
           addr -- char -- address
           val -- int -- value
         OUTPUTS:
-          msg -- string -- transmitted packet minus SYNC
+          msg -- string -- response packet's payload, or None if the write
+            timed out or was suppressed
         """
-        ##POTENTIAL ERROR HERE
-        return self.p.mem_write_sync( self.nid, addr, self.mm.val2pkt( addr, val ))
+        if self.shadow.isRedundant( addr, val ):
+          return None
+        self.shadow.invalidate( addr )
+        reply = self.p.mem_write_sync( self.nid, addr, self.mm.val2pkt( addr, val ))
+        if reply is not None:
+          self.shadow.store( addr, val )
+        return reply
 
     def mem_read_sync( self, addr ):
         """
-        TODO
+        Read a register and wait for the result, using the shadow for
+        static registers (see ControlTableShadow)
+
+        INPUTS:
+          addr -- char -- address
+        OUTPUTS:
+          value of the register
         """
+        val = self.shadow.lookup( addr )
+        if val is not None:
+          return val
         reply = self.p.mem_read_sync( self.nid, addr, self.mm.val2len(addr) )
-        return self.mm.pkt2val( addr, reply )
+        val = self.mm.pkt2val( addr, reply )
+        self.shadow.store( addr, val )
+        return val
+
+    def mem_read_block( self, first, last ):
+        """
+        Read the registers from first through last in one transaction
+
+        INPUTS:
+          first, last -- char or str -- address or name of the first and
+            last register
+        OUTPUTS:
+          named tuple of register values (see RegisterBlock)
+        """
+        blk = self.mm.block( first, last )
+        return blk.decode( self.p.mem_read_sync( self.nid, blk.addr, blk.length ) )
 
     def get_typecode( self ):
         """
@@ -902,6 +1889,7 @@ class ProtocolNodeAdaptor( AbstractNodeAdaptor ):
         OUTPUTS:
           promise -- list -- promise returned from request
         """
+        self.shadow.invalidate( addr )
         return self.p.request( self.nid, Dynamixel.CMD_WRITE_DATA, addr+self.mm.val2pkt( addr, val ))
 
     @classmethod
@@ -927,6 +1915,24 @@ class ProtocolNodeAdaptor( AbstractNodeAdaptor ):
             raise dat
         return dat
 
+    def async_read_value( self, addr, promise, barf=True ):
+        """
+        Parse the result of a mem_read_async of address addr into a value
+
+        INPUTS:
+          addr -- char -- address that was read
+          promise -- list -- promise returned by mem_read_async
+          barf -- bool -- throw exception or not (see async_parse)
+        OUTPUTS:
+          value of the register, or an exception object if barf is False
+        """
+        dat = self.async_parse( promise, barf )
+        if isinstance(dat,Exception):
+            return dat
+        val = self.mm.pkt2val( addr, self.p.bus.splitReply(dat)[-1] )
+        self.shadow.store( addr, val )
+        return val
+
     def get_voltage( self ):
         """
         Get present voltage on bus as read by servo
@@ -979,7 +1985,7 @@ class Request(object):
     -- Request objects are specific to those messages handled by the
        dynamixel.Protocol and dynamixel.Bus
     """
-    def __init__(self, nid, cmd, pars='',  ts=None, tout=0.05, attempts=4 ):
+    def __init__(self, nid, cmd, pars=b'',  ts=None, tout=0.05, attempts=4 ):
         if ts is None:
             ts = now()
         self.nid = nid
@@ -988,8 +1994,28 @@ class Request(object):
         self.ts = ts
         self.tout = tout
         self.attempts = attempts
+        self.sends = 0
+        self.sent = None
         self.promise = []
 
+    def isExpired( self, t ):
+      """True if the request outlived its lifetime at time t"""
+      return t - self.ts > self.tout
+
+    def isReply( self, pkt ):
+      """
+      Test whether status packet payload pkt is a plausible reply to this request.
+      Status packets carry no command code, so we match on the node ID and, for
+      reads, on the number of bytes that were requested. This is only safe
+      because the Protocol never has more than one attempt outstanding per
+      node, including attempts that timed out (see Protocol.ghosts).
+      """
+      if pkt[0] != self.nid:
+        return False
+      if self.cmd == Dynamixel.CMD_READ_DATA:
+        return len(pkt) == 3 + bytearray(self.pars)[1]
+      return len(pkt) == 3
+
     def setError( self, msg ):
       self.promise[:] = [ProtocolError("%s on node 0x%x" % (msg,self.nid))]
 
@@ -999,6 +2025,142 @@ class Request(object):
     def sendArgs( self ):
       return self.nid, self.cmd, self.pars
 
+class MotionFrame( object ):
+    """ ( concrete )
+    DESCRIPTION:
+      -- A MotionFrame collects the writes issued through Protocol.mem_write
+         and mem_write_many while it is active, and commits them so that all
+         servos act on them at the same instant
+    RESPONSIBILITIES:
+      -- stage writes, merging the writes to each node
+      -- commit them as REG_WRITE requests followed by a broadcast ACTION
+    OWNERSHIP:
+      -- created by Protocol.motion_frame(); active while Protocol.frame
+    THEORY:
+      -- REG_WRITE stores a single write in each servo, which it executes
+         when it receives an ACTION. The writes staged for a node are merged
+         into contiguous spans (e.g. goal_position, moving_speed and
+         torque_limit form one span); the span holding the goal position
+         (or else the last span) is sent with REG_WRITE.
+      -- commit() queues the REG_WRITE requests, acknowledged and retried as
+         usual, and an ACTION request, which the Protocol sends only once all
+         requests queued before it were answered or given up. Protocol.update
+         drives the commit; callers need not wait for it.
+      -- frames nest; only the outermost frame commits.
+    CONSTRAINTS:
+      -- a frame that exits with an exception discards the writes it has
+         staged and sends no ACTION
+      -- as a servo holds a single REG_WRITE, the other spans of a node
+         (e.g. torque_en written by go_slack) are sent as acknowledged
+         WRITE_DATA requests, queued before the node's REG_WRITE. They take
+         effect when they arrive, i.e. before the ACTION, and not in sync
+         with the other servos.
+    """
+    GOAL_ADDR = bytearray(MX64Mem.goal_position)[0] #: same for all models
+
+    def __init__(self, protocol, lifetime=0.5):
+        """
+        INPUTS:
+          protocol -- Protocol -- the protocol whose writes are staged
+          lifetime -- float -- lifetime of the commit requests
+        ATTRIBUTES:
+          writes -- dict -- node ID to dict of address to staged bytes
+          promises -- list -- promises of the REG_WRITE and ACTION requests
+            of the last commit
+        """
+        self.p = protocol
+        self.lifetime = lifetime
+        self.writes = {}
+        self.promises = []
+        self.depth = 0
+
+    def __enter__( self ):
+        if self.depth == 0:
+            self.p.frame = self
+        self.depth += 1
+        return self
+
+    def __exit__( self, typ, val, tb ):
+        self.depth -= 1
+        if self.depth == 0:
+            self.p.frame = None
+            if typ is None:
+                self.commit()
+            else:
+                self.writes = {}
+        return False
+
+    def stage( self, nid, addr, pars ):
+        """
+        Stage a write of pars to address addr of node nid
+        """
+        self.writes.setdefault(nid,{})[bytearray(addr)[0]] = bytes(pars)
+
+    def _spans( self, regs ):
+        """(private)
+        Merge a dict of address to bytes into a list of contiguous
+        (addr, bytes) spans; later writes overwrite earlier ones
+        """
+        mem = {}
+        for a in sorted(regs):
+            for k,b in enumerate(bytearray(regs[a])):
+                mem[a+k] = b
+        spans = []
+        for a in sorted(mem):
+            if spans and spans[-1][0]+len(spans[-1][1]) == a:
+                spans[-1][1].append(mem[a])
+            else:
+                spans.append((a,bytearray([mem[a]])))
+        return spans
+
+    def commit( self ):
+        """
+        Queue the staged writes as REG_WRITE requests (and WRITE_DATA
+        requests for spans that do not fit in a REG_WRITE, see
+        CONSTRAINTS), followed by a broadcast ACTION
+
+        OUTPUTS:
+          promise -- list -- promise of the ACTION request, or None if
+            nothing was staged
+        """
+        writes, self.writes = self.writes, {}
+        self.promises = []
+        if not writes:
+            return None
+        for nid,regs in sorted(writes.items()):
+            spans = self._spans(regs)
+            main = spans[-1]
+            for sp in spans:
+                if sp[0] <= self.GOAL_ADDR < sp[0]+len(sp[1]):
+                    main = sp
+            # The servo keeps only one REG_WRITE --> write the others now
+            for sp in spans:
+                if sp is not main:
+                    self.promises.append( self.p.request( nid, Dynamixel.CMD_WRITE_DATA,
+                        pack('B',sp[0])+bytes(sp[1]), lifetime=self.lifetime ) )
+            self.promises.append( self.p.request( nid, Dynamixel.CMD_REG_WRITE,
+                pack('B',main[0])+bytes(main[1]), lifetime=self.lifetime ) )
+        act = self.p.request( Dynamixel.BROADCAST_ID, Dynamixel.CMD_ACTION,
+            lifetime=self.lifetime )
+        self.promises.append( act )
+        return act
+
+    def done( self ):
+        """True if the last commit completed"""
+        return all( self.promises )
+
+    def wait( self, timeout=0.5 ):
+        """
+        Run Protocol.update until the last commit completed
+
+        OUTPUTS:
+          list of errors reported by the commit's requests
+        """
+        t1 = now() + timeout
+        while not self.done() and now() < t1:
+            self.p.update( timeout=t1-now() )
+        return [ pr[0] for pr in self.promises if pr and isinstance(pr[0],Exception) ]
+
 class Protocol( AbstractProtocol ):
     """ ( concrete )
     DESCRIPTION:
@@ -1040,39 +2202,58 @@ class Protocol( AbstractProtocol ):
            response is not found, a number of retries should occur to accomodate
            for errors
 
+         Requests are handled asynchronously. A request is written to the bus
+         as soon as the bus is free, and remains "in flight" until a status
+         packet from its node arrives, or until its reply timeout expires.
+         Since the bus is half duplex, by default only one request is in
+         flight at a time (see .pipeline). Replies are matched to in-flight
+         requests by node ID (and reply length), so update() never blocks
+         waiting for any single reply; requests still in flight when the
+         timeslice ends are completed by a later update().
+
+         Status packets carry no sequence number, so a reply that arrives
+         after its attempt timed out could be taken for the reply to the
+         next request to that node. After a timeout, nothing is sent to
+         the node until its late reply arrives (and is discarded), or
+         another reply timeout passed (see .ghosts). Replies thus match
+         the node's only outstanding attempt, and only first attempts give
+         RTT samples.
+
+         The synchronous methods (mem_read_sync, mem_write_sync) queue
+         their request like any other, and run update() until it
+         completes, so they never consume replies to other requests.
+
          A basic representation of the update() algorithm follows:
 
            get the allowed timeslice
-           while len queue > 0:
-             pop message from queue
-             if message has timed out:
-               declare message promise as Err
-             if allowed timeslice is used up:
-               append message to front of queue and exit
-             if the message is a broadcast message:
-               if ping:
-                 warn that broadcast pings are not allowed outside of scan
+           while timeslice is not used up:
+             for each in-flight request whose reply timed out:
+               if it has attempts and lifetime left:
+                 put it back at the front of the queue
                else:
-                 send message through Bus, and continue to next message
-             else:
-               for number of retries remaining in message:
-                 if allowed timeslice is used up:
-                   append message to front of queue and exit
-                 send message through Bus
-                 while have not reached timeout or timeslice is used up:
-                   read in packet
-                   if packet exists:
-                     fulfill message promise, and continue to next message
-                   sleep so that we don't overwork the OS
-               if no more retries remaining:
                  declare message promise as Err
+             while the pipeline has room and queue is not empty:
+               pop message from queue
+               if message has timed out:
+                 declare message promise as Err
+               elif the message is a broadcast message:
+                 if SYNC_WRITE:
+                   send message through Bus, fulfill with None
+                 else:
+                   declare message promise as Err
+               else:
+                 send message through Bus and mark it in-flight
+             read all available packets:
+               fulfill the in-flight message for the packet's node
+             if nothing is queued or in flight:
+               exit
 
     CONSTRAINTS:
       -- a single write when handled by update must have only a single response
       -- it is expected that a Dynamixel Bus has been instantiated as shown in the
          Dynamixel Module Examples
     """
-    def __init__(self, bus=None, nodes=None, *args,**kw):
+    def __init__(self, bus=None, nodes=None, topology=TOPOLOGY_CACHE, *args,**kw):
         """
         Initialize a Dynamixel Protocol
 
@@ -1084,7 +2265,23 @@ class Protocol( AbstractProtocol ):
           pnas -- dictionary -- dict of NodeAdaptor objects, used for interfacing with Dynamixel Module
           heartbeats -- dictionary -- dict of node heartbeats. nid : (timestamp, err)
           requests -- deque object -- queue of pending requests <<< maybe should just be a list?
-          ping_period -- float -- expected ping period
+          inflight -- dict -- nid to Request awaiting a reply
+          ghosts -- dict -- nid to the time until which a late reply to an
+            attempt that timed out may still arrive; nothing else is sent
+            to the node meanwhile, and a reply from it is discarded
+          pipeline -- int -- maximal number of requests in flight
+          frame -- MotionFrame or None -- active motion frame, which
+            stages writes (see motion_frame())
+          reply_timeout -- float -- maximal time to wait for a reply before
+            retrying; actual timeouts adapt to each node's round trip times
+            (see Bus.replyTimeout)
+          ping_rate -- float -- nodes silent for this long are pinged
+          pingDue -- list -- heap of (time, nid) at which nodes may need
+            a ping
+          models -- dict -- node ID to model number, as found by scan()
+          topology -- str -- path of topology cache file (see scan()), or
+            None to disable caching; defaults to TOPOLOGY_CACHE, i.e. the
+            PYCKBOTTOPOLOGY environment variable, or None if it is unset
 
         """
         AbstractProtocol.__init__(self,*args,**kw)
@@ -1092,6 +2289,7 @@ class Protocol( AbstractProtocol ):
             self.bus = Bus()
         else:
             self.bus = bus
+        self.topology = topology or None
         self.reset(nodes)
 
     def reset( self, nodes=None, ping_rate=1.0 ):
@@ -1103,23 +2301,31 @@ class Protocol( AbstractProtocol ):
         OUTPUTS:
           None
         THEORY OF OPERATION:
-          scan for nodes, add each node to the pollRing and generate a ProtocolNodeAdaptor
+          scan for nodes, and generate a ProtocolNodeAdaptor for each node,
+          which schedules it for heartbeat pings. The bus stores all
+          packets it receives as heartbeats.
         """
         self.pnas = {}
-        self.heartbeats = {}
+        self.heartbeats = HeartbeatTable()
+        self.bus.heartbeats = self.heartbeats
         self.requests = deque()
-        self.pollRing = deque()
+        self.inflight = {}
+        self.ghosts = {}
+        self.pipeline = 1
+        self.reply_timeout = 0.01
+        self.pingDue = []
         self.ping_rate = ping_rate
+        self.models = {}
+        self.frame = None
         if nodes is None:
             progress("Scanning bus for nodes \n")
             nodes = self.scan()
         for nid in nodes:
-            self.pollRing.append( nid )
             self.generatePNA( nid )
 
         progress("Dynamixel nodes: %s\n" % repr(list(nodes)))
 
-    def scan( self, timeout=1.0, retries=1, get_model=True ):
+    def scan( self, timeout=1.0, retries=1, get_model=True, gap=0.05 ):
         """
         Build a broadcast ping message and then read for responses, and if
           the get_model flag is set, then get model numbers for all existing
@@ -1131,6 +2337,8 @@ class Protocol( AbstractProtocol ):
           get_model -- bool -- flag determining if node model numbers
                                should be read to indicate the servo
                                type
+          gap -- float -- the reply window closes when no reply arrived
+                          for this long
         OUTPUTS:
           found -- dict -- map from servo IDs that were discovered
             to their model numbers, or None if get_model is False
@@ -1138,28 +2346,140 @@ class Protocol( AbstractProtocol ):
         THEORY OF OPERATION:
           Assemble packet as per EX-106 section 3-2 pp. 16, using
           PING Command as per section 3-5-5 pp. 37 and broadcast ID
-          Send this packet, then read responses and add to set  until
-          timeout and number of retries.
+          Send this packet, then read responses and add to set until
+          no response arrived for gap seconds, or the timeout for this
+          retry passed.
+
+          Model numbers are read by queueing a read request for each node,
+          and running update() until all are answered. Nodes found in the
+          topology cache (see .topology) whose cached model supports
+          BULK_READ are instead checked with a single BULK_READ of their
+          model numbers; a cached model is only used if the node reports
+          the same model (e.g. not if a servo was swapped for another
+          with the same ID), and other nodes fall back to a read request.
+          The models found are stored in .models and written back to the
+          cache.
         """
         found = []
         for retry in range(0, retries):
             self.bus.flush()
             self.bus.send(Dynamixel.BROADCAST_ID, Dynamixel.CMD_PING)
-            t0 = now()
-            while now()-t0 < float(timeout)/retries:
+            t0 = t1 = now()
+            t2 = t0 + float(timeout)/retries
+            while True:
                 pkt = self.bus.recv()
                 if pkt is not None:
                     nid = pkt[0]
-                    found.append(nid)
-                sleep(0.01)
-        res={}
+                    if nid not in found:
+                        found.append(nid)
+                    t1 = now()
+                    continue
+                t = now()
+                if t >= t2 or t-t1 >= gap:
+                    break
+                self.bus.ser.waitInput( min(t2,t1+gap)-t )
+        if not get_model:
+            return dict.fromkeys(found)
         for nid in found:
-          if get_model:
-            res[nid] = self.mem_read_sync( nid, DynamixelMemMap.MODEL_ADDR, DynamixelMemMap.MODEL_ADDR_LEN)
-          else:
-            res[nid] = None
+            self.models.pop(nid,None)
+        self.models.update( self._checkTopology( found, timeout ) )
+        promise = {}
+        for nid in found:
+            if nid not in self.models:
+                promise[nid] = self.request( nid, Dynamixel.CMD_READ_DATA,
+                  DynamixelMemMap.MODEL_ADDR+pack('B',DynamixelMemMap.MODEL_ADDR_LEN),
+                  lifetime=timeout )
+        t0 = now()
+        while self.update(timeout=timeout) and now()-t0 < timeout:
+            pass
+        for nid,pr in promise.items():
+            if pr and not isinstance(pr[0],Exception):
+                self.models[nid] = unpack('<H',bytes(pr[0][3:5]))[0]
+        res = {}
+        for nid in found:
+            mdl = self.models.get(nid,None)
+            if mdl is None:
+                res[nid] = ProtocolError("NID 0x%02x model read failed" % nid)
+            else:
+                res[nid] = pack('<H',mdl)
+        self._saveTopology( dict( (nid,self.models[nid]) for nid in found if nid in self.models ) )
         return res
 
+    def _checkTopology( self, found, timeout ):
+        """(private)
+        Verify the cached model numbers of the nodes found by a scan
+
+        INPUTS:
+          found -- list -- node IDs found by the scan
+          timeout -- float -- maximal wait for the replies
+        OUTPUTS:
+          dict mapping node ID to model number, for the nodes that
+          reported the model number found for them in the cache
+        """
+        cache = self._loadTopology()
+        if not cache:
+            return {}
+        bulk = []
+        for nid in found:
+            mm = MODELS.get("Dynamixel-%04x" % cache.get(nid,-1),(None,))[0]
+            if getattr(mm,'BULK_READ',False):
+                bulk.append(nid)
+        res = self._bulk_read( DynamixelMemMap.MODEL_ADDR,
+          DynamixelMemMap.MODEL_ADDR_LEN, bulk, min(timeout,0.05) )
+        return dict( (nid,cache[nid]) for nid,val in res.items()
+          if not isinstance(val,Exception) and unpack('<H',val)[0] == cache[nid] )
+
+    def _topologyKey( self ):
+        """(private)
+        Key of this bus in the topology cache: its connection specification,
+        which includes the port and baudrate
+        """
+        spec = getattr(self.bus.ser,'newConnection_spec',None)
+        if not spec:
+            return None
+        return repr(sorted(spec.items()))
+
+    def _loadTopology( self ):
+        """(private)
+        Load the cached topology of this bus
+
+        OUTPUTS:
+          dict mapping node ID to model number, or None
+        """
+        key = self._topologyKey()
+        if not self.topology or key is None:
+            return None
+        try:
+            with open(self.topology,'r') as f:
+                ent = json_load(f).get(key,None)
+        except (IOError, OSError, ValueError):
+            return None
+        if not ent:
+            return None
+        return dict( (int(nid),mdl) for nid,mdl in ent.items() )
+
+    def _saveTopology( self, models ):
+        """(private)
+        Store the topology of this bus in the cache, if it changed
+        """
+        key = self._topologyKey()
+        if not self.topology or key is None or not models:
+            return
+        if self._loadTopology() == models:
+            return
+        try:
+            with open(self.topology,'r') as f:
+                tbl = json_load(f)
+        except (IOError, OSError, ValueError):
+            tbl = {}
+        tbl[key] = dict( (str(nid),mdl) for nid,mdl in models.items() )
+        try:
+            with open(self.topology+'.tmp','w') as f:
+                json_dump(tbl,f,indent=1,sort_keys=True)
+            os_replace(self.topology+'.tmp',self.topology)
+        except (IOError, OSError) as err:
+            progress("Could not save topology cache '%s': %s\n" % (self.topology,str(err)))
+
     def hintNodes( self, nodes ):
         """
         Generate NodeAdaptors for nodes that are not already in pnas
@@ -1192,15 +2512,33 @@ class Protocol( AbstractProtocol ):
         THEORY OF OPERATION:
           Instantiate ProtocolNodeAdaptor add to pnas dictionary
         """
-        pna = ProtocolNodeAdaptor(self, nid)
+        mdl = self.models.get(nid,None)
+        if mdl is not None:
+          mdl = "Dynamixel-%04x" % mdl
+        if nid not in self.pnas:
+          heappush( self.pingDue, (0, nid) )
+        pna = ProtocolNodeAdaptor(self, nid, model=mdl)
         self.pnas[nid] = pna
         return pna
 
     def off( self ):
-      """
-      Turn all servos off ... see Bus.off
-      """
-      self.bus.off()
+        """
+        Turn all servos on the bus off ... see Bus.off
+
+        Queued and in-flight requests, and writes staged by a motion frame,
+        are dropped first, so that none of them can re-enable a servo
+        after it was turned off (writing goal_position enables torque).
+        """
+        if self.frame is not None:
+            self.frame.writes.clear()
+        for inc in list(self.requests)+list(self.inflight.values()):
+            inc.setError("cancelled by off()")
+        self.requests.clear()
+        t = now()
+        for nid,inc in self.inflight.items():
+            self.ghosts[nid] = t + self._replyTimeout(inc)
+        self.inflight.clear()
+        return self.bus.off()
 
     def reset_nid(self, nid):
         """
@@ -1217,10 +2555,65 @@ class Protocol( AbstractProtocol ):
           val -- int -- value
           pars -- string -- parameters
         OUTPUTS:
-          msg -- string -- transmitted packet minus SYNC
+          msg -- string -- transmitted packet minus SYNC, or None if
+            staged by a motion frame
         """
+        if self.frame is not None:
+            return self.frame.stage( nid, addr, pars )
         return self.bus.send_sync_write( nid, addr, pars )
 
+    def mem_write_many( self, addr, items ):
+        """
+        Send a memory write of the same address to many nodes, without
+        waiting for a response
+
+        INPUTS:
+          addr -- char -- address
+          items -- dict or sequence of pairs -- node ID to parameters
+        OUTPUTS:
+          msgs -- list -- transmitted packets minus SYNC
+
+        THEORY OF OPERATION:
+          Pack as many nodes as fit into each SYNC_WRITE packet; typically
+          a whole cluster fits in a single packet. While a motion frame is
+          active, the writes are staged instead.
+        """
+        if isinstance(items,dict):
+          items = list(items.items())
+        else:
+          items = list(items)
+        if self.frame is not None:
+          for nid,pars in items:
+            self.frame.stage( nid, addr, pars )
+          return []
+        if not items:
+          return []
+        per = (0xFF-4) // (len(items[0][1])+1)
+        return [ self.bus.send_sync_write_many( addr, items[k:k+per] )
+                 for k in range(0,len(items),per) ]
+
+    def motion_frame( self, lifetime=0.5 ):
+        """
+        Context manager staging writes for a synchronized commit
+
+        INPUTS:
+          lifetime -- float -- lifetime of the commit requests
+        OUTPUTS:
+          MotionFrame -- the active frame, if there is one; otherwise a
+            new frame
+
+        THEORY OF OPERATION:
+          Within the frame, writes made with mem_write and mem_write_many
+          (e.g. by module setters) are staged; when the outermost frame
+          exits, they are committed with REG_WRITE and a broadcast ACTION,
+          so that all servos start moving together (see MotionFrame).
+          The commit is driven by update(); use the frame's wait() method
+          to block until it completes.
+        """
+        if self.frame is not None:
+            return self.frame
+        return MotionFrame(self, lifetime)
+
     def mem_write_sync( self, nid, addr, pars ):
         """
         Send a memory write command and wait for response, returning it
@@ -1230,13 +2623,46 @@ class Protocol( AbstractProtocol ):
           val -- int -- value
           pars -- string -- parameters
         OUTPUTS:
-          msg -- string -- transmitted packet minus SYNC
+          msg -- string -- reply packet minus SYNC, or None if no reply
+            arrived
         """
-        return self.bus.send_cmd_sync( nid, Dynamixel.CMD_WRITE_DATA, addr+pars )
+        return self._sync( nid, Dynamixel.CMD_WRITE_DATA, addr+pars )
+
+    def _sync( self, nid, cmd, pars, timeout=0.1, retries=5 ):
+        """(private)
+        Queue a request, and run update() until it completes
+
+        INPUTS:
+          nid, cmd, pars -- as for request()
+          timeout -- float -- lifetime of the request per attempt
+          retries -- int -- number of attempts after the first
+        OUTPUTS:
+          pkt -- string -- reply packet minus SYNC, as from
+            Bus.send_cmd_sync, or None if no reply arrived
+
+        THEORY OF OPERATION:
+          Unlike Bus.send_cmd_sync, this goes through the request engine,
+          so replies to requests already in flight still reach them.
+          Raises DynamixelServoError if the servo reported an error.
+        """
+        lifetime = timeout*(retries+1)
+        promise = self.request( nid, cmd, pars, lifetime=lifetime,
+          attempts=retries+1 )
+        t1 = now() + lifetime
+        while not promise and now() < t1:
+            self.update( timeout=t1-now() )
+        if not promise:
+            return None
+        reply = promise[0]
+        if isinstance(reply,DynamixelServoError):
+            raise reply
+        if isinstance(reply,Exception):
+            return None
+        return reply
 
     def mem_read_sync( self, nid, addr, length, retries=4 ):
       """
-        A Protocol level syncronous memory read wrapper around bus.send_cmd_sync
+        A Protocol level syncronous memory read, through the request engine
 
         INPUTS:
           nid -- int -- node ID
@@ -1246,7 +2672,7 @@ class Protocol( AbstractProtocol ):
       """
       #ERROR 1
       for retry in range(0,retries):
-          reply = self.bus.send_cmd_sync( nid, Dynamixel.CMD_READ_DATA, addr+pack('B', length)) ##ERROR
+          reply = self._sync( nid, Dynamixel.CMD_READ_DATA, addr+pack('B', length))
           if reply is None:
             return ProtocolError("NID 0x%02x mem_read[0x%02x] timed out"
               % (nid, ord(addr)))
@@ -1254,10 +2680,73 @@ class Protocol( AbstractProtocol ):
           if len(res) != length:
             if retry < retries:
                   continue
-            return ProtocolError("NID 0x%02x mem_read[0x%02x] result length mismatch. Reply was %s" % (nid,ord(addr),repr(reply)))
+            return ProtocolError("NID 0x%02x mem_read[0x%02x] result length mismatch. Reply was %s" % (nid,ord(addr),repr(bytes(reply))))
           return res
 
-    def request( self, nid, cmd, pars='', lifetime=0.05,  **kw ):
+    def mem_read_many( self, addr, length, nids, timeout=0.05, retries=4 ):
+        """
+        Read the same address from many nodes
+
+        INPUTS:
+          addr -- string -- address (one byte string)
+          length -- int -- number of bytes to read from each node
+          nids -- sequence of int -- node IDs
+          timeout -- float -- maximal wait for the replies to a BULK_READ
+          retries -- int -- retries of reads that fall back to mem_read_sync
+        OUTPUTS:
+          res -- dict -- node ID to the bytes read, or to an Exception
+            (ProtocolError or DynamixelServoError) if the read failed
+
+        THEORY OF OPERATION:
+          Nodes whose model supports BULK_READ (see DynamixelMemMap.BULK_READ)
+          are read with one BULK_READ packet per (at most) 84 nodes, so the
+          whole exchange costs one request and a stream of back-to-back
+          replies. Replies are matched to nodes by node ID and length.
+          Nodes that do not support BULK_READ, and nodes whose reply did not
+          arrive (which also silences those listed after them), are read
+          with mem_read_sync.
+        """
+        bulk = [ nid for nid in nids
+          if nid in self.pnas and self.pnas[nid].mm.BULK_READ ]
+        res = self._bulk_read( addr, length, bulk, timeout )
+        for nid in nids:
+          if nid not in res:
+            res[nid] = self.mem_read_sync( nid, addr, length, retries )
+        return res
+
+    def _bulk_read( self, addr, length, bulk, timeout ):
+        """(private)
+        Read addr from nodes that support BULK_READ (see mem_read_many)
+
+        OUTPUTS:
+          res -- dict -- node ID to the bytes read, or to a
+            DynamixelServoError, for the nodes whose reply arrived
+        """
+        res = {}
+        per = (0xFF-3)//3
+        for k in range(0,len(bulk),per):
+          want = set(bulk[k:k+per])
+          self.bus.send_bulk_read( [ (nid,addr,length) for nid in bulk[k:k+per] ] )
+          t0 = now()
+          while want and now()-t0<timeout:
+            try:
+              pkt = self.bus.recv( maxlen=length+6 )
+            except DynamixelServoError as err:
+              pkt = err.pkt
+              reply = err
+            else:
+              if pkt is None:
+                self.bus.ser.waitInput( t0+timeout-now() )
+                continue
+              reply = pkt
+            nid = pkt[0]
+            if nid in want and len(pkt) == 3+length:
+              want.discard(nid)
+              self.heartbeats[nid] = (now(), reply)
+              res[nid] = reply if isinstance(reply,Exception) else bytes(pkt[3:])
+        return res
+
+    def request( self, nid, cmd, pars=b'', lifetime=0.05,  **kw ):
         """
         Send a response request by creating an incomplete messsage
         and appending it to the queue for handling by update
@@ -1281,26 +2770,38 @@ class Protocol( AbstractProtocol ):
           and return a promise that will be fulfilled by a successful read
           during Protocol.update()
         """
-        inc = Request( nid, cmd, pars, tout=lifetime)
+        inc = Request( nid, cmd, pars, tout=lifetime, **kw )
         self.requests.append( inc )
         return inc.promise
 
     def _get_heartbeats( self, now ):
         """
-        Use pollRing to poll all nodes that haven't been seen for
-        self.ping_rate seconds with ping packets.
+        Ping a node that hasn't been heard from for self.ping_rate seconds
 
         INPUTS:
           now -- float -- current time
-        """
-        nxt = deque()
-        while self.pollRing:
-          nid = self.pollRing.popleft()
-          nxt.append(nid)
-          if now-self.heartbeats.get( nid, (0,) )[0]>self.ping_rate:
+
+        THEORY OF OPERATION:
+          Nodes are kept in the pingDue heap, ordered by the time at which
+          they become silent for too long. Heartbeats are collected from
+          all traffic by the bus, so a node whose deadline came up is first
+          checked against its latest heartbeat, and rescheduled if it was
+          heard since. Only silent nodes with no request in flight are
+          pinged, at most one per call, so pings don't crowd out traffic.
+        """
+        heap = self.pingDue
+        while heap and heap[0][0] <= now:
+          _,nid = heappop(heap)
+          if nid not in self.pnas:
+            continue
+          last = self.heartbeats.get( nid, (0,) )[0]
+          if now-last <= self.ping_rate:
+            heappush( heap, (last+self.ping_rate, nid) )
+            continue
+          heappush( heap, (now+self.ping_rate, nid) )
+          if nid not in self.inflight:
             self.request( nid, Dynamixel.CMD_PING )
             break
-        self.pollRing.extend(nxt)
 
     def update( self, t=None, timeout=0.01 ):
         """
@@ -1311,63 +2812,150 @@ class Protocol( AbstractProtocol ):
           t -- time -- ignored; uses now() to get real time
           timeout -- time -- time interval for processing updates
         OUTPUTS:
-          num_requests -- int -- length of request queue
+          num_requests -- int -- number of requests queued or in flight
         PRECONDITIONS:
           instantiation of dynamixel.Bus, dynamixel.Protocol
         POSTCONDITIONS:
           No response occurs
 
         THEORY OF OPERATION:
-          get the allowed timeslice
-          while timeslice not done:
-            if queue empty --> return
-            pop 1st message on queue
-            if message has timed out:
-              fill promise with ProtocolError(timeout)
-              continue
-            if message ID is BROADCAST_ID:
-              if message cmd not CMD_SYNC_WRITE:
-                bus.send the message
-                fill promise with None
-              else:
-                fill promise with ProtocolError(not CMD_SYNC_WRITE bcast not allowed)
-              continue
-            else:
-              bus.send_cmd_sync the message
-              store reply in promise
+          See the Protocol class documentation. The update returns as soon as
+          no requests are pending, or the timeslice is used up, whichever
+          happens first.
         """
         t0 = now()
         self._get_heartbeats(t0)
         t1 = t0
-        while (t1-t0 < timeout) and self.requests:
+        while True:
+            self._expireRequests( t1 )
+            self._issueRequests( t1 )
+            got = self._collectReplies( t1 )
+            # In-flight window drained and nothing left to send --> done
+            if not self.requests and not self.inflight:
+                break
             t1 = now()
-            self._doRequest( t0, self.requests.popleft() )
-        # Parse any remaining messages in buffer, generating
-        #   exceptions as needed
-        while (t1-t0 < timeout):
-            if not self.bus.recv():
-              break
-
+            if t1-t0 >= timeout:
+                break
+            if got:
+                continue
+            # Nothing arrived --> wait for input until the next reply deadline
+            t2 = t0 + timeout
+            for inc in self.inflight.values():
+                t2 = min( t2, inc.sent + self._replyTimeout(inc) )
+            # Requests held for a late reply go out when its window closes
+            if self.requests:
+                for tg in self.ghosts.values():
+                    if tg > t1:
+                        t2 = min( t2, tg )
+            self.bus.ser.waitInput( t2-t1 )
+            # Expire and collect with the time after the wait, not before it
+            t1 = now()
+        # Write out everything the timeslice held in batch mode
+        self.bus.flushTx()
+        return len(self.requests)+len(self.inflight)
 
-    def _doRequest(self, now, inc ):
+    def _replyTimeout( self, inc ):
+        """(private)
+        Time to wait for the reply to in-flight request inc
         """
-        Process a single incomplete request
-        If it requires a response -- complete it or time-out; if not,
-        complete with a None reply
+        return self.bus.replyTimeout( inc.nid, self.reply_timeout, inc.sends-1 )
 
-        TODO: this code branch has never been tested... check async operations
+    def _expireRequests( self, t ):
+        """(private)
+        Retry or fail in-flight requests whose reply did not arrive in time
         """
-        if inc.nid == Dynamixel.BROADCAST_ID:
-            if inc.cmd != Dynamixel.CMD_SYNC_WRITE:
+        for nid,inc in list(self.inflight.items()):
+            if t - inc.sent < self._replyTimeout(inc):
+                continue
+            self.bus.noteLost(nid)
+            del self.inflight[nid]
+            # A late reply could be taken for the reply to the next attempt
+            self.ghosts[nid] = t + self._replyTimeout(inc)
+            if inc.attempts > 0 and not inc.isExpired(t):
+                self.requests.appendleft(inc)
+            else:
+                inc.setError("timed out")
+                self._trace( inc, None, t, TIMEOUT )
+
+    def _issueRequests( self, t ):
+        """(private)
+        Transmit queued requests while the pipeline has room for them.
+        Requests for a node that already has a request in flight wait their turn.
+        A broadcast ACTION waits until all requests before it are done, and
+        requests after it wait for the ACTION.
+        """
+        held = []
+        while self.requests and len(self.inflight) < self.pipeline:
+            inc = self.requests.popleft()
+            if inc.isExpired(t):
+                inc.setError("expired before sending")
+            elif inc.nid == Dynamixel.BROADCAST_ID:
+                if inc.cmd == Dynamixel.CMD_ACTION and (held or self.inflight):
+                    # ACTION is a barrier: it goes out once everything
+                    #   queued before it was answered
+                    held.append(inc)
+                    break
+                if inc.cmd in (Dynamixel.CMD_SYNC_WRITE,Dynamixel.CMD_ACTION):
+                    self.bus.send(*inc.sendArgs())
+                    inc.setResponse(None)
+                else:
+                    inc.setError("broadcast allowed only for CMD_SYNC_WRITE and CMD_ACTION")
+            elif inc.nid in self.inflight or self.ghosts.get(inc.nid,0) > t:
+                held.append(inc)
+            else:
                 self.bus.send(*inc.sendArgs())
-                inc.setResponse(None)
+                inc.sent = now()
+                inc.sends += 1
+                inc.attempts -= 1
+                self.inflight[inc.nid] = inc
+        self.requests.extendleft(reversed(held))
+
+    def _collectReplies( self, t ):
+        """(private)
+        Read all available packets and use them to fulfill in-flight requests
+
+        OUTPUT:
+          number of packets received
+        """
+        got = 0
+        maxlen = max( [10]+[ self.bus.replyMaxlen(inc.cmd,inc.pars)
+                             for inc in self.inflight.values() ] )
+        while True:
+            try:
+                pkt = self.bus.recv( maxlen )
+            except DynamixelServoError as err:
+                # Reply was valid, but reported a servo error --> pass it on
+                pkt = err.pkt
+                reply = err
             else:
-                inc.setError("broadcast allowed only for CMD_SYNC_WRITE")
-        else:
-            reply = self.bus.send_cmd_sync(*inc.sendArgs())
-            if reply is not None and not isinstance(reply,Exception):
-                self.heartbeats[inc.nid] = (now, reply)
-            inc.setResponse(reply)
+                if pkt is None:
+                    return got
+                reply = pkt
+            got += 1
+            nid = pkt[0]
+            self.heartbeats[nid] = (t, reply)
+            # Late reply to an attempt that timed out --> discard it
+            if self.ghosts.pop(nid, None) is not None and nid not in self.inflight:
+                continue
+            inc = self.inflight.get(nid, None)
+            if inc is not None and inc.isReply(pkt):
+                del self.inflight[nid]
+                # Only replies to first attempts give reliable RTTs
+                if inc.sends == 1:
+                    self.bus.noteRTT(nid, now()-inc.sent)
+                inc.setResponse(reply)
+                self._trace( inc, pkt, now(),
+                  ERROR if reply is not pkt else OK )
+
+    def _trace( self, inc, pkt, t, outcome ):
+        """(private)
+        Record a completed request in the bus trace, if there is one
+        """
+        tr = self.bus.trace
+        if tr is None:
+            return
+        tr.record( inc.ts, inc.nid, inc.cmd, inc.sends*(6+len(inc.pars)),
+          0 if pkt is None else len(pkt)+3, t-inc.sent, inc.sends-1, outcome )
 
 class DynamixelModule( AbstractServoModule ):
     """ concrete class DynamixelModule provides shared capabilities of
@@ -1664,6 +3252,24 @@ class DynamixelModule( AbstractServoModule ):
         elif pos > self.MAX_LIM: pos = self.MAX_LIM
         return self.pna.mem_write_fast( self.mcu.goal_position, self.ang2dynamixel(pos))
 
+    def _batch_set_pos(self,pos):
+        """*PRIVATE*
+        Prepare a set_pos for batching with other modules (see
+        Cluster.set_pos_many)
+
+        INPUT:
+          pos -- units in 1/100s of degrees between -10000 and 10000
+        OUTPUT:
+          (addr, pars) -- address and marshalled value to write, or None if
+            the current mode does not allow set_pos to be batched
+        """
+        if self.set_pos != self._set_pos_servo:
+            return None
+        if pos < self.MIN_LIM: pos = self.MIN_LIM
+        elif pos > self.MAX_LIM: pos = self.MAX_LIM
+        addr = self.mcu.goal_position
+        return addr, self.pna.mm.val2pkt( addr, self.ang2dynamixel(pos) )
+
     def set_pos_sync(self,val):
         """
         Sets position of the module, with safety checks.
@@ -0,0 +1,582 @@
+"""
+module ckbot.dynamixelsim
+
+This module provides a software network of Dynamixel servos speaking
+Protocol 1.0, which stands in for a real bus so that dynamixel.Bus and
+dynamixel.Protocol can be exercised, benchmarked and regression tested
+without hardware.
+
+The simulated servos implement:
+  - the control tables of the MX-28, MX-64, MX-106, RX-64, AX-12 and
+    EX-106, with their factory defaults
+  - PING, READ_DATA, WRITE_DATA, REG_WRITE, ACTION, RESET, SYNC_WRITE
+    and (MX series only) BULK_READ, answered with status packets as
+    governed by the status return level register
+  - status packet error bits for bad checksums, bad instructions and out
+    of range values, and any error bits set on the servo by a test
+  - simple dynamics: with torque enabled, the present position moves
+    toward the goal position at the moving speed
+
+The network models the timing of a half duplex bus: every byte takes 10
+bit times at the network baudrate, servos reply after their return delay
+time, and servos whose baud register does not match the network baudrate
+(within 3%, as for a UART) do not hear anything. Servos start with their
+baud register set for the network baudrate. Transmissions may optionally be echoed back, as
+they are by many half duplex adaptors, and replies may be dropped,
+corrupted or preceded by line noise with given probabilities.
+
+The network is reached through a port2port connection spec:
+  {TYPE='dxlsim', servos={1:'MX64',2:'MX28'}, baudrate=1000000,
+   echo=False, realtime=True, ret_delay=None, drop=0, corrupt=0,
+   noise=0, seed=None, pty=False}
+    servos : dict.  Node ID to model name (see MODELS), or list of node
+        IDs of MX64 servos
+    baudrate : int.  Bit rate of the simulated bus
+    echo : bool.  Whether written bytes are looped back to the reader
+    realtime : bool.  If set, replies arrive when they would on a real
+        bus; otherwise they are available immediately
+    ret_delay : int or None.  Return delay register value of all servos,
+        in units of 2 usec; None keeps the factory default
+    drop, corrupt, noise : float.  Probability that a reply is lost, has
+        a byte flipped, or is preceded by a garbage byte
+    seed : random seed for the error injection
+    pty : bool.  If set, the network is served on a pseudo terminal, and
+        the connection is a port2port.SerialConnection to its slave side;
+        otherwise it is an in-process SimConnection
+
+In both cases, the connection's .sim attribute is the SimNetwork, which
+gives tests access to the servos.
+
+Typical use:
+  >>> b = dynamixel.Bus(dict(TYPE='dxlsim',servos={1:'MX64',2:'MX28'}))
+  >>> p = dynamixel.Protocol(bus=b)
+  >>> b.ser.sim.servos[0].error = 0x04 # make servo 1 report overheating
+"""
+
+from time import time as now, sleep
+from struct import pack, unpack_from
+from random import Random
+from threading import Thread
+from collections import deque
+from select import select
+import os
+
+from .port2port import Connection, SerialConnection
+from .dynamixel import (
+  Dynamixel, MX64Mem, MX28Mem, MX106RMem, RX64Mem, EX106Mem
+)
+
+#: Status packet error bits
+ERR_VOLTAGE = 0x01
+ERR_ANGLE = 0x02
+ERR_OVERHEAT = 0x04
+ERR_RANGE = 0x08
+ERR_CHECKSUM = 0x10
+ERR_OVERLOAD = 0x20
+ERR_INSTRUCTION = 0x40
+
+class SimModel( object ):
+  """
+  Description of a servo model: its model number, control table, and
+  factory defaults of the registers
+
+  ATTRIBUTES:
+    name -- str -- model name
+    number -- int -- model number, as stored at address 0
+    mm -- DynamixelMemMap subclass describing the control table
+    size -- int -- length of the control table
+    ticks -- int -- position ticks per revolution
+    maxpos -- int -- maximal position
+    rpm -- float -- rpm per unit of moving speed
+    bulk -- bool -- True if the model supports BULK_READ
+    defaults -- dict -- register name to factory default
+  """
+  def __init__(self, name, number, mm, size, ticks, maxpos, rpm, **defaults):
+    self.name = name
+    self.number = number
+    self.mm = mm
+    self.size = size
+    self.ticks = ticks
+    self.maxpos = maxpos
+    self.rpm = rpm
+    self.bulk = mm.BULK_READ
+    dflt = dict( version=0x24, ID=1, baud=1, ret_delay=250,
+      cw_angle_limit=0, ccw_angle_limit=maxpos, max_temp=80,
+      min_voltage=60, max_voltage=160, max_torque=0x3FF, status=2,
+      alarm_LED=36, alarm_shutdown=36, goal_position=maxpos//2,
+      torque_limit=0x3FF, present_position=maxpos//2,
+      present_voltage=120, present_temperature=35 )
+    dflt.update(defaults)
+    self.defaults = dflt
+
+  def table( self ):
+    """
+    Control table with factory defaults
+    """
+    tbl = bytearray(self.size)
+    tbl[0:2] = pack('<H',self.number)
+    for nm,val in self.defaults.items():
+      addr = getattr(self.mm,nm)
+      dat = pack(self.mm._ADDR_DCR[addr][1],val)
+      a = bytearray(addr)[0]
+      tbl[a:a+len(dat)] = dat
+    return tbl
+
+#: Models that can be simulated, by name
+MODELS = dict( (m.name,m) for m in [
+  SimModel('MX28',0x1d,MX28Mem,0x4A,4096,4095,0.114,P_gain=32),
+  SimModel('MX64',0x136,MX64Mem,0x4A,4096,4095,0.114,P_gain=32,current=2048),
+  SimModel('MX106',0x140,MX106RMem,0x4A,4096,4095,0.114,P_gain=32),
+  SimModel('RX64',0x40,RX64Mem,0x32,1228,1023,0.111,cw_compliance_margin=1,
+    ccw_compliance_margin=1,cw_compliance_slope=32,ccw_compliance_slope=32,punch=32),
+  SimModel('AX12',0x0c,RX64Mem,0x32,1228,1023,0.111,max_temp=70,
+    cw_compliance_margin=1,ccw_compliance_margin=1,cw_compliance_slope=32,
+    ccw_compliance_slope=32,punch=32),
+  SimModel('EX106',0x6b,EX106Mem,Dynamixel.MEM_LEN,5876,4095,0.111,punch=32)
+])
+
+class SimServo( object ):
+  """
+  A simulated Dynamixel servo
+
+  ATTRIBUTES:
+    model -- SimModel -- the servo model
+    mem -- bytearray -- the control table
+    reg -- tuple or None -- (addr,data) of the REG_WRITE awaiting ACTION
+    error -- int -- error bits reported in all status packets
+    rx -- int -- number of instruction packets addressed to this servo
+  """
+  #: Addresses of registers the servo dynamics use
+  A_ID = 3
+  A_BAUD = 4
+  A_RET_DELAY = 5
+  A_STATUS = 0x10
+  A_TORQUE_EN = 0x18
+  A_GOAL = 0x1e
+  A_SPEED = 0x20
+  A_POS = 0x24
+  A_PSPEED = 0x26
+  A_REGISTERED = 0x2c
+  A_MOVING = 0x2e
+  #: Range of read-only sensor addresses
+  SENSORS = (0x24,0x2f)
+
+  def __init__(self, nid, model='MX64'):
+    if not isinstance(model,SimModel):
+      model = MODELS[model]
+    self.model = model
+    self.mem = model.table()
+    self.mem[self.A_ID] = nid
+    self.reg = None
+    self.error = 0
+    self.rx = 0
+    self._t = now()
+    self._pos = None
+
+  @property
+  def nid( self ):
+    return self.mem[self.A_ID]
+
+  def baudrate( self ):
+    """Baudrate set in the baud register"""
+    return 2000000 // (self.mem[self.A_BAUD]+1)
+
+  def retDelay( self ):
+    """Return delay time, in seconds"""
+    return self.mem[self.A_RET_DELAY] * 2e-6
+
+  def step( self, t ):
+    """
+    Advance the servo dynamics to time t
+    """
+    dt = t - self._t
+    self._t = t
+    mem = self.mem
+    if not mem[self.A_TORQUE_EN] or dt <= 0:
+      return
+    goal, = unpack_from('<H',mem,self.A_GOAL)
+    pos, = unpack_from('<H',mem,self.A_POS)
+    spd, = unpack_from('<H',mem,self.A_SPEED)
+    spd = (spd & 0x3FF) or 0x3FF
+    # Track position with sub-tick resolution
+    if self._pos is None or int(self._pos) != pos:
+      self._pos = float(pos)
+    v = spd * self.model.rpm * self.model.ticks / 60.0
+    d = goal - self._pos
+    if abs(d) <= v*dt:
+      self._pos = goal
+      spd = 0
+    else:
+      self._pos += v*dt if d > 0 else -v*dt
+    pos = int(self._pos)
+    mem[self.A_POS:self.A_POS+2] = pack('<H',pos)
+    mem[self.A_PSPEED:self.A_PSPEED+2] = pack('<H',spd)
+    mem[self.A_MOVING] = 1 if pos != goal else 0
+
+  def _write( self, addr, dat ):
+    """(private)
+    Write dat to the control table at addr
+
+    OUTPUT:
+      error bits
+    """
+    if addr+len(dat) > len(self.mem) or not dat:
+      return ERR_INSTRUCTION
+    s0,s1 = self.SENSORS
+    if addr < s1 and addr+len(dat) > s0:
+      return ERR_RANGE
+    if addr <= self.A_GOAL < addr+len(dat):
+      goal, = unpack_from('<H', bytes(self.mem[:addr])+dat+bytes(self.mem[addr+len(dat):]), self.A_GOAL)
+      if goal > self.model.maxpos:
+        return ERR_RANGE
+      self.mem[self.A_TORQUE_EN] = 1
+    self.mem[addr:addr+len(dat)] = dat
+    return 0
+
+  def handle( self, cmd, pars, bcast ):
+    """
+    Execute an instruction addressed to this servo
+
+    INPUT:
+      cmd -- int -- instruction code
+      pars -- bytes -- instruction parameters
+      bcast -- bool -- True if the instruction was broadcast
+    OUTPUT:
+      (err, payload) of the status packet, or None if the servo does
+      not reply
+    """
+    self.rx += 1
+    err = 0
+    dat = b''
+    if cmd == Dynamixel.CMD_PING:
+      pass
+    elif cmd == Dynamixel.CMD_READ_DATA:
+      if len(pars) != 2 or pars[0]+pars[1] > len(self.mem):
+        err = ERR_INSTRUCTION
+      else:
+        dat = bytes(self.mem[pars[0]:pars[0]+pars[1]])
+    elif cmd == Dynamixel.CMD_WRITE_DATA:
+      err = self._write( pars[0], bytes(pars[1:]) ) if pars else ERR_INSTRUCTION
+    elif cmd == Dynamixel.CMD_REG_WRITE:
+      if len(pars) < 2 or pars[0]+len(pars)-1 > len(self.mem):
+        err = ERR_INSTRUCTION
+      else:
+        self.reg = (pars[0],bytes(pars[1:]))
+        self.mem[self.A_REGISTERED] = 1
+    elif cmd == Dynamixel.CMD_ACTION:
+      if self.reg is not None:
+        err = self._write( *self.reg )
+        self.reg = None
+        self.mem[self.A_REGISTERED] = 0
+    elif cmd == Dynamixel.CMD_RESET:
+      self.mem = self.model.table()
+    else:
+      err = ERR_INSTRUCTION
+    # Only pings are answered when broadcast
+    if bcast and cmd != Dynamixel.CMD_PING:
+      return None
+    lvl = self.mem[self.A_STATUS]
+    if cmd != Dynamixel.CMD_PING and (lvl == 0 or (lvl == 1 and cmd != Dynamixel.CMD_READ_DATA)):
+      return None
+    return (err | self.error, dat)
+
+  def status( self, err, dat ):
+    """Status packet with error bits err and payload dat"""
+    body = bytearray([self.nid, len(dat)+2, err]) + dat
+    return Dynamixel.SYNC + bytes(body) + pack('B', 0xFF ^ (sum(body) & 0xFF))
+
+class SimNetwork( object ):
+  """
+  A network of simulated servos on a half duplex bus
+
+  ATTRIBUTES:
+    servos -- list -- the SimServo-s on the bus
+    baudrate -- int -- bit rate of the bus
+    echo -- bool -- loop back written bytes
+    realtime -- bool -- deliver replies at realistic times
+    drop, corrupt, noise -- float -- error injection probabilities
+    rxq -- deque -- (time, bytes) of data to be delivered to the host
+    busFree -- float -- time at which the bus becomes idle
+    stats -- dict -- counters of packets, replies and injected errors
+  """
+  def __init__(self, servos=None, baudrate=1000000, echo=False, realtime=True,
+               ret_delay=None, drop=0, corrupt=0, noise=0, seed=None ):
+    if servos is None:
+      servos = [1,2,3]
+    if not isinstance(servos,dict):
+      servos = dict.fromkeys(servos,'MX64')
+    self.servos = [ SimServo(int(nid),mdl) for nid,mdl in sorted(servos.items()) ]
+    for s in self.servos:
+      s.mem[SimServo.A_BAUD] = max(0,int(round(2e6/baudrate))-1)
+      if ret_delay is not None:
+        s.mem[SimServo.A_RET_DELAY] = ret_delay
+    self.baudrate = baudrate
+    self.echo = echo
+    self.realtime = realtime
+    self.drop = drop
+    self.corrupt = corrupt
+    self.noise = noise
+    self.rnd = Random(seed)
+    self.rxq = deque()
+    self.busFree = 0
+    self._inbuf = bytearray()
+    self.stats = dict(packets=0,replies=0,dropped=0,corrupted=0,noise=0,badchk=0)
+
+  def byteTime( self, n=1 ):
+    """Time taken to transmit n bytes"""
+    return n * 10.0 / self.baudrate
+
+  def servo( self, nid ):
+    """The first servo with ID nid, or None"""
+    for s in self.servos:
+      if s.nid == nid:
+        return s
+    return None
+
+  def _listeners( self, nid ):
+    """(private) servos that hear packets addressed to nid"""
+    return [ s for s in self.servos
+      if (nid == Dynamixel.BROADCAST_ID or s.nid == nid)
+        and abs(s.baudrate()-self.baudrate) <= 0.03*self.baudrate ]
+
+  def _deliver( self, t, dat ):
+    """(private) queue dat for the host, arriving at time t"""
+    if not self.realtime:
+      t = 0
+    self.rxq.append((t,dat))
+
+  def _reply( self, t, srv, res ):
+    """(private)
+    Transmit a status packet from srv after its return delay, starting
+    no earlier than time t; returns the time the bus is free again
+    """
+    t += srv.retDelay()
+    pkt = srv.status( *res )
+    self.stats['replies'] += 1
+    rnd = self.rnd
+    if self.noise and rnd.random() < self.noise:
+      pkt = pack('B',rnd.randrange(256)) + pkt
+      self.stats['noise'] += 1
+    if self.corrupt and rnd.random() < self.corrupt:
+      pkt = bytearray(pkt)
+      pkt[rnd.randrange(len(pkt))] ^= 1 << rnd.randrange(8)
+      pkt = bytes(pkt)
+      self.stats['corrupted'] += 1
+    t += self.byteTime(len(pkt))
+    if self.drop and rnd.random() < self.drop:
+      self.stats['dropped'] += 1
+    else:
+      self._deliver(t,pkt)
+    return t
+
+  def write( self, msg, t=None ):
+    """
+    Transmit bytes from the host onto the bus at time t (default: now)
+    """
+    if t is None:
+      t = now()
+    t = max(t,self.busFree)
+    buf = self._inbuf
+    buf.extend(msg)
+    k = 0
+    while True:
+      k = buf.find(Dynamixel.SYNC,k)
+      # No SYNC --> keep a trailing 0xFF that may start one
+      if k < 0:
+        k = max(0,len(buf)-1)
+        break
+      L = buf[k+3]+4 if len(buf)-k >= 4 else None
+      if L is None or len(buf)-k < L:
+        break
+      pkt = bytes(buf[k:k+L])
+      t += self.byteTime(L)
+      if self.echo:
+        self._deliver(t,pkt)
+      t = self._packet(t,pkt)
+      k += L
+    del buf[:k]
+    self.busFree = t
+    return len(msg)
+
+  def _packet( self, t, pkt ):
+    """(private)
+    Process an instruction packet that completed at time t
+
+    OUTPUT:
+      time at which the bus is free again
+    """
+    self.stats['packets'] += 1
+    nid, L, cmd = pkt[2], pkt[3], pkt[4]
+    pars = pkt[5:L+3]
+    bcast = nid == Dynamixel.BROADCAST_ID
+    for s in self.servos:
+      s.step(t)
+    if 0xFF & (sum(pkt[2:]) - pkt[-1]) != 0xFF ^ pkt[-1]:
+      self.stats['badchk'] += 1
+      for s in self._listeners(nid):
+        if not bcast:
+          t = self._reply(t,s,(ERR_CHECKSUM|s.error,b''))
+      return t
+    if cmd == Dynamixel.CMD_SYNC_WRITE and bcast and len(pars) >= 2:
+      addr,n = pars[0],pars[1]
+      for k in range(2,len(pars)-n,n+1):
+        for s in self._listeners(pars[k]):
+          s.handle( Dynamixel.CMD_WRITE_DATA, pack('B',addr)+pars[k+1:k+1+n], True )
+      return t
+    if cmd == Dynamixel.CMD_BULK_READ and bcast:
+      # Each servo replies after the previous one; a missing servo
+      #   stalls all those after it
+      for k in range(1,len(pars)-2,3):
+        n,bid,addr = pars[k:k+3]
+        ss = [ s for s in self._listeners(bid) if s.model.bulk ]
+        if not ss:
+          break
+        for s in ss:
+          res = s.handle( Dynamixel.CMD_READ_DATA, pack('BB',addr,n), False )
+          if res is not None:
+            t = self._reply(t,s,res)
+      return t
+    for s in self._listeners(nid):
+      res = s.handle( cmd, pars, bcast )
+      if res is not None:
+        t = self._reply(t,s,res)
+    return t
+
+  def ready( self, t=None ):
+    """
+    Number of bytes that arrived at the host by time t (default: now)
+    """
+    if t is None:
+      t = now()
+    return sum( len(d) for ts,d in self.rxq if ts <= t )
+
+  def nextArrival( self ):
+    """Time at which the next data arrives, or None"""
+    return self.rxq[0][0] if self.rxq else None
+
+  def read( self, length, t=None ):
+    """
+    Read at most length bytes that arrived by time t (default: now)
+    """
+    if t is None:
+      t = now()
+    res = bytearray()
+    q = self.rxq
+    while q and q[0][0] <= t and len(res) < length:
+      ts,d = q.popleft()
+      n = length-len(res)
+      res.extend(d[:n])
+      if len(d) > n:
+        q.appendleft((ts,d[n:]))
+    return bytes(res)
+
+  def flush( self ):
+    """Discard all data not yet read"""
+    self.rxq.clear()
+
+class SimConnection( Connection ):
+  """
+  In-process port2port connection to a SimNetwork
+  """
+  def __init__(self, sim=None, **kw):
+    """
+    INPUT:
+      sim -- SimNetwork -- network to connect to; if None, one is
+        created with keyword arguments kw
+    """
+    if sim is None:
+      sim = SimNetwork(**kw)
+    self.sim = sim
+
+  @property
+  def baudrate( self ):
+    return self.sim.baudrate
+
+  def isOpen( self ):
+    return True
+
+  def flush( self ):
+    self.sim.flush()
+
+  def inWaiting( self ):
+    return self.sim.ready()
+
+  def waitInput( self, timeout ):
+    """Sleep until the next reply arrives, for at most timeout seconds"""
+    t0 = now()
+    ts = self.sim.nextArrival()
+    if ts is None:
+      if timeout > 0:
+        sleep(min(timeout,0.0005))
+      return False
+    if ts > t0:
+      sleep(min(timeout,ts-t0))
+    return ts <= now()
+
+  def write( self, msg ):
+    return self.sim.write(msg)
+
+  def read( self, length ):
+    return self.sim.read(length)
+
+  def reconnect( self, **changes ):
+    """Apply changes of baudrate and drop any buffered data"""
+    if 'baudrate' in changes:
+      self.sim.baudrate = changes['baudrate']
+    self.sim.flush()
+
+class SimPty( Thread ):
+  """
+  Serve a SimNetwork on a pseudo terminal, so that it can be opened as
+  a serial port, by this or any other process.
+
+  ATTRIBUTES:
+    sim -- SimNetwork -- the network served
+    path -- str -- path of the pty slave device
+  """
+  def __init__(self, sim):
+    Thread.__init__(self, name="SimPty")
+    self.daemon = True
+    self.sim = sim
+    self.master, self.slave = os.openpty()
+    self.path = os.ttyname(self.slave)
+    self._running = True
+
+  def run( self ):
+    sim = self.sim
+    while self._running:
+      ts = sim.nextArrival()
+      dt = 0.01 if ts is None else max(0,ts-now())
+      rd,_,_ = select([self.master],[],[],dt)
+      if rd:
+        try:
+          sim.write( os.read(self.master,4096) )
+        except OSError:
+          break
+      n = sim.ready()
+      if n:
+        os.write( self.master, sim.read(n) )
+
+  def stop( self ):
+    self._running = False
+
+def newSimConnection( pty=False, **kw ):
+  """
+  Factory for connections to a new SimNetwork, used by
+  port2port.newConnection for TYPE='dxlsim'; keyword arguments are
+  those of the SimNetwork constructor.
+
+  OUTPUT:
+    SimConnection, or if pty is set, SerialConnection to a SimPty
+  """
+  if 'servos' in kw and isinstance(kw['servos'],dict):
+    kw['servos'] = dict( (int(nid),mdl) for nid,mdl in kw['servos'].items() )
+  sim = SimNetwork(**kw)
+  if not pty:
+    return SimConnection(sim)
+  srv = SimPty(sim)
+  srv.start()
+  res = SerialConnection(srv.path, baudrate=sim.baudrate, timeout=0.01)
+  res.sim = sim
+  res.simPty = srv
+  return res
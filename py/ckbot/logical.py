@@ -17,13 +17,16 @@
 from re import compile as re_compile
 from time import sleep, time as now
 from traceback import extract_stack
+from contextlib import nullcontext
+from threading import Thread
 
 from .ckmodule import ( 
-    AbstractProtocol, progress, MissingModule, Module, DebugModule, PermissionError
+    AbstractProtocol, HeartbeatTable, progress, MissingModule, Module, DebugModule, PermissionError
 )
 from . import polowixel
 from . import pololu
 from . import dynamixel
+from .busthread import BusThread
 from .defaults import DEFAULT_ARCH, DEFAULT_PORT
 
 def nids2str( nids ):
@@ -146,6 +149,8 @@ class Cluster(dict):
       p -- instance of Protocol for communication with modules
       at -- instance of the Attributes class.
       limit -- float -- heartbeat time limit before considering node dead
+      busThread -- BusThread or None -- thread running the protocol, if
+        started with .startBusThread()
       _updQ -- list -- collection of objects that need update() calls
     """
     dict.__init__(self)
@@ -163,6 +168,7 @@ class Cluster(dict):
     self._updQ = [self.p]
     self.at = ModulesByName()
     self.limit = 2.0
+    self.busThread = None
     if args or kwargs:
       return self.populate(*args,**kwargs)
 
@@ -221,7 +227,9 @@ class Cluster(dict):
     If this hasn't happened after a duration of timeout seconds (+/- a timestep),
     discover raises a DiscoveryError.
     In the special case of count==0 and required=set(), discover collects
-    all node ID-s found until timeout, and does not return an error.
+    all node ID-s found until timeout, and does not return an error. If the
+    protocol can scan() the bus, discover returns as soon as the scan
+    stops receiving replies instead.
     INPUT:
       count -- number of modules -- if 0 then collects until timeout
       timeout -- time to listen in seconds
@@ -234,8 +242,13 @@ class Cluster(dict):
     required = set(required)
     # If any number of nodes is acceptable --> wait and collect them
     if not count and not required:
-      progress("Discover: waiting for %g seconds..." % timeout)
-      sleep(timeout)
+      if hasattr(self.p,'scan'):
+        progress("Discover: scanning for up to %g seconds..." % timeout)
+        self.p.scan( timeout=timeout, get_model=False )
+      else:
+        progress("Discover: waiting for %g seconds..." % timeout)
+        sleep(timeout)
+      self.update()
       nids = self.getLive(timeout)
       progress("Discover: done. Found %s" % nids2str(nids))
       return nids
@@ -244,9 +257,11 @@ class Cluster(dict):
       self.p.hintNodes( required )
     # else --> collect nodes with count limit, timeout, required
     time_end = now()+timeout
+    self.update()
     nids = self.getLive(timeout)
     while (len(nids) < count) or not (nids >= required):
       sleep(timestep)
+      self.update()
       nids = self.getLive(timeout)
       progress("Discover: found %s" % nids2str(nids))
       if time_end < now():
@@ -257,15 +272,179 @@ class Cluster(dict):
     return nids
 
   def update(self,t=None):
-    """Allow stateful members to update; propagates to sub-objects"""
+    """Allow stateful members to update; propagates to sub-objects
+
+    While a bus thread is running, the updates happen on that thread,
+    and this method does nothing.
+    """
+    if self.busThread is not None:
+      return
     if t is None:
         t = now()
     for m in self._updQ:
       m.update(t)
 
+  def motion_frame( self, **kw ):
+    """
+    Context manager making the module writes issued inside it take effect
+    together, e.g.
+      >>> with c.motion_frame():
+      ...   c.at.Nx01.set_pos(1000)
+      ...   c.at.Nx02.set_pos(-1000)
+    Writes are committed when the context exits; see the motion_frame()
+    method of the protocol (e.g. dynamixel.Protocol.motion_frame) for
+    details. Protocols without motion frames make the writes immediately.
+    While a bus thread is running, the frame is entered and exited on
+    the bus thread, in order with the setter commands posted inside it.
+
+    INPUT:
+      **kw -- passed to the protocol's motion_frame()
+    """
+    if not hasattr(self.p,'motion_frame'):
+      return nullcontext()
+    fr = self.p.motion_frame(**kw)
+    if self.busThread is not None:
+      return self.busThread.postContext(fr)
+    return fr
+
+  def startBusThread( self, **kw ):
+    """
+    Start running the protocol on a dedicated thread (see ckbot.busthread)
+
+    While the thread runs, .setterOf() setters post coalesced commands to
+    the thread, .getterOf() getters return the latest values polled by
+    the thread, and .update() leaves all updates to the thread.
+
+    INPUT:
+      **kw -- passed to the BusThread constructor
+    OUTPUT:
+      the BusThread instance, also stored in .busThread
+    """
+    if self.busThread is not None:
+      raise RuntimeError("Bus thread is already running")
+    self.busThread = BusThread(self,**kw)
+    self.busThread.start()
+    return self.busThread
+
+  def stopBusThread( self ):
+    """
+    Stop the bus thread started by .startBusThread(), returning to
+    updates from .update()
+    """
+    if self.busThread is None:
+      return
+    bt = self.busThread
+    self.busThread = None
+    bt.stop()
+
+  def set_pos_many( self, positions ):
+    """
+    Set the positions of many modules in a single operation
+
+    Modules that support batching (they provide _batch_set_pos) are
+    grouped by protocol and address, and each group is written with one
+    call to the protocol's mem_write_many(). On a Dynamixel bus this
+    sends a single SYNC_WRITE packet instead of an acknowledged write per
+    servo. All other modules get a regular set_pos() call.
+
+    INPUT:
+      positions -- dict -- node ID to position (centidegrees)
+    """
+    batch = {}
+    for nid,pos in positions.items():
+      mod = self[nid]
+      item = None
+      if hasattr(mod,'_batch_set_pos'):
+        item = mod._batch_set_pos(pos)
+      if item is None:
+        mod.set_pos(pos)
+        continue
+      addr,pars = item
+      batch.setdefault((mod.pna.p,addr),[]).append((mod.pna.nid,pars))
+    for (p,addr),items in batch.items():
+      p.mem_write_many(addr,items)
+
+  def read_many( self, register, nids=None ):
+    """
+    Read the same register from many modules in a single operation
+
+    Modules are grouped by protocol, and each group whose protocol
+    provides mem_read_many() is read with one call to it. On a Dynamixel
+    bus of MX servos this is a single BULK_READ transaction instead of a
+    read request per servo. All other modules get a regular mem_read().
+
+    INPUT:
+      register -- str or address -- register name (e.g. 'present_position')
+        or address in the modules' memory map
+      nids -- sequence -- node IDs to read; defaults to all modules
+    OUTPUT:
+      numpy array of register values, in the order of nids; reads that
+      failed give NaN
+    """
+    from numpy import array, nan
+    if nids is None:
+      nids = list(self.keys())
+    val = {}
+    batch = {}
+    for nid in nids:
+      mod = self[nid]
+      pna = mod.pna
+      addr = getattr(pna.mm,register) if isinstance(register,str) else register
+      if hasattr(pna.p,'mem_read_many'):
+        batch.setdefault((pna.p,addr),[]).append(nid)
+        continue
+      try:
+        val[nid] = mod.mem_read(addr)
+      except Exception:
+        val[nid] = nan
+    for (p,addr),grp in batch.items():
+      for nid,pkt in p.mem_read_many(addr,self[grp[0]].pna.mm.val2len(addr),grp).items():
+        try:
+          val[nid] = self[nid].pna.mm.pkt2val(addr,pkt)
+        except Exception:
+          val[nid] = nan
+    return array([ val[nid] for nid in nids ], dtype=float)
+
   def off( self ):
     """Make all servo or motor modules go slack"""
+    if self.busThread is not None:
+      return self.busThread.call(self._off)
+    return self._off()
+
+  def _off( self ):
+    """(private)
+    Turn off all modules, one bus at a time in parallel
+
+    Modules are grouped by the protocol (i.e. bus) their node adaptor
+    uses. Protocols with an off() method (e.g. dynamixel, which
+    broadcasts a single torque off packet) turn off their whole bus at
+    once; modules of other protocols, or of a protocol whose off()
+    failed, are made slack one by one. Each group runs in a thread of
+    its own, except the first, which runs in the calling thread.
+    """
+    grp = {}
     for m in self.itermodules():
+      p = getattr(getattr(m,'pna',None),'p',None)
+      grp.setdefault(p,[]).append(m)
+    grp = list(grp.items())
+    ths = [ Thread(target=self._offBus, args=g, name="off") for g in grp[1:] ]
+    for th in ths:
+      th.start()
+    if grp:
+      self._offBus(*grp[0])
+    for th in ths:
+      th.join()
+
+  def _offBus( self, p, mods ):
+    """(private) turn off the modules mods of protocol p (see _off)"""
+    if callable(getattr(p,'off',None)):
+      try:
+        p.off()
+        return
+      except Exception as exc:
+        progress("Cluster.off: %s.off() failed (%s); using go_slack" % (
+          p.__class__.__module__, exc))
+    for m in mods:
       if hasattr(m,'go_slack') and callable(getattr(m,'go_slack')):
         m.go_slack()
 
@@ -277,6 +456,7 @@ class Cluster(dict):
     t0 = now()
     while now()-t0<t:
       lst = []
+      self.update()
       for nid in self.getLive():
         if nid in self:
           lst.append( '%02X:%s' % (nid,self[nid].name) )
@@ -336,18 +516,28 @@ class Cluster(dict):
   def getLive( self, limit=None ):
     """
     Use heartbeats to get set of live node ID-s
+
+    If the protocol keeps its heartbeats in a HeartbeatTable, the set is
+    maintained incrementally, and heartbeats are only those the protocol
+    collected in its own update()-s. Otherwise, the protocol is updated
+    and the set is recomputed from all heartbeats.
     INPUT:
       limit -- float -- heartbeats older than limit seconds in
          the past are ignored
     OUTPUT:
-      python set of node ID numbers
+      python set (or frozenset) of node ID numbers
     """
     if limit is None:
       limit = self.limit
     t0 = now()
-    self.p.update(t0)
+    hb = self.p.heartbeats
+    if isinstance(hb,HeartbeatTable):
+      return hb.live(limit,t0)
+    # The bus thread (if any) keeps the heartbeats up to date
+    if self.busThread is None:
+      self.p.update(t0)
     s = set( ( nid
-      for nid,(ts,_) in self.p.heartbeats.items()
+      for nid,(ts,_) in list(hb.items())
       if ts + limit > t0 ) )
     return s
 
@@ -397,9 +587,16 @@ class Cluster(dict):
     Obtain a getter function for a cluster property
 
     If property is not readable, returns a DelayedPermissionError
+
+    While a bus thread is running, the property is polled by the thread
+    (see BusThread.watch) and the getter returns its latest value, or
+    None until the thread first polled it.
     """
     if self._getAttrOfClp(clp,'isReadable')():
-      return self._getAttrOfClp(clp,'get_sync')
+      get = self._getAttrOfClp(clp,'get_sync')
+      if self.busThread is not None:
+        return self.busThread.watch( clp, get )
+      return get
     return DelayedPermissionError("Property '%s' is not readable" % clp)
 
   def setterOf( self, clp ):
@@ -407,9 +604,19 @@ class Cluster(dict):
     Obtain a setter function for a cluster property
 
     If property is not writeable, returns a DelayedPermissionError
+
+    While a bus thread is running, the setter posts a command to the
+    thread, coalesced with any not yet executed command for the same
+    property.
     """
     if self._getAttrOfClp(clp,'isWritable')():
-      return self._getAttrOfClp(clp,'set')
+      sf = self._getAttrOfClp(clp,'set')
+      if self.busThread is not None:
+        bt = self.busThread
+        def postSet( val ):
+          bt.post( clp, sf, val )
+        return postSet
+      return sf
     return DelayedPermissionError("Property '%s' is not writable" % clp)
 
 Module.Types.update(
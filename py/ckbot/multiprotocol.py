@@ -2,8 +2,16 @@
 FILE: multiprotocol.py defines the MultiProtocol class, a class that maps
 multiple Protocol instances under a single umbrella, allowing multiple robot
 communication busses and protocols to be used from a single user application
+
+Each sub-protocol talks to its own bus, so MultiProtocol runs the bus I/O
+of its sub-protocols (update, scan, reset, off) concurrently, one worker
+thread per sub-protocol. The calling thread waits for all of them, so the
+time an update takes is that of the slowest bus, rather than the sum over
+all busses. Per-bus timing statistics are kept in .stats (see .statsMsg())
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from time import time as now
 from .ckmodule import AbstractProtocol, AbstractBus
 from warnings import warn
 warn("""
@@ -73,15 +81,27 @@ class NidMapper( object ):
 class MultiProtocol( AbstractProtocol ):
     DEFAULT_PORT = None # required by arch API
 
-    def __init__(self,*subs):
+    def __init__(self,*subs,**kw):
         """
         Create a protocol which multiplexes multiple sub-protocols
 
         For convenience, these sub-protocols can be listed sequentially
         in the constructor
+
+        INPUT:
+            *subs -- sub-protocols
+            parallel -- bool -- (keyword only, default True) if true,
+              operations on the sub-protocols run concurrently, each in a
+              worker thread of its own; otherwise they run one after the
+              other in the calling thread
         """
         AbstractProtocol.__init__(self)
         self.nim = NidMapper()
+        self.parallel = kw.pop('parallel',True)
+        if kw:
+            raise TypeError("Unexpected keyword arguments %s" % repr(list(kw)))
+        self.pool = None
+        self.stats = {}
         if subs:
             if isinstance(subs[0], AbstractBus):
                 raise ValueError("MultiProtocol() cannot accept a Bus parameter")
@@ -93,43 +113,110 @@ class MultiProtocol( AbstractProtocol ):
         """
         for sub in subs:
             self.nim.addOwner( sub )
+            self.stats[self.nim.itbl[hash(sub)]] = dict(
+                updates=0, total=0.0, last=0.0, max=0.0 )
+        # Worker pool is re-created, with a thread per sub-protocol, on demand
+        self.close()
+
+    def close( self ):
+        """Stop the worker threads; they are restarted when next needed"""
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    def _each( self, func ):
+        """
+        (private) Call func(oid,sub) for every sub-protocol, concurrently
+        if .parallel is set, and wait for all calls to complete.
+
+        OUTPUT:
+            list of (sub,result) pairs, in owner ID order
+
+        Exceptions raised by func are re-raised in the calling thread,
+        after all calls completed.
+        """
+        subs = sorted(self.nim.tbl.items())
+        if not self.parallel or len(subs)<2:
+            return [ (p,func(oid,p)) for oid,p in subs ]
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(
+                max_workers=len(subs), thread_name_prefix="MultiProtocol")
+        fs = [ (p,self.pool.submit(func,oid,p)) for oid,p in subs ]
+        # Wait for all before raising anything, so no bus is still busy
+        for _,f in fs:
+            f.exception()
+        return [ (p,f.result()) for p,f in fs ]
 
     def off( self ):
         """Broadcast the p.off() call to any supporting subs"""
-        for o in self.nim.iterowners():
+        def _off(oid,o):
             if hasattr(o,'off') and callable(o.off):
                 o.off()
+        self._each(_off)
 
     def reset( self, *argv, **kwarg ):
         """Broadcast the p.reset() call to any supporting subs"""
-        for o in self.nim.iterowners():
+        def _reset(oid,o):
             if hasattr(o,'reset') and callable(o.reset):
                 o.reset(*argv, **kwarg)
+        self._each(_reset)
 
     def scan( self, *argv, **kwarg ):
         """
         Broadcast the p.scan() call to any supporting subs, then
         collect results and map to external NIDs
         """
-        res = []
-        for p in self.nim.iterowners():
+        def _scan(oid,p):
             if not hasattr(p,'scan') or not callable(p.scan):
-                continue
-            s = p.scan(*argv, **kwarg)
+                return ()
+            return p.scan(*argv, **kwarg)
+        res = []
+        for p,s in self._each(_scan):
             res.extend([ self.nim.mapI2X(p,inid) for inid in s])
         return res
 
+    def _update( self, oid, p, t ):
+        """(private) update a sub-protocol, keeping timing statistics"""
+        t0 = now()
+        p.update(t)
+        dt = now()-t0
+        st = self.stats[oid]
+        st['updates'] += 1
+        st['total'] += dt
+        st['last'] = dt
+        if dt > st['max']:
+            st['max'] = dt
+
     def update( self, t=None ):
         """Update all sub-protocols and collect heartbeats"""
         hb = {}
-        # Loop over all protocols contained in this one
-        for p in self.nim.iterowners():
-            p.update(t)
+        # Update all protocols contained in this one
+        for p,_ in self._each(lambda oid,p : self._update(oid,p,t)):
             # Collect heartbeats from the protocols
             for inid,val in p.heartbeats.items():
                 xnid = self.nim.mapI2X(p,inid)
                 hb[xnid] = val
-        self.heartbeats = hb
+        # Nodes no sub-protocol lists any more leave the table
+        hbt = self.heartbeats
+        for xnid in set(hbt).difference(hb):
+            del hbt[xnid]
+        hbt.update(hb)
+
+    def statsMsg( self ):
+        """
+        returns per-bus update timing statistics
+
+        OUTPUTS:
+          -- list -- one string per sub-protocol, with the number of
+             updates and the mean, last and maximal update time
+        """
+        res = []
+        for oid,st in sorted(self.stats.items()):
+            n = st['updates']
+            res.append( 'bus 0x%02x %s: %d updates, mean %.2f last %.2f max %.2f ms'
+                % (oid, self.nim.tbl[oid].__class__.__module__, n,
+                   1e3*st['total']/max(n,1), 1e3*st['last'], 1e3*st['max'] ) )
+        return res
 
     def hintNodes( self, nodes ):
         """Hint the existence of specified NIDs"""
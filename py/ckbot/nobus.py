@@ -1,5 +1,5 @@
 from time import time as now
-from .ckmodule import AbstractProtocol, AbstractBus, AbstractNodeAdaptor, MissingModule
+from .ckmodule import AbstractProtocol, AbstractBus, AbstractNodeAdaptor, MissingModule, HeartbeatTable
 
 # If you want to use non-default MissingModule replacements, first
 #   map their NIDs to their module classes, e.g.
@@ -34,7 +34,7 @@ class Protocol( AbstractProtocol ):
     h = {}
     for nd in nodes:
       h[nd] = self._ts
-    self.heartbeats = h
+    self.heartbeats = HeartbeatTable(h)
 
   def generatePNA( self, nid ):
     return NodeAdaptor( nid )
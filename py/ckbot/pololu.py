@@ -25,8 +25,13 @@ Both examples sets the position of the 0x23 robot module, connected to Pololu Ma
 
 from os import getenv
 from struct import pack, unpack
+from collections import deque
+from time import time as now
 
-from .ckmodule import AbstractNodeAdaptor, AbstractProtocol, AbstractBus, AbstractServoModule
+from .ckmodule import (
+  AbstractNodeAdaptor, AbstractProtocol, AbstractBus, AbstractServoModule,
+  HeartbeatTable, AbstractProtocolError, progress
+)
 from .port2port import newConnection
 
 DEFAULT_PORT = dict(
@@ -39,11 +44,69 @@ DEFAULT_PORT = dict(
 # DEBUG flags
 DEBUG = (getenv("PYCKBOTDEBUG",'')).split(",")
 
+# Maestro compact protocol commands (see section 5.e of the user manual)
+CMD_SET_TARGET = 0x84 # channel, target low 7 bits, target high 7 bits
+CMD_SET_MULTIPLE_TARGETS = 0x9F # count, first channel, targets as above
+CMD_GET_POSITION = 0x90 # channel; replies with 2 bytes, little endian
+CMD_GET_ERRORS = 0xA1 # replies with the 2 bytes of error bits, little endian
+
+# Maestro default 8-bit (MiniSSC-II) mapping: position 127 is NEUTRAL_US,
+#   and positions 0 and 254 are SSC_RANGE_US away from it. Batched targets
+#   are sent in quarter microseconds, converted with the mapping of their
+#   channel, which is this one unless given to the Protocol (see ranges)
+NEUTRAL_US = 1500.0
+SSC_RANGE_US = 476.25
+SSC_DEFAULT_RANGE = (NEUTRAL_US-SSC_RANGE_US, NEUTRAL_US+SSC_RANGE_US)
+
 CR = 0x40 # Bits indicating a CR node type
 UB = 0x80 # Bits indicating a UB node type
 NID_MASK = 0x3F # Mask for valid IDs
 assert (NID_MASK & (CR|UB)) == 0
 
+def _crc7_table():
+  """
+  Table of the CRC7 (polynomial 0x91, least significant bit first, as
+  used by the Maestro) of every byte value
+  """
+  tbl = []
+  for crc in range(256):
+    for _ in range(8):
+      if crc & 1:
+        crc ^= 0x91
+      crc >>= 1
+    tbl.append(crc)
+  return bytes(tbl)
+
+CRC7_TABLE = _crc7_table()
+
+def crc7_update(crc, dat):
+  """
+  Continue computing a CRC7 over more bytes
+
+  INPUT:
+  crc -- int -- CRC7 of the bytes before dat; 0 to start
+  dat -- bytes or iterable of ints -- more bytes
+  OUTPUT:
+  CRC7 of all the bytes so far
+  """
+  tbl = CRC7_TABLE
+  for b in dat:
+    crc = tbl[crc ^ b]
+  return crc
+
+def crc7(dat):
+  """
+  CRC7 of a complete Maestro command (e.g. 0x83,0x01 --> 0x17)
+  """
+  return crc7_update(0, dat)
+
+class ProtocolError( AbstractProtocolError ):
+  """
+  Error reported through a promise, e.g. a position read that timed out
+  """
+  def __init__(self,*arg,**kw):
+    AbstractProtocolError.__init__(self,*arg,**kw)
+
 class Bus(AbstractBus):
   """
   Concrete class that provides the functionality
@@ -55,64 +118,125 @@ class Bus(AbstractBus):
   Maestro User Manual located at http://www.pololu.com/docs/0J40/all
   """
 
-  def __init__(self, port = DEFAULT_PORT, crc_enabled=False, *args,**kw):
+  def __init__(self, port = DEFAULT_PORT, crc_enabled=False, batch=False, *args,**kw):
     """
     Initialize a Pololu Bus class
 
     INPUT:
     port -- port / connection specification (see port2port.Connection)
+    crc_enabled -- bool -- append a CRC7 byte to every command
+    batch -- bool -- hold commands and write them together (see write())
 
     ATTRIBUTES:
     ser -- connection handle
+    txq -- bytearray -- commands held for writing in batch mode
+    txWrites -- int -- number of writes to the connection
     """
     AbstractBus.__init__(self,*args,**kw)
     self.ser = newConnection( port )
     self.port = port
     self.crc_enabled = crc_enabled
+    self.batch = batch
+    self.txq = bytearray()
+    self.txWrites = 0
     self.DEBUG = DEBUG
 
-  def get_errors(self):
+  def get_errors(self, timeout=0.1):
     """
     Retrieve error messages from the Pololu Maestro device using the protocol outlined by the Pololu Maestro documentation
 
-    WARNING: This method will hang if there is a faulty serial connection
-    """
-    if self.ser is not None:
-      self.write((0xA1,0))
+    Waits at most timeout seconds for the reply. Any other input waiting
+    is discarded first. For use while a Protocol is running, see
+    Protocol.request_errors, which does not wait at all.
 
-      while not self.ser.inWaiting():
-        continue
-
-      high = self.ser.read()
-      while self.ser.inWaiting():
-        low = high
-        high = self.ser.read()
-
-      return low | (high << 8)
+    INPUT:
+    timeout -- float -- seconds to wait for the reply
+    OUTPUT:
+    error bits, or None if the reply did not arrive in time
+    """
+    if self.ser is None:
+      return None
+    n = self.ser.inWaiting()
+    if n:
+      self.ser.read(n)
+    self.write((CMD_GET_ERRORS,),flush=True)
+    dat = b''
+    t1 = now()+timeout
+    while len(dat)<2:
+      dt = t1-now()
+      if dt <= 0:
+        return None
+      if self.ser.inWaiting() or self.ser.waitInput(dt):
+        dat += self.ser.read(2-len(dat))
+    return unpack('<H',dat)[0]
 
   def open( self ):
     if not self.ser.isOpen():
       raise IOError("Serial port is not open")
 
-  def write(self, val):
+  def write(self, val, flush=False):
     """
     Write data to the pololu controller over serial
 
+    In batch mode, commands are held in .txq, and written together by
+    flushTx(), which Protocol.update calls at the end of every timeslice.
+
     INPUT:
     val -- tuple -- tuple of ints to write to serial
+    flush -- bool -- write out immediately, along with any held commands;
+      needed for commands whose reply is read next
     """
 
-    if self.ser is None:
-      raise IOError("Serial port is not open")
+    self._send(self._format(val), flush)
+
+  def write_many(self, vals, flush=False):
+    """
+    Write several commands to the pololu controller in a single write
+    (or, in batch mode, hold them together in .txq)
 
+    INPUT:
+    vals -- sequence of tuples of ints -- commands, each formatted as by
+      write(); in CRC mode, each command gets its own CRC7 byte
+    flush -- bool -- as in write()
+    """
+    self._send(b''.join( self._format(val) for val in vals ), flush)
+
+  def _format(self, val):
+    """(private) format a command as bytes, with its CRC7 byte in CRC mode"""
     # Format the values into serial-writable string
     cmd_str = pack("B"*len(val), *val)
 
     if self.crc_enabled:
       cmd_str = self.crc7(cmd_str) # Calculate and append Cyclic Redundancy Check byte
+    return cmd_str
+
+  def _send(self, cmd_str, flush):
+    """(private) write formatted commands, or hold them in batch mode"""
+    if self.ser is None:
+      raise IOError("Serial port is not open")
     if 'w' in self.DEBUG:
       print("Ser WR>",repr(cmd_str))
+    if self.batch:
+      self.txq.extend(cmd_str)
+      if flush:
+        self.flushTx()
+      return
     self.ser.write(cmd_str)
+    self.txWrites += 1
+
+  def flushTx(self):
+    """
+    Write out all commands held in batch mode
+
+    OUTPUT:
+    number of bytes written
+    """
+    n = len(self.txq)
+    if n and self.ser is not None:
+      self.ser.write(bytes(self.txq))
+      self.txWrites += 1
+      del self.txq[:]
+    return n
 
   def close(self):
     """
@@ -120,64 +244,20 @@ class Bus(AbstractBus):
     a connection has been made
     """
     if self.ser is not None:
+      self.flushTx()
       self.ser.close()
       self.ser = None
 
   def crc7(self,comstr):
     """
     This function calculates and appends the Cyclic Redundancy Check (CRC7) byte for error checking
-    """
-    l = len(comstr)
-
-    int_tuple = unpack('B'*len(comstr), comstr)
-    divd = self.__bitrev(int_tuple)
-
-    if(l>4):
-      print(" This CRC function currently does not support strings > 4 chars")
-      return 0
-
-    divd = self.__bitrev(ord(comstr[0]))
 
-        # put the chars in an integer
-    for i in range(1,l):
-      new = self.__bitrev(ord(comstr[i]))
-      divd <<= 8
-      divd = divd | new
-
-        #crc = 0b10001001<<(8*(l-1))
-      #hex instead
-      crc = int('10001001',2)<<(8*(l-1)) #J binary literals don't work in python 2.5
-      lsbcheck = 0x80 << (8*(l-1))
-
-      for i in range(0,8*l):
-        if(divd & lsbcheck == lsbcheck):
-          divd = divd ^ crc
-          divd = divd << 1
-        else:
-          divd = divd<<1
-
-      divd = divd>>(8*(l-1))
-      divd = self.__bitrev(divd)
-      s = chr(divd & 0xff)
-
-      return comstr + s
-
-  def __bitrev(self,bytes):
-    """
-    Creates a lookup table of reversed bit orders
-
-    Input:
-       bytes -- tuple -- tuple of 1 byte values to be reversed
-    Output:
-       bitrev_table -- dict
+    INPUT:
+    comstr -- bytes -- command of any length
+    OUTPUT:
+    comstr followed by its CRC7 byte
     """
-    bytes = sum(bytes)         # Sums the bytes
-    bin_repr = bin(bytes)[2:]  # Convert to binary string, remove "0b" at the beginning of the string
-    bin_repr = bin_repr[::-1]  # Reverse all digits
-    bin_repr = "0b%s" % bin_repr
-
-    return int(bin_repr,2)     # Convert back to int, and return
-
+    return comstr + pack('B',crc7(comstr))
 
 class Protocol( AbstractProtocol ):
   """
@@ -207,18 +287,42 @@ class Protocol( AbstractProtocol ):
   # This is also to initialize the Maestro to begin receiving commands using the PololuProtocol
   POLOLU_BYTE = 0xAA
 
-  def __init__(self, bus=None, nodes=None, *args,**kw):
+  #: Time to wait for the reply to a Get Position or Get Errors command
+  REPLY_TIMEOUT = 0.05
+
+  def __init__(self, bus=None, nodes=None, batch=False, readback=False,
+               error_period=None, reply_timeout=REPLY_TIMEOUT, ranges=None,
+               *args,**kw):
     """
     Initialize a pololu.Protocol
 
     INPUT:
     bus -- pololu.Bus -- Serial bus used to communicate with Pololu Device
     nodes -- dictionary -- key:module node_id, value:pololu controller number
+    batch -- bool -- if set, positions given to set_target during a
+      timeslice are sent by update() in Set Multiple Targets commands
+      (Mini Maestro 12, 18 and 24 only)
+    readback -- bool -- if set, modules read their positions from the
+      Maestro with Get Position commands (see request_pos)
+    error_period -- float -- if set, update() polls the Maestro for errors
+      every error_period seconds, in the background (see request_errors)
+    reply_timeout -- float -- time to wait for each reply to a query
+    ranges -- dictionary -- key:pololu controller number, value:(min,max)
+      pulse widths, in microseconds, of MiniSSC-II positions 0 and 254 on
+      that channel (its neutral -/+ its 8-bit range, as set on the
+      Maestro); other channels use SSC_DEFAULT_RANGE
 
     ATTRIBUTES:
     heartbeats -- dictionary -- key:nid, value:(timestamp)
     msgs -- dictionary -- a fake representation of a dictionary message, used so the pololu.Protocol can "dock" onto existing Cluster interfaces (provides the Module version)
     pna -- dictionary -- table of NodeID to ProtocolNodeAdaptor mappings
+    targets -- dict -- channel to target (quarter microseconds) to be sent
+      by the next update(), in batch mode
+    reads -- deque -- (command, promise) of queries to be sent
+    inflight -- deque -- (command, promise, time sent) of queries whose
+      reply has not arrived, in the order they were sent
+    errors -- int or None -- error bits from the latest background poll
+    errorsT -- float or None -- time that poll was sent
 
     FUTURE:
     buses -- may be a list of buses (Protocol can communicate with multiple buses by changing servonums)
@@ -234,9 +338,22 @@ class Protocol( AbstractProtocol ):
     elif nodes is None:
       nodes = {}
     self.nodes = nodes
-    self.heartbeats = {} # Gets populated by update
+    self.heartbeats = HeartbeatTable() # Gets populated by update
     self.msgs = {}
     self.pnas = {}
+    self.batch = batch
+    self.readback = readback
+    self.targets = {}
+    self.reads = deque()
+    self.inflight = deque()
+    self.rxbuf = b''
+    self.reply_timeout = reply_timeout
+    self.ranges = dict(ranges or {})
+    self.error_period = error_period
+    self.errors = None
+    self.errorsT = None
+    self._errPoll = None
+    self._errDue = 0
     self.pololu_setup() # Must be called before the Maestro can begin to respond to commands
 
   def pololu_setup(self):
@@ -260,6 +377,134 @@ class Protocol( AbstractProtocol ):
 
     self.bus.write([cmd_type,channel]+list(cmd))
 
+  def ssc_range(self, nid):
+    """
+    Range, as (min,max) in microseconds, that MiniSSC-II positions 0..254
+    map to on the channel of a node (see ranges)
+    """
+    return self.ranges.get(self.nodes[nid], SSC_DEFAULT_RANGE)
+
+  def set_target(self, nid, target):
+    """
+    Set the target of a node, in quarter microseconds (0 turns the channel
+    off). In batch mode, the target is sent by the next update(), together
+    with all other targets set until then; otherwise it is sent at once.
+    """
+    if self.batch:
+      self.targets[self.nodes[nid]] = target
+    else:
+      self.send_cmd(CMD_SET_TARGET, nid, (target & 0x7F, (target >> 7) & 0x7F))
+
+  def flushTargets(self):
+    """
+    Send all targets set since the last call, one Set Multiple Targets
+    command per run of contiguous channels (Set Target for single channels)
+
+    OUTPUT:
+    number of commands written
+    """
+    if not self.targets:
+      return 0
+    tgt = self.targets
+    self.targets = {}
+    chs = sorted(tgt)
+    n = 0
+    k = 0
+    while k < len(chs):
+      # Find the run of contiguous channels starting at chs[k]
+      e = k+1
+      while e < len(chs) and chs[e] == chs[e-1]+1:
+        e += 1
+      dat = []
+      for ch in chs[k:e]:
+        dat.extend((tgt[ch] & 0x7F, (tgt[ch] >> 7) & 0x7F))
+      if e-k == 1:
+        self.bus.write([CMD_SET_TARGET, chs[k]]+dat)
+      else:
+        self.bus.write([CMD_SET_MULTIPLE_TARGETS, e-k, chs[k]]+dat)
+      n += 1
+      k = e
+    return n
+
+  def request_pos(self, nid):
+    """
+    Request the position of a node; the Get Position command is sent by
+    the next update(), together with all other requests made until then
+
+    OUTPUT:
+    promise -- list -- empty until the reply arrives; then holds the
+      position in quarter microseconds, or a ProtocolError
+    """
+    promise = []
+    self.reads.append(((CMD_GET_POSITION, self.nodes[nid]), promise))
+    return promise
+
+  def request_errors(self):
+    """
+    Request the error bits of the Maestro; the Get Errors command is sent
+    by the next update(), which never waits for the reply
+
+    OUTPUT:
+    promise -- list -- empty until the reply arrives; then holds the
+      error bits, or a ProtocolError if no reply arrived in time (see
+      reply_timeout)
+    """
+    promise = []
+    self.reads.append(((CMD_GET_ERRORS,), promise))
+    return promise
+
+  def _pollErrors(self, t):
+    """(private)
+    Background error polling: collect the result of the previous poll,
+    and issue a new one when due
+    """
+    pr = self._errPoll
+    if pr:
+      self._errPoll = None
+      if isinstance(pr[0],Exception):
+        progress("pololu: error poll failed: %s" % pr[0])
+      else:
+        if pr[0] and pr[0] != self.errors:
+          progress("pololu: Maestro reports errors 0x%04x" % pr[0])
+        self.errors = pr[0]
+    if self._errPoll is None and t >= self._errDue:
+      self._errPoll = self.request_errors()
+      self.errorsT = t
+      self._errDue = t + self.error_period
+
+  def _issueReads(self, t):
+    """(private) send queued queries, in a single write"""
+    cmds = []
+    while self.reads:
+      cmd,promise = self.reads.popleft()
+      cmds.append(cmd)
+      self.inflight.append((cmd, promise, t))
+    if cmds:
+      self.bus.write_many(cmds, flush=True)
+
+  def _collectReplies(self, t):
+    """(private)
+    Fulfill position reads with the replies that arrived; replies come
+    in the order commands were sent. If the oldest reply is overdue, all
+    pending reads fail, as the reply stream can no longer be aligned.
+    """
+    ser = self.bus.ser
+    n = ser.inWaiting()
+    if n:
+      self.rxbuf += ser.read(n)
+    k = 0
+    while self.inflight and len(self.rxbuf) >= k+2:
+      cmd,promise,ts = self.inflight.popleft()
+      promise[:] = [unpack('<H',self.rxbuf[k:k+2])[0]]
+      k += 2
+    self.rxbuf = self.rxbuf[k:]
+    if self.inflight and t - self.inflight[0][2] > self.reply_timeout:
+      for cmd,promise,ts in self.inflight:
+        promise[:] = [ProtocolError("Reply to command %s timed out"
+          % " ".join("0x%02x" % b for b in cmd))]
+      self.inflight.clear()
+      self.rxbuf = b''
+
   def hintNodes( self, nodes ):
     """
     Specify which nodes to expect on the bus.
@@ -288,7 +533,15 @@ class Protocol( AbstractProtocol ):
     # This allows Cluster to believe that all the modules connected through Pololu are alive
     self.heartbeats.update( { nid : (t,0)
       for nid in self.nodes.keys() } )
-    return 0
+    self.flushTargets()
+    # Write out the commands of this timeslice, if batching
+    self.bus.flushTx()
+    if self.error_period:
+      self._pollErrors(t)
+    if self.reads or self.inflight:
+      self._collectReplies(t)
+      self._issueReads(t)
+    return len(self.reads)+len(self.inflight)
 
   def generatePNA(self, nid):
     """
@@ -335,19 +588,54 @@ class ProtocolNodeAdaptor( AbstractNodeAdaptor ):
     self.p = protocol
     self.nid = nid
 
+  @classmethod
+  def ssc2qus(cls, target, rng=SSC_DEFAULT_RANGE):
+    """
+    Convert a MiniSSC-II position (0..254) to quarter microseconds, on a
+    channel with range rng (see Protocol.ssc_range)
+    """
+    lo,hi = rng
+    return int(4*(lo + target*(hi-lo)/254.0) + 0.5)
+
+  @classmethod
+  def qus2ssc(cls, qus, rng=SSC_DEFAULT_RANGE):
+    """
+    Convert quarter microseconds to a MiniSSC-II position (0..254), on a
+    channel with range rng (see Protocol.ssc_range)
+    """
+    lo,hi = rng
+    return (qus/4.0 - lo)*254.0/(hi-lo)
+
   def go_slack(self):
+    if self.p.batch:
+      # Target 0 stops the pulses; also replaces any pending target
+      return self.p.set_target(self.nid, 0)
     self.p.send_cmd(self.COMPACT_BYTE, self.nid, (0x00,) )
 
   def set_pos(self, target):
     """
     Sends a position command to the Pololu device over serial via the
-    pololu.Protocol.send_cmd()
+    pololu.Protocol.send_cmd(), or in batch mode via the next
+    pololu.Protocol.update()
 
     INPUT:
     target -- byte -- the command
     """
+    if self.p.batch:
+      return self.p.set_target(self.nid,
+        self.ssc2qus(target, self.p.ssc_range(self.nid)))
     return self.p.send_cmd(self.MINISSC2_BYTE, self.nid, (target,) )
 
+  def get_pos_async(self):
+    """
+    Request the position from the Maestro (see Protocol.request_pos)
+
+    OUTPUT:
+    promise -- list -- filled with the position in quarter microseconds,
+      or a ProtocolError, by a later update()
+    """
+    return self.p.request_pos(self.nid)
+
   def get_typecode( self ):
     return "PolServoModule"
 
@@ -356,7 +644,8 @@ class ServoModule( AbstractServoModule ):
   """
   ServoModule Class has the basic functionality of ServoModules, with some exceptions listed below:
 
-  - Pololu Modules cannot get_pos or is_slack
+  - Pololu Modules cannot is_slack; they can get_pos only if their
+    Protocol was created with readback=True
   - The Pololu Device allows for:
   - servo parameter settings
   - set speed
@@ -401,21 +690,66 @@ class ServoModule( AbstractServoModule ):
     """
     return self.slack
 
-  def get_pos_async(self):
+  @classmethod
+  def _pol2deg(cls, qus, rng=SSC_DEFAULT_RANGE):
     """
-    Returns the 'believed' position of the module, none if set_pos has not been called yet.
-
-    WARNING: This function does NOT actually read states from the pololu device, returns an attribute that is updated by calls to set_pos and go_slack. If any external communications fail, then this function may report incorrect states
+    Convert a position read from the Maestro, in quarter microseconds,
+    to 100ths of degrees (inverse of _deg2pol), on a channel with range rng
     """
-    return self.pos
+    scale = 1.0*(255-0)/(9000--9000)
+    return int((ProtocolNodeAdaptor.qus2ssc(qus, rng) - 127)/scale)
 
-  def get_pos(self):
+  def get_pos_async(self):
+    """
+    Returns a promise for the position, as the dynamixel modules do;
+    parse it with async_parse(). If the protocol has readback enabled,
+    the position is requested from the Maestro. Otherwise, the promise
+    is already resolved, with the 'believed' position of the module
+    (or a ProtocolError if set_pos has not been called yet).
     """
-    Returns the 'believed' position of the module, none if set_pos has not been called yet.
+    if self.pna.p.readback:
+      return self.pna.get_pos_async()
+    if self.pos is None:
+      return [ProtocolError("NID 0x%02x position is not known" % self.node_id)]
+    return [ProtocolNodeAdaptor.ssc2qus(self._deg2pol(self.pos),
+              self.pna.p.ssc_range(self.node_id))]
 
-    WARNING: This function does NOT actually read states from the pololu device, returns an attribute that is updated by calls to set_pos and go_slack. If any external communications fail, then this function may report incorrect states
+  def async_parse(self, promise, barf=True):
+    """
+    Parse a promise returned by get_pos_async() into a position in 100ths
+    of degrees, with the range of the module's channel. When barf is True,
+    raises ProtocolError if the read failed or did not complete; otherwise
+    returns the exception object.
     """
-    return self.pos
+    if not promise:
+      err = ProtocolError("Asynchronous operation did not complete")
+    else:
+      err = promise[0]
+      if not isinstance(err,Exception):
+        return self._pol2deg(err, self.pna.p.ssc_range(self.node_id))
+    if barf:
+      raise err
+    return err
+
+  def get_pos(self, timeout=0.1):
+    """
+    If the protocol has readback enabled, reads the position from the
+    Maestro, running protocol updates for at most timeout seconds until it
+    arrives. Otherwise, returns the 'believed' position of the module,
+    none if set_pos has not been called yet.
+
+    WARNING: without readback, this function does NOT actually read states from the pololu device, returns an attribute that is updated by calls to set_pos and go_slack. If any external communications fail, then this function may report incorrect states
+    """
+    p = self.pna.p
+    if not p.readback:
+      return self.pos
+    promise = self.pna.get_pos_async()
+    t0 = now()
+    while not promise and now()-t0 < timeout:
+      p.update(now())
+      if not promise:
+        p.bus.ser.waitInput(0.001)
+    return self.async_parse(promise)
 
   def go_slack(self):
     """
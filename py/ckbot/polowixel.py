@@ -8,6 +8,8 @@ continuous rotation servos with position feedback.
 
 from warnings import warn
 from struct import unpack, error as struct_error
+from collections import deque
+from time import time as now
 from .ckmodule import AbstractServoModule, AbstractNodeAdaptor, progress, AbstractBusError
 from .pololu import (
   Bus as pololu_Bus,
@@ -42,94 +44,216 @@ def _DBG(fun,fmt,*argv):
     else:
       fun(fmt,*argv)
 
+class FrameRing( object ):
+    """
+    Bounded ring of timestamped frames, oldest first
+
+    ATTRIBUTES:
+      ring -- deque -- (t, frame) pairs; the oldest are dropped when full
+      count -- int -- number of frames ever added
+    """
+    def __init__(self, size=64):
+      self.ring = deque(maxlen=size)
+      self.count = 0
+
+    def __len__(self):
+      return len(self.ring)
+
+    def append(self, t, frame):
+      self.ring.append((t,frame))
+      self.count += 1
+
+    def latest(self):
+      """Most recent (t, frame) pair, or None if there is none"""
+      if not self.ring:
+        return None
+      return self.ring[-1]
+
+    def since(self, t):
+      """List of (t, frame) pairs received after time t, oldest first"""
+      res = []
+      for tf in reversed(self.ring):
+        if tf[0] <= t:
+          break
+        res.append(tf)
+      res.reverse()
+      return res
+
 class Bus( pololu_Bus ):
     """
     Concrete class Bus extending the pololu_Bus class
 
     This class adds an update function that pulls all data from the bus,
-    and a read function that aligns to the \xFF\xFF sync byte pattern
-    used in our wixel code
+    and reader functions that align to the \xFF\xFF sync byte pattern
+    used in our wixel code. Every complete frame is stored with its
+    receive time in a FrameRing, .frames
     """
 
     # Communications timeout
     TIMEOUT = 1.0
 
+    # Number of frames kept in .frames
+    RING_LEN = 64
+
+    # Interval at which the wixel sends frames, in seconds; if None, it is
+    #   estimated from the arrival rate of frames
+    FRAME_PERIOD = None
+
+    # Weight of each new sample in the frame period estimate
+    PERIOD_GAIN = 0.2
+
     def __init__(self, *arg, **kw):
+      self.period = kw.pop('frame_period',self.FRAME_PERIOD)
       pololu_Bus.__init__(self,*arg,**kw)
-      self.buf = b''
+      self.estPeriod = None
+      self.lastFrameT = None
+      self.buf = bytearray()
       self.n = 0
       self.lastUpdT = None
       self.t = None
+      self.frames = FrameRing(self.RING_LEN)
+      self.pending = deque(maxlen=self.RING_LEN)
 
     def update(self,t):
       self.t = t
 
+    def poll(self,l):
+      """
+      Read all available bytes, and parse every complete frame of l
+      characters (after its sync bytes) out of them.
+
+      Frames that arrived in the same read are given receive times spaced
+      by the wixel's frame period, ending at the time of the read, so the
+      intervals between samples are those of the wixel rather than those
+      of our polling. The period is .period if it was configured (the
+      frame_period constructor keyword), and otherwise .estPeriod, a
+      running estimate from the number of frames received per interval
+      between reads. Times never go back past the newest earlier frame.
+
+      OUTPUT:
+        list of new (t, frame) pairs, oldest first; also added to .frames
+      """
+      w = self.ser.read(self.ser.inWaiting())
+      t = now()
+      if w:
+        self.lastUpdT = self.t
+      elif not (self.lastUpdT is None or self.t is None) and (self.t-self.lastUpdT)>self.TIMEOUT:
+        raise AbstractBusError("Communication timed out")
+      b = self.buf
+      b.extend(w)
+      got = []
+      h = 0
+      while True:
+        s = b.find(b'\xff\xff',h)
+        if s<0:
+          # Only report an error if sync search failed with bytes in buffer
+          if not got and len(b)>h:
+            progress("%s no sync (%d bytes)" % (repr(self),len(b)-h))
+          # Keep a trailing 0xFF, which may be the start of a sync
+          h = max(h,len(b)-1)
+          break
+        # If not enough bytes for a complete frame --> wait for more
+        if len(b)<s+2+l:
+          h = s
+          break
+        got.append(bytes(b[s+2:s+2+l]))
+        h = s+2+l
+      del b[:h]
+      if not got:
+        return []
+      n = len(got)
+      dt = self.period or 0
+      if self.lastFrameT is not None:
+        gap = (t-self.lastFrameT)/n
+        if self.estPeriod is None:
+          self.estPeriod = gap
+        else:
+          self.estPeriod += self.PERIOD_GAIN*(gap-self.estPeriod)
+        dt = min(gap, self.period or self.estPeriod)
+      self.lastFrameT = t
+      res = [ (t-(n-1-k)*dt, f) for k,f in enumerate(got) ]
+      for tf in res:
+        self.frames.append(*tf)
+      self.pending.extend(res)
+      return res
+
+    def latest(self):
+      """Most recent (t, frame) received, or None (see FrameRing)"""
+      return self.frames.latest()
+
+    def since(self, t):
+      """List of (t, frame) pairs received after time t (see FrameRing)"""
+      return self.frames.since(t)
+
     def read(self,l,skip=False):
       """
       Read an l character frame from the serial from after the next sync
       bytes, in an atomic read operation.
 
-      When skip is true, tries to read the last frame of length l by skipping
-      to the end of the buffer minus length of frame with l bytes
+      When skip is true, returns the last frame received, dropping any
+      older ones that were not read yet
 
       If the requested data isn't available, returns None
       """
-      w = self.ser.read(self.ser.inWaiting())
-      if w:
-        self.lastUpdT = self.t
-      elif not (self.lastUpdT is None or self.t is None) and (self.t-self.lastUpdT)>self.TIMEOUT:
-        raise AbstractBusError("Communication timed out")
-      b = self.buf + w
-      # If skip requested, and possible --> do it
-      if skip and len(b)>(l+2):
-        b = b[-l-2:]
-      s = b.find(b'\xff\xff')
-      if s<0:
-        # Only report an error if sync search failed with bytes in buffer
-        if len(b):
-          progress("%s no sync (%d bytes)" % (repr(self),len(b)))
-        self.buf = b
-        return None # no sync bytes
-      # If not enough bytes for atomic read --> return nothing
-      if len(b)<s+2+l:
-        self.buf = b
+      self.poll(l)
+      if not self.pending:
         return None
-      # Read selected number of bytes
-      res = b[s+2:s+l+2]
-      self.buf = b[s+4+l:]
-      self.n -= s+2+l
-      return res
+      if skip:
+        t,res = self.pending[-1]
+        self.pending.clear()
+        return res
+      return self.pending.popleft()[1]
 
 class Protocol( pololu_Protocol ):
     def __init__(self, *arg, **kw):
       port = dict(TYPE='TTY', glob="/dev/ttyACM*", baudrate=115200)
-      port.update(kw.get('port',{}))
-      kw.update(bus=Bus(port=port))
+      port.update(kw.pop('port',{}))
+      # The wixel streams positions on its own; replies to Get Position
+      #   and Get Errors would corrupt that stream
+      kw.update(bus=Bus(port=port,frame_period=kw.pop('frame_period',None)),
+        readback=False, error_period=None)
       pololu_Protocol.__init__(self,*arg,**kw)
       self.count=6 # Current code supports 6 motors on a polowixel
       self.DEBUG=DEBUG
+      self.group = None
+
+    def crGroup(self):
+      """
+      The CRGroup controlling the continuous rotation modules of this
+      protocol; created on first use. None if NumPy is not available.
+      """
+      if self.group is None:
+        try:
+          self.group = CRGroup(self)
+        except ImportError:
+          return None
+      return self.group
 
     def update(self, t):
       # Superclass update
       pololu_Protocol.update(self,t)
       # Bus update
       self.bus.update(t)
-      # Read the latest update off of the bus
-      l = self.bus.read(self.count * 2,skip=True)
-      if l is None:
-        return
-      # Push position into PNAs
-      try:
-        msg = unpack("h"*self.count,l)
-      except struct_error as er:
-        progress("Error unpacking message ('%s', %r)" % (er,l))
-        return
-      for nid,ii in self.nodes.items():
-        val = msg[ii]
-        if nid in self.pnas:
-          self.pnas[nid].feedPos(val)
-          if 'P' in self.DEBUG:
-              _DBG(self.DEBUG['P'],"RAW nid%d pos = %g",nid,val)
+      # Push every new frame, with its receive time, into PNAs and the
+      #   readings of the CRGroup
+      for ft,l in self.bus.poll(self.count * 2):
+        try:
+          msg = unpack("h"*self.count,l)
+        except struct_error as er:
+          progress("Error unpacking message ('%s', %r)" % (er,l))
+          continue
+        if self.group is not None:
+          self.group.feed(msg,ft)
+        for nid,ii in self.nodes.items():
+          val = msg[ii]
+          if nid in self.pnas:
+            self.pnas[nid].feedPos(val,ft)
+            if 'P' in self.DEBUG:
+                _DBG(self.DEBUG['P'],"RAW nid%d pos = %g",nid,val)
+      # Run the servo loop of all CR modules, and send the result at once
+      if self.group is not None and self.group.step():
+        self.flushTargets()
+        self.bus.flushTx()
 
     def generatePNA(self, nid):
       """
@@ -142,6 +266,9 @@ class Protocol( pololu_Protocol ):
         pna = ProtocolNodeAdaptor_UB(self, nid)
       else:
         raise TypeError("Node ID 0x%02x does not match any known module type" % nid)
+      # Modules of a node that is (re)discovered lost their old adaptor
+      if self.group is not None and nid in self.pnas:
+        self.group.removeNode(nid)
       self.pnas[nid] = pna
       return pna
 
@@ -154,9 +281,11 @@ class ProtocolNodeAdaptor_UB( pololu_ProtocolNodeAdaptor ):
     def __init__(self,*arg,**kw):
       pololu_ProtocolNodeAdaptor.__init__(self,*arg,**kw)
       self.pos = 0
+      self.t = None
 
-    def feedPos(self,pos):
+    def feedPos(self,pos,t=None):
       self.pos = pos
+      self.t = t
 
     def getRawPos(self):
       return self.pos
@@ -191,11 +320,17 @@ class ProtocolNodeAdaptor_CR( AbstractNodeAdaptor ):
       self.lb = self.DEFAULT_LB
       self.ub = self.DEFAULT_UB
       self.relpos = None
+      self.t = None
+      self.relvel = None
       self.DEBUG = DEBUG
 
-    def feedPos(self,pos):
+    def feedPos(self,pos,t=None):
       """
-      Feed a position reading from
+      Feed a position reading from the wixel, received at time t
+
+      Consecutive readings with receive times give .relvel, the rate of
+      rotation in calibrated range per second (taking the short way
+      around, as the position wraps)
       """
       # Update calibration range
       if pos > self.ub:
@@ -204,7 +339,15 @@ class ProtocolNodeAdaptor_CR( AbstractNodeAdaptor ):
           self.lb = pos
       # Position as a fraction of calibrated range
       p = (pos - self.lb)/float(self.ub - self.lb)
+      if t is not None and self.t is not None and t > self.t:
+        d = p - self.relpos
+        if d>0.5:
+          d -= 1
+        elif d<-0.5:
+          d += 1
+        self.relvel = d/(t-self.t)
       self.relpos = p
+      self.t = t
 
     def isCalibrated(self):
         return (self.ub != self.DEFAULT_UB) and (self.lb != self.DEFAULT_LB)
@@ -212,13 +355,24 @@ class ProtocolNodeAdaptor_CR( AbstractNodeAdaptor ):
     def get_relpos(self):
       return self.relpos
 
+    def get_sample(self):
+      """
+      Latest reading as (t, relpos, relvel); t and relvel are None until
+      timestamped readings arrived
+      """
+      return self.t, self.relpos, self.relvel
+
+    @classmethod
+    def rpm2cmd(cls, target):
+      """MiniSSC-II position commanding a rate of rotation of target rpm"""
+      return max(0,min(254,int(127+128*target/float(cls.MAXRPM))))
+
     def set_rpm(self, target):
       """
       INPUT:
       target -- float -- rate of rotation
       """
-      M = float(self.MAXRPM)
-      cmd = max(0,min(254,int(127+128*target/M)))
+      cmd = self.rpm2cmd(target)
       if 'r' in self.DEBUG:
           _DBG(self.DEBUG['r'], "nid%d.set_rpm(%g) --> %g",
                self.nid, target,cmd)
@@ -230,6 +384,196 @@ class ProtocolNodeAdaptor_CR( AbstractNodeAdaptor ):
 class ServoModule( AbstractServoModule ):
     pass
 
+class CRGroup( object ):
+    """
+    Concrete class holding the servo loop state of all continuous rotation
+    modules (ServoModuleCR) of a polowixel Protocol in NumPy arrays, one
+    entry per module, and running their servo loops in a single vectorized
+    step() per Protocol.update.
+
+    The attributes of the modules listed in FIELDS are views of the entries
+    of the arrays with the same names.
+
+    The position readings of the modules are kept in the SAMPLES arrays,
+    which Protocol.update fills from every frame the wixel sent with a
+    single call to feed(); step() thus works on arrays only, without
+    visiting the modules or their node adaptors.
+
+    ATTRIBUTES:
+      p -- Protocol -- the protocol the modules are on
+      mods -- list -- modules, in the order of the array entries
+      live -- bool array -- modules whose calibration is complete, and
+        which are controlled by step()
+      (and the FIELDS and SAMPLES arrays)
+    """
+    #: State arrays and the initial value of their entries
+    FIELDS = dict( pos=None, vel=None, tPos=None, goalPos=0., Kp=100.,
+      p_punch=6., n_punch=-6., mode=0, torque_rpm=0., slack=True,
+      live=False )
+
+    #: Arrays of the latest readings: node ID, wixel channel, calibrated
+    #:   range (as in ProtocolNodeAdaptor_CR), receive time, position as
+    #:   a fraction of the range, and its rate of change
+    SAMPLES = dict( nid=0, ch=0, lb=0., ub=0., sT=None, sPos=None, sVel=None )
+
+    def __init__(self, protocol):
+      from numpy import array, nan
+      self.p = protocol
+      self.mods = []
+      self.nan = nan
+      for nm,v in list(self.FIELDS.items())+list(self.SAMPLES.items()):
+        setattr(self,nm,array([],type(nan if v is None else v)))
+
+    def add(self, mod):
+      """
+      Add a module. A module already in the group with the same node ID
+      (e.g. the previous module of a re-populated cluster) is removed.
+
+      OUTPUT:
+        index of the module's entries in the arrays
+      """
+      from numpy import append
+      for old in [ m for m in self.mods if m.node_id == mod.node_id ]:
+        self.remove(old)
+      ix = len(self.mods)
+      self.mods.append(mod)
+      for nm,v in self.FIELDS.items():
+        setattr(self,nm,append(getattr(self,nm),self.nan if v is None else v))
+      # Readings start from those the node adaptor has seen so far
+      pna = mod.pna
+      t,pos,vel = pna.get_sample()
+      smp = dict( nid=mod.node_id, ch=self.p.nodes[mod.node_id],
+        lb=pna.lb, ub=pna.ub, sT=t, sPos=pos, sVel=vel )
+      for nm,v in smp.items():
+        setattr(self,nm,append(getattr(self,nm),self.nan if v is None else v))
+      return ix
+
+    def remove(self, mod):
+      """
+      Remove a module, e.g. because its node was lost. The module keeps a
+      copy of its servo loop state, and is no longer controlled by step().
+
+      OUTPUT:
+        True if the module was in the group
+      """
+      from numpy import delete
+      if mod not in self.mods:
+        return False
+      ix = self.mods.index(mod)
+      sc = _CRScalars()
+      for nm in self.FIELDS:
+        setattr(sc,nm,[getattr(mod,nm)])
+      sc.live = [False]
+      mod._grp = sc
+      mod._ix = 0
+      del self.mods[ix]
+      for nm in list(self.FIELDS)+list(self.SAMPLES):
+        setattr(self,nm,delete(getattr(self,nm),ix))
+      for k,m in enumerate(self.mods):
+        m._ix = k
+      return True
+
+    def removeNode(self, nid):
+      """Remove the modules of node ID nid (see remove())"""
+      for m in [ m for m in self.mods if m.node_id == nid ]:
+        self.remove(m)
+
+    def feed(self, msg, t):
+      """
+      Take in a frame from the wixel, received at time t, for all modules
+      at once; computes what ProtocolNodeAdaptor_CR.feedPos does
+
+      INPUT:
+        msg -- sequence -- raw position of every wixel channel
+      """
+      from numpy import asarray, minimum, maximum, where, errstate, full_like
+      if not self.mods:
+        return
+      raw = asarray(msg,float)[self.ch]
+      self.lb = minimum(self.lb,raw)
+      self.ub = maximum(self.ub,raw)
+      pos = (raw-self.lb)/(self.ub-self.lb)
+      # Short way around, as the position wraps
+      d = pos-self.sPos
+      d = where(d>0.5, d-1, where(d<-0.5, d+1, d))
+      with errstate(invalid='ignore',divide='ignore'):
+        dt = t-self.sT
+        self.sVel = where(dt>0, d/dt, self.sVel)
+      self.sPos = pos
+      self.sT = full_like(self.sT,t)
+
+    def step(self):
+      """
+      Run the servo loop of all live modules that have a new position
+      reading, and send their rotation commands: in Set Multiple Targets
+      commands if the protocol is in batch mode, otherwise as MiniSSC-II
+      commands in a single write (each with its own CRC7 byte, if the bus
+      is in CRC mode). See ServoModuleCR._live_update for the control law,
+      which this computes for all modules at once, from the readings
+      given to feed().
+
+      OUTPUT:
+        number of modules commanded
+      """
+      from numpy import where, isnan, trunc, clip
+      if not self.live.any():
+        return 0
+      # Control once per new reading from the wixel
+      fresh = self.live & ~isnan(self.sPos) & ~(self.sT == self.tPos)
+      if not fresh.any():
+        return 0
+      self.tPos = where(fresh,self.sT,self.tPos)
+      self.pos = where(fresh,self.sPos,self.pos)
+      self.vel = where(fresh,self.sVel,self.vel)
+      act = fresh & ~self.slack
+      if not act.any():
+        return 0
+      err = self.goalPos - self.pos
+      # Continuous mode takes the short way around
+      err = where(self.mode == 2,
+        where(err>0.5, err-1, where(err<-0.5, err+1, err)), err)
+      rpm = where(self.mode == 1, self.torque_rpm, -self.Kp*err)
+      rpm = rpm + where(rpm>0, self.p_punch, where(rpm<0, self.n_punch, 0.))
+      M = float(ProtocolNodeAdaptor_CR.MAXRPM)
+      cmd = clip(trunc(127+128*rpm/M),0,254).astype(int)
+      ix = act.nonzero()[0]
+      if 'u' in DEBUG:
+        for k in ix:
+          _DBG(DEBUG['u'],"nid%d update pos %g goal %g rpm %g mode %d",
+              self.nid[k], self.pos[k], self.goalPos[k], rpm[k], self.mode[k])
+      p = self.p
+      if p.batch:
+        for nid,c in zip(self.nid[ix].tolist(),cmd[ix].tolist()):
+          p.set_target(nid, pololu_ProtocolNodeAdaptor.ssc2qus(c,
+            p.ssc_range(nid)))
+      else:
+        p.bus.write_many([ (ProtocolNodeAdaptor_CR.MINISSC2_BYTE, ch, c)
+          for ch,c in zip(self.ch[ix].tolist(),cmd[ix].tolist()) ])
+      return len(ix)
+
+class _CRScalars( object ):
+    """
+    (private) Servo loop state of a single ServoModuleCR, when NumPy is not
+    available; has the same attributes as CRGroup, as one entry lists
+    """
+    def __init__(self):
+      self.nan = None
+      for nm,v in CRGroup.FIELDS.items():
+        setattr(self,nm,[v])
+
+def _crState( nm ):
+    """(private) property viewing entry ._ix of CRGroup field nm"""
+    v0 = CRGroup.FIELDS[nm]
+    tp = float if v0 is None else type(v0)
+    def fget(self):
+      v = getattr(self._grp,nm)[self._ix]
+      if v is None or v != v: # None, or NaN
+        return None
+      return tp(v)
+    def fset(self, v):
+      getattr(self._grp,nm)[self._ix] = self._grp.nan if v is None else v
+    return property(fget,fset,doc="servo loop state '%s'" % nm)
+
 class ServoModuleUB( pololu_ServoModule ):
     RAW_POS_OFS = 0
     RAW_POS_SCALE = 1.
@@ -263,6 +607,14 @@ class ServoModuleCR( ServoModule ):
 
     def __init__(self, node_id, typecode, pna, *argv, **kwarg):
       AbstractServoModule.__init__(self, node_id, typecode, pna, *argv, **kwarg )
+      # Servo loop state lives in the CRGroup of the protocol (see FIELDS)
+      grp = pna.rawpna.p.crGroup()
+      if grp is None:
+        self._grp = _CRScalars()
+        self._ix = 0
+      else:
+        self._grp = grp
+        self._ix = grp.add(self)
       self._attr.update(
         go_slack="1R",
         set_pos="2W",
@@ -273,6 +625,8 @@ class ServoModuleCR( ServoModule ):
 
     def setDefaults(self):
       self.pos = None
+      self.vel = None
+      self.tPos = None
       self.goalPos = 0
       self.DEBUG=DEBUG
       self.tCal = None
@@ -293,7 +647,8 @@ class ServoModuleCR( ServoModule ):
       for k,v in kw.items():
         if not k in ATTR:
           raise KeyError("Cannot set '%s'" % k)
-      self.__dict__.update(kw)
+      for k,v in kw.items():
+        setattr(self,k,v)
       if kw.get('slack',False):
         self.go_slack()
 
@@ -364,18 +719,34 @@ class ServoModuleCR( ServoModule ):
         self.torque_rpm = 0
         self.set_rpm(0)
         self.go_slack()
+      elif isinstance(self._grp,CRGroup):
+        # and then switch to controller; CRGroup.step runs it
+        self.live = True
+        self.update = self._group_update
       else: # and then switch to controller
         self.update = self._live_update
 
+    def _group_update( self, t ):
+      """
+      Periodic update once calibrated; the servo loop runs in CRGroup.step,
+      for all modules of the protocol at once
+      """
+      pass
+
     def _live_update( self, t ):
       """
       Perform a periodic update for controlling motor position
       """
       # Get current position; range is 0-1
-      np = self.pna.get_relpos()
+      ts,np,vel = self.pna.get_sample()
       if np is None:
         return
+      # Control once per new reading from the wixel
+      if ts is not None and ts == self.tPos:
+        return
+      self.tPos = ts
       self.pos = np
+      self.vel = vel
       # Do nothing else if slack
       if self.slack:
         return
@@ -437,6 +808,16 @@ class ServoModuleCR( ServoModule ):
       """
       return self.pos
 
+    def get_vel(self):
+      """
+      Return the rate of rotation in centi-degrees per second, computed
+      from the receive times of the two most recent readings; None if
+      not known yet
+      """
+      if self.vel is None:
+        return None
+      return self.vel*self.SCL
+
     def go_slack(self):
       """
       Equivalent of setting a ServoModule slack. This is referred to as "off"
@@ -446,3 +827,8 @@ class ServoModuleCR( ServoModule ):
       self.pna.go_slack()
       # Module should now be slack
       self.slack = True
+
+# Servo loop state of ServoModuleCR lives in the CRGroup of its protocol
+for _nm in CRGroup.FIELDS:
+  setattr(ServoModuleCR,_nm,_crState(_nm))
+del _nm
@@ -21,8 +21,9 @@ from struct import pack
 from sys import platform, stderr
 from os import sep
 from json import loads as json_loads
-from time import time as now
+from time import time as now, sleep
 from errno import EAGAIN
+from select import select
 # Handle windows
 try:
   import _winreg as winreg
@@ -50,6 +51,27 @@ class Connection( object ):
   def inWaiting(self):
     return 0
 
+  def fileno( self ):
+    """File descriptor that becomes readable when input arrives, or None"""
+    return None
+
+  def waitInput( self, timeout ):
+    """Wait at most timeout seconds for input to arrive.
+    Uses select() on .fileno() where there is one; otherwise sleeps
+    for a short polling interval (at most timeout).
+    Return False if it is known that no input arrived, True otherwise
+    """
+    if timeout <= 0:
+      return True
+    try:
+      fd = self.fileno()
+    except (IOError, OSError, ValueError):
+      fd = None
+    if fd is None:
+      sleep(min(timeout,0.0005))
+      return True
+    return bool(select([fd],[],[],timeout)[0])
+
   def write( self, msg ):
     """(pure) Attempt to write the specified message through the
     connection. Returns number of byte written
@@ -63,6 +85,15 @@ class Connection( object ):
     """
     return 0
 
+  def readinto( self, buf ):
+    """Read up to len(buf) bytes into the writable buffer buf
+    Return number of bytes actually read
+    """
+    dat = self.read(len(buf))
+    n = len(dat)
+    buf[:n] = dat
+    return n
+
   def close( self ):
     """Disconnect; further traffic may raise an exception
     """
@@ -139,6 +170,19 @@ def newConnection( spec=None, **_spec ):
         
   {TYPE='tty', glob=<glob>, baudrate=<baud>, stopbits = <n>, parity = 'N'|'E'|'O', timeout=0.5 } -- set up a tty connection
 
+  {TYPE='loop', echo=False, maxlen=1<<20}
+        echo : bool.  Whether written bytes are looped back to the reader
+        maxlen : int.  Maximal number of bytes buffered for reading
+
+  {TYPE='dxlsim', servos={1:'MX64'}, baudrate=1000000, pty=False, ...}
+        a simulated network of Dynamixel servos; see ckbot.dynamixelsim
+
+  {TYPE='replay', fn=<capture file>, speed=1.0, lockstep=False}
+        plays back the received traffic of a capture; see ckbot.buscapture
+
+  Any of the above can also have a capture=<filename> entry, to append all
+  traffic of the connection to a capture file; see ckbot.buscapture
+
   any other string: string is taken as a Serial device glob pattern
 
   """
@@ -151,6 +195,7 @@ def newConnection( spec=None, **_spec ):
 
   T = args['TYPE']
   del args['TYPE']
+  cap = args.pop('capture',None)
 
   if T.lower() == 'udp':
     res = UDPConnection( **args )
@@ -158,6 +203,15 @@ def newConnection( spec=None, **_spec ):
     res = TCPConnection( **args )
   elif T.lower() == 'rtp':
     res = RTPConnection( **args )
+  elif T.lower() == 'loop':
+    res = LoopbackConnection( **args )
+  elif T.lower() == 'dxlsim':
+    # Imported here, as the simulator depends on the dynamixel module
+    from .dynamixelsim import newSimConnection
+    res = newSimConnection( **args )
+  elif T.lower() == 'replay':
+    from .buscapture import ReplayConnection
+    res = ReplayConnection( **args )
   elif T.lower() == 'tty':
     if 'glob' not in args:
       res = SerialConnection(**args)
@@ -172,6 +226,10 @@ def newConnection( spec=None, **_spec ):
         raise IOError("Could not open serial port '%s'" % g)
   else:
     raise ValueError('Unknown Connection type %s' % repr(T))
+  if cap:
+    from .buscapture import CaptureConnection
+    res = CaptureConnection( res, cap )
+    args['capture']=cap
   # new connection is ready, store the spec used to create it
   args['TYPE']=T
   res.newConnection_spec = args
@@ -206,6 +264,15 @@ class TCPConnection( Connection ):
     self._readSock()
     return len(self.rxq)
 
+  def fileno( self ):
+    return self.sock.fileno()
+
+  def waitInput( self, timeout ):
+    """Wait at most timeout seconds for input (see Connection.waitInput)"""
+    if self.rxq:
+      return True
+    return Connection.waitInput( self, timeout )
+
   def write( self, msg ):
     """
     Attempt to write the specified message through the connection.
@@ -287,6 +354,15 @@ class UDPConnection( Connection ):
     self._readSock()
     return self.rxlen
 
+  def fileno( self ):
+    return self.sock.fileno()
+
+  def waitInput( self, timeout ):
+    """Wait at most timeout seconds for input (see Connection.waitInput)"""
+    if self.rxq:
+      return True
+    return Connection.waitInput( self, timeout )
+
   def write( self, msg ):
     """
     Attempt to write the specified message through the connection.
@@ -389,4 +465,66 @@ class RTPConnection( UDPConnection ):
         msg = pack('>L',ts) + msg
         return super().write(msg)
 
-    
+
+class LoopbackConnection( Connection ):
+  """
+  In-memory connection, used for testing and benchmarking without hardware.
+
+  Bytes given to .feed() become available for reading. If echo is set, all
+  bytes written are also looped back to the reader, as happens on
+  half-duplex serial adaptors.
+  """
+  def __init__(self,*arg,**kw):
+    cfg = dict(echo=False,maxlen=1<<20)
+    cfg.update(kw)
+    self.cfg = cfg
+    self.rxq = bytearray()
+    self.txCount = 0
+
+  def isOpen( self ):
+    """Test if connection is open"""
+    return True
+
+  def flush( self ):
+    pass
+
+  def inWaiting( self ):
+    return len(self.rxq)
+
+  def feed( self, dat ):
+    """Make dat available for reading"""
+    if len(self.rxq)+len(dat) > self.cfg['maxlen']:
+      raise BufferError("Loopback buffer overflow")
+    self.rxq.extend(dat)
+
+  def write( self, msg ):
+    """
+    Write the message; it is discarded unless echo is set
+    Returns number of bytes written
+    """
+    self.txCount += len(msg)
+    if self.cfg['echo']:
+      self.feed(msg)
+    return len(msg)
+
+  def read( self, length ):
+    """
+    Read at most length bytes
+    """
+    pkt = bytes(self.rxq[:length])
+    del self.rxq[:length]
+    return pkt
+
+  def readinto( self, buf ):
+    """
+    Read at most len(buf) bytes directly into buf
+    """
+    n = min(len(buf),len(self.rxq))
+    buf[:n] = self.rxq[:n]
+    del self.rxq[:n]
+    return n
+
+  def reconnect( self, **changes ):
+    """Apply configuration changes and drop any buffered data"""
+    self.cfg.update(changes)
+    self.rxq = bytearray()
@@ -328,6 +328,7 @@ class JoyApp( object ):
       remote = None,
       midi = None,
       logVideo = None,
+      robotThread = None,
     )
     pth = PYCKBOTPATH + 'cfg%sJoyApp.yml' % OS_SEP
     if glob(pth):
@@ -373,11 +374,26 @@ class JoyApp( object ):
     if a:
       del robot['arch']
     self.robot = Cluster(arch=a, **robot)
+    if self.cfg.robotThread:
+      self._initRobotThread()
     if self.cfg.robotPollRate:
       self._initPosPolling()
     if self.cfg.minimalVoltage:
       return self._initVoltageSafety()
 
+  def _initRobotThread(self):
+    """(protected)
+    Start running robot communication on a dedicated thread.
+    The robotThread configuration may be True, or a dictionary of
+    ckbot.busthread.BusThread constructor parameters, e.g. period=0.005
+    """
+    try:
+      kw = dict(self.cfg.robotThread)
+    except TypeError:
+      kw = {}
+    self.robot.startBusThread(**kw)
+    progress("Robot communication runs on %s" % self.robot.busThread.name)
+
   def _initPosPolling(self):
     """(protected)
     Set up servos for position polling
@@ -633,6 +649,7 @@ class JoyApp( object ):
       self.onStop()
       if self.robot:
         self.robot.off()
+        self.robot.stopBusThread()
       if self.logger:
         self.logger.close()
         if self.cfg.logProgress:
@@ -18,6 +18,8 @@ class MultiJoyApp(JoyApp):
     self.robot = Cluster(
        arch=mp,count=len(NIDS),fillMissing=True, required=NIDS
     )
+    if self.cfg.robotThread:
+      self._initRobotThread()
     if self.cfg.robotPollRate:
       self._initPosPolling()
     if self.cfg.minimalVoltage:
@@ -0,0 +1,139 @@
+"""
+Benchmark suite for the ckbot.dynamixel communication stack
+
+Measures, against a loopback connection or a simulated servo network
+(ckbot.dynamixelsim), with fixed random seeds:
+  - send -- packets per second encoded and written by Bus.send
+  - recv -- packets per second parsed by Bus.recv
+  - sync_rtt -- round trip latency of Bus.send_cmd_sync; once with the
+    simulator delivering replies instantly (software overhead only), and
+    once with realistic 1 Mbps bus timing
+  - update -- cost of Protocol.update draining N queued read requests
+  - getter / setter -- overhead of calling Cluster.getterOf and
+    Cluster.setterOf functions
+
+Results are printed as progress messages, and written as JSON (to stdout,
+or to a file if one is given) so that runs can be compared between
+releases.
+
+Usage: python3 bench_bus.py [repeats] [seed] [results.json]
+"""
+from sys import argv, stdout, version
+from json import dump
+from random import Random
+from time import time as now
+from platform import platform
+
+from ckbot.dynamixel import Bus, Protocol, Dynamixel
+from ckbot.logical import Cluster
+from ckbot.ckmodule import progress
+
+#: Servos on the simulated bus
+SERVOS = { 1 : 'MX64', 2 : 'MX64', 3 : 'MX28', 4 : 'MX28' }
+
+def simBus( realtime=False, seed=1 ):
+  return Bus(dict(TYPE='dxlsim', servos=SERVOS, ret_delay=0,
+    realtime=realtime, seed=seed))
+
+def stats( samples ):
+  """Summary statistics of a list of durations, in microseconds"""
+  s = sorted(samples)
+  n = len(s)
+  return dict( n=n, mean_us=1e6*sum(s)/n, min_us=1e6*s[0],
+    median_us=1e6*s[n//2], p99_us=1e6*s[min(n-1,int(n*0.99))],
+    max_us=1e6*s[-1] )
+
+def benchSend( n, rng ):
+  b = Bus(dict(TYPE='loop'))
+  pars = [ bytearray([0x1e, rng.randint(0,255), rng.randint(0,15)]) for _ in range(256) ]
+  t0 = now()
+  for k in range(n):
+    b.send( 1+(k & 7), Dynamixel.CMD_WRITE_DATA, pars[k & 0xFF] )
+  dt = now()-t0
+  return dict( packets=n, sec=dt, pkt_per_sec=n/dt )
+
+def benchRecv( n, rng ):
+  b = Bus(dict(TYPE='loop'))
+  out = bytearray()
+  for k in range(n):
+    body = bytearray([rng.randint(1,20), 4, 0, rng.randint(0,255), rng.randint(0,15)])
+    out.extend( Dynamixel.SYNC + body + Bus._chksum(body) )
+  b.ser.feed(bytes(out))
+  t0 = now()
+  got = 0
+  while b.recv() is not None:
+    got += 1
+  dt = now()-t0
+  return dict( packets=got, sec=dt, pkt_per_sec=got/dt )
+
+def benchSyncRTT( n, realtime, seed ):
+  b = simBus(realtime,seed)
+  nids = sorted(SERVOS)
+  smp = []
+  for k in range(n):
+    t0 = now()
+    b.send_cmd_sync( nids[k % len(nids)], Dynamixel.CMD_READ_DATA, b'\x24\x02' )
+    smp.append(now()-t0)
+  return stats(smp)
+
+def benchUpdate( n, seed ):
+  p = Protocol( bus=simBus(False,seed), nodes=sorted(SERVOS), topology=None )
+  nids = sorted(SERVOS)
+  rng = Random(seed)
+  res = {}
+  for N in (1, 8, 64, n):
+    proms = [ p.request( rng.choice(nids), Dynamixel.CMD_READ_DATA, b'\x24\x02', lifetime=1.0 )
+      for _ in range(N) ]
+    t0 = now()
+    calls = 0
+    while p.update(timeout=1.0):
+      calls += 1
+    dt = now()-t0
+    res[str(N)] = dict( requests=N, done=sum( 1 for pr in proms if pr ),
+      sec=dt, us_per_request=1e6*dt/N, update_calls=calls+1 )
+  return res
+
+def benchGetSet( n, seed ):
+  p = Protocol( bus=simBus(False,seed), nodes=sorted(SERVOS), topology=None )
+  c = Cluster( arch=p, count=len(SERVOS) )
+  res = {}
+  for what,clp,arg in (('getter','Nx01/@get_pos',None),('setter','Nx01/@set_pos',1000)):
+    if what=='getter':
+      f = c.getterOf(clp)
+      g = lambda : f()
+    else:
+      f = c.setterOf(clp)
+      g = lambda : f(arg)
+    smp = []
+    for k in range(n):
+      t0 = now()
+      g()
+      smp.append(now()-t0)
+    res[what] = stats(smp)
+  return res
+
+if __name__=="__main__":
+  R = int(argv[1]) if len(argv)>1 else 2000
+  seed = int(argv[2]) if len(argv)>2 else 1
+  rng = Random(seed)
+  res = dict( version=version, platform=platform(), repeats=R, seed=seed )
+  res['send'] = benchSend( 50*R, rng )
+  progress("send: %(pkt_per_sec)8.0f pkt/s" % res['send'])
+  res['recv'] = benchRecv( 50*R, rng )
+  progress("recv: %(pkt_per_sec)8.0f pkt/s" % res['recv'])
+  res['sync_rtt'] = benchSyncRTT( R, False, seed )
+  progress("sync_rtt (instant): mean %(mean_us)7.1f p99 %(p99_us)7.1f usec" % res['sync_rtt'])
+  res['sync_rtt_1mbps'] = benchSyncRTT( R//4, True, seed )
+  progress("sync_rtt (1Mbps)  : mean %(mean_us)7.1f p99 %(p99_us)7.1f usec" % res['sync_rtt_1mbps'])
+  res['update'] = benchUpdate( R//4, seed )
+  for r in res['update'].values():
+    progress("update: %(requests)5d requests %(done)5d done %(us_per_request)7.1f usec/request" % r)
+  res.update( benchGetSet( R, seed ) )
+  progress("getter: mean %(mean_us)7.1f p99 %(p99_us)7.1f usec" % res['getter'])
+  progress("setter: mean %(mean_us)7.1f p99 %(p99_us)7.1f usec" % res['setter'])
+  if len(argv)>3:
+    with open(argv[3],'w') as f:
+      dump(res,f,indent=1,sort_keys=True)
+  else:
+    dump(res,stdout,indent=1,sort_keys=True)
+    stdout.write("\n")
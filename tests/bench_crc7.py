@@ -0,0 +1,48 @@
+"""
+Micro-benchmark of the CRC7 used by ckbot.pololu in CRC mode
+
+Compares the table driven ckbot.pololu.crc7 with the bit by bit
+algorithm it replaced (reproduced below, with its 4 byte limit removed so
+that it can be timed on every packet length), after checking that both
+give the same results.
+
+Usage: python3 bench_crc7.py [repeats] [seed]
+"""
+from sys import argv
+from random import Random
+from time import time as now
+
+from ckbot.pololu import crc7
+from ckbot.ckmodule import progress
+
+def crc7_bitwise( dat ):
+  """Bit by bit CRC7 of dat"""
+  crc = 0
+  for b in dat:
+    crc ^= b
+    for _ in range(8):
+      if crc & 1:
+        crc ^= 0x91
+      crc >>= 1
+  return crc
+
+def bench( fun, pkts, n ):
+  t0 = now()
+  for k in range(n):
+    fun(pkts[k & 0xFF])
+  return now()-t0
+
+if __name__=="__main__":
+  R = int(argv[1]) if len(argv)>1 else 20000
+  seed = int(argv[2]) if len(argv)>2 else 1
+  rng = Random(seed)
+  assert crc7(b'\x83\x01') == 0x17, "Example from the Maestro user manual"
+  # Set Target, Set Multiple Targets for 6 and 18 channels
+  for L in (4, 15, 39):
+    pkts = [ bytes( rng.randint(0,255) for _ in range(L) ) for _ in range(256) ]
+    for p in pkts:
+      assert crc7(p) == crc7_bitwise(p)
+    tb = bench( crc7_bitwise, pkts, R )
+    tt = bench( crc7, pkts, R )
+    progress("%2d bytes: bitwise %6.2f usec table %6.2f usec speedup %5.1fx"
+      % (L, 1e6*tb/R, 1e6*tt/R, tb/tt))
@@ -0,0 +1,122 @@
+"""
+Benchmark for the ckbot.dynamixel.Bus.recv packet parser
+
+Feeds streams of status packets through a loopback connection and reports
+parse throughput on a clean stream and on streams corrupted with line
+noise. For comparison, the same streams are parsed with the previous
+parser, which grew its buffer by bytes concatenation and dropped bytes
+one at a time by re-slicing.
+
+Usage: python3 bench_recv.py [packets] [seed]
+"""
+from sys import argv
+from random import Random
+from time import time as now
+
+from ckbot.dynamixel import Bus, Dynamixel
+from ckbot.ckmodule import progress
+
+def mkStatus( nid, pars ):
+  """Build a status packet, as sent by a servo"""
+  body = bytearray([nid, len(pars)+2, 0]) + pars
+  return Dynamixel.SYNC + body + Bus._chksum(body)
+
+def mkStream( rng, n, noise ):
+  """
+  Build a stream of n status packets (2 byte reads from random nodes).
+  With probability noise, a packet is preceded by a burst of random bytes
+  or has one of its bytes flipped.
+  """
+  out = bytearray()
+  for k in range(n):
+    pkt = bytearray(mkStatus( rng.randint(1,20), bytearray([rng.randint(0,255),rng.randint(0,15)]) ))
+    if rng.random() < noise:
+      if rng.random() < 0.5:
+        out.extend( rng.randint(0,255) for _ in range(rng.randint(1,64)) )
+      else:
+        pkt[rng.randint(0,len(pkt)-1)] ^= 1<<rng.randint(0,7)
+    out.extend(pkt)
+  return bytes(out)
+
+class LegacyBus( Bus ):
+  """Bus using the parsing loop of the previous Bus.recv"""
+  def reset( self ):
+    Bus.reset(self)
+    self.lbuf = b''
+
+  def _dropByte( self, error=None ):
+    self.lbuf = self.lbuf[1:]
+    self.expect = 6
+    if error is not None:
+      setattr(self,error,getattr(self,error)+1)
+
+  def recv( self, maxlen=10 ):
+    while True:
+      n = self.ser.inWaiting()
+      if n>0:
+        rd = bytes(self.ser.read(n))
+        self.lbuf += rd
+        self.count += len(rd)
+      if len(self.lbuf)<self.expect:
+        return None
+      if not self.lbuf.startswith(Dynamixel.SYNC):
+        self._dropByte('eSync')
+        continue
+      if self.lbuf[2] > Dynamixel.MAX_ID:
+        self._dropByte('eID')
+        continue
+      L = 4+self.lbuf[3]
+      if L > maxlen or L < 6:
+        self._dropByte('eLen')
+        continue
+      if len(self.lbuf)<L:
+        self.expect = L
+        continue
+      if self.lbuf[L-1] != self._chksum(self.lbuf[2:L-1])[0]:
+        self._dropByte('eChksum')
+        continue
+      pkt = self.lbuf[2:L-1]
+      fl_pkt = self.lbuf[:L]
+      self.lbuf = self.lbuf[L:]
+      if self._testForEcho(fl_pkt):
+        self.rxEcho += 1
+        continue
+      self.rxPkts += 1
+      self.parseErr(pkt)
+      self.expect = 6
+      return pkt
+
+def run( parser, stream, chunk=4096 ):
+  """
+  Feed the stream in chunks of up to chunk bytes (as a serial driver would
+  deliver them), parsing everything after each chunk.
+  OUTPUT: packets parsed, seconds taken
+  """
+  ser = parser.ser
+  n = 0
+  t0 = now()
+  for k in range(0,len(stream),chunk):
+    ser.feed(stream[k:k+chunk])
+    while True:
+      try:
+        pkt = parser.recv()
+      except Exception:
+        # servo error flag from a corrupted packet that passed the checksum
+        n += 1
+        continue
+      if pkt is None:
+        break
+      n += 1
+  return n, now()-t0
+
+if __name__=="__main__":
+  N = int(argv[1]) if len(argv)>1 else 20000
+  seed = int(argv[2]) if len(argv)>2 else 1
+  # Chunk sizes model a busy main loop (small) and a stalled one (large)
+  for chunk in (64, 4096, 65536):
+    for noise in (0, 0.01, 0.1):
+      stream = mkStream( Random(seed), N, noise )
+      for cls in (Bus, LegacyBus):
+        n,dt = run( cls(dict(TYPE='loop')), stream, chunk )
+        progress("%-9s chunk %5d noise %4.2f : %6d packets %7d bytes in %7.4f sec --> %8.0f pkt/s %5.2f MB/s"
+          % (cls.__name__, chunk, noise, n, len(stream), dt, n/dt, len(stream)/dt/1e6))
@@ -0,0 +1,502 @@
+"""
+Behavioral checks of the ckbot bus stack against the simulated servo
+network (ckbot.dynamixelsim) and loopback connections
+
+Each test_* function raises AssertionError on failure. Run with pytest,
+or directly: python3 test_dxlsim.py
+"""
+from time import time as now
+from struct import pack
+
+from ckbot.dynamixel import Bus, Protocol, Dynamixel, MX64Mem
+
+SERVOS = { 1 : 'MX64', 2 : 'MX64', 3 : 'MX28', 4 : 'MX28' }
+
+def simProtocol( batch=False, **kw ):
+  spec = dict(TYPE='dxlsim', servos=SERVOS, echo=True, seed=1)
+  spec.update(kw)
+  return Protocol( bus=Bus(spec,batch=batch), nodes=sorted(SERVOS), topology=None )
+
+def test_sim_servo_replies():
+  from ckbot import dynamixelsim as ds
+  sim = ds.SimNetwork( servos=SERVOS, realtime=False )
+  def pkt( nid, cmd, pars=b'', chk=None ):
+    body = bytearray([nid, len(pars)+2, cmd]) + pars
+    if chk is None:
+      chk = 0xFF ^ (sum(body) & 0xFF)
+    return b'\xff\xff' + bytes(body) + pack('B',chk)
+  def status( nid, err, dat=b'' ):
+    body = bytearray([nid, len(dat)+2, err]) + dat
+    return b'\xff\xff' + bytes(body) + pack('B', 0xFF ^ (sum(body) & 0xFF))
+  def xact( *arg, **kw ):
+    sim.write( pkt(*arg,**kw) )
+    return sim.read(1000)
+  # PING is answered by present servos only, and by all when broadcast
+  assert xact( 1, Dynamixel.CMD_PING ) == b'\xff\xff\x01\x02\x00\xfc'
+  assert xact( 9, Dynamixel.CMD_PING ) == b''
+  assert xact( Dynamixel.BROADCAST_ID, Dynamixel.CMD_PING ) == b''.join(
+    status(nid,0) for nid in sorted(SERVOS) )
+  # READ returns the control table: model numbers of the MX-64 and MX-28
+  assert xact( 1, Dynamixel.CMD_READ_DATA, b'\x00\x02' ) == status(1,0,b'\x36\x01')
+  assert xact( 3, Dynamixel.CMD_READ_DATA, b'\x00\x02' ) == status(3,0,b'\x1d\x00')
+  # WRITE changes it, unless the value is out of range
+  mem = sim.servo(2).mem
+  assert xact( 2, Dynamixel.CMD_WRITE_DATA, b'\x1e\x00\x02' ) == status(2,0)
+  assert bytes(mem[0x1e:0x20]) == b'\x00\x02'
+  assert xact( 2, Dynamixel.CMD_READ_DATA, b'\x1e\x02' ) == status(2,0,b'\x00\x02')
+  assert xact( 2, Dynamixel.CMD_WRITE_DATA, b'\x1e\xff\xff' ) == status(2,ds.ERR_RANGE)
+  assert xact( 2, Dynamixel.CMD_WRITE_DATA, b'\x24\x00\x00' ) == status(2,ds.ERR_RANGE)
+  assert bytes(mem[0x1e:0x20]) == b'\x00\x02'
+  # Bad packets are reported
+  assert xact( 2, Dynamixel.CMD_PING, chk=0 ) == status(2,ds.ERR_CHECKSUM)
+  assert xact( 2, 0x77 ) == status(2,ds.ERR_INSTRUCTION)
+  assert xact( 2, Dynamixel.CMD_READ_DATA, b'\x80\x80' ) == status(2,ds.ERR_INSTRUCTION)
+
+def test_scan_batched():
+  for batch in (False,True):
+    p = simProtocol(batch)
+    found = p.scan(timeout=0.2)
+    assert sorted(found) == sorted(SERVOS), (batch,found)
+
+def test_bulk_read_batched():
+  for batch in (False,True):
+    p = simProtocol(batch)
+    tx = p.bus.txPkts
+    t0 = now()
+    res = p.mem_read_many( MX64Mem.present_position, 2, sorted(SERVOS) )
+    dt = now()-t0
+    assert sorted(res) == sorted(SERVOS), res
+    assert not any( isinstance(v,Exception) for v in res.values() ), res
+    # One BULK_READ packet, no fallback reads
+    assert p.bus.txPkts-tx == 1, (batch,p.bus.txPkts-tx)
+    assert dt < 0.05, (batch,dt)
+
+def test_batched_writes_coalesce():
+  p = simProtocol(True)
+  p.update()
+  w0 = p.bus.txWrites
+  for nid in SERVOS:
+    p.mem_write( nid, MX64Mem.goal_position, b'\x00\x04' )
+  assert p.bus.txq, "broadcast writes are held"
+  p.update()
+  assert not p.bus.txq
+  assert p.bus.txWrites-w0 == 1, p.bus.txWrites-w0
+  # Echoes of held packets are still recognized
+  r = p.bus.send_cmd_sync( 1, Dynamixel.CMD_READ_DATA, b'\x1e\x02' )
+  assert bytes(r[-2:]) == b'\x00\x04', bytes(r)
+  st = p.bus.statsMsg()
+  assert 'id errors 0' in st and 'length errors 0' in st, st
+
+def test_update_returns_when_drained():
+  for batch in (False,True):
+    p = simProtocol(batch, realtime=True)
+    p.update()
+    proms = [ p.request( nid, Dynamixel.CMD_READ_DATA, b'\x24\x02' )
+              for nid in SERVOS ]
+    t0 = now()
+    assert p.update(timeout=0.5) == 0
+    dt = now()-t0
+    assert all( pr and not isinstance(pr[0],Exception) for pr in proms ), proms
+    assert dt < 0.05, (batch,dt)
+    # A request to a missing node fails after its retries, not at the
+    #   end of the timeslice
+    pr = p.request( 9, Dynamixel.CMD_READ_DATA, b'\x24\x02' )
+    t0 = now()
+    assert p.update(timeout=0.5) == 0
+    assert isinstance(pr[0],Exception) and now()-t0 < 0.2, (pr,now()-t0)
+
+def test_motion_frame_spans():
+  p = simProtocol()
+  sim = dict( (s.nid,s) for s in p.bus.ser.sim.servos )
+  with p.motion_frame() as fr:
+    for nid in (1,2):
+      p.mem_write( nid, MX64Mem.goal_position, b'\x00\x04' )
+      p.mem_write( nid, MX64Mem.moving_speed, b'\x40\x00' )
+    # Nothing reaches the servos before the frame commits
+    p.update()
+    assert all( bytes(sim[nid].mem[0x1e:0x22]) != b'\x00\x04\x40\x00'
+                for nid in (1,2) )
+    # Writes outside the goal span are accepted, and written directly
+    p.mem_write( 1, MX64Mem.LED, b'\x01' )
+  assert fr.wait() == []
+  for nid in (1,2):
+    assert bytes(sim[nid].mem[0x1e:0x22]) == b'\x00\x04\x40\x00', nid
+  assert sim[1].mem[0x19] == 1 and sim[2].mem[0x19] == 0
+
+def test_sync_call_between_updates():
+  p = simProtocol()
+  p.update()
+  tx = p.bus.txPkts
+  # Leave a read in flight, then make a synchronous read of another node
+  pr = p.request( 1, Dynamixel.CMD_READ_DATA, b'\x24\x02' )
+  p._issueRequests( now() )
+  assert not pr and 1 in p.inflight
+  res = p.mem_read_sync( 2, MX64Mem.present_position, 2 )
+  assert not isinstance(res,Exception) and len(res) == 2, res
+  # The reply to the request in flight was not swallowed
+  while not pr:
+    p.update()
+  assert not isinstance(pr[0],Exception), pr
+  assert p.bus.txPkts-tx == 2, p.bus.txPkts-tx
+  assert sum( st.lost for st in p.bus.rtt.values() ) == 0
+
+def test_late_reply_discarded():
+  p = simProtocol()
+  p.update()
+  # A write whose (error) reply arrives only after its attempt timed out
+  w = p.request( 1, Dynamixel.CMD_WRITE_DATA, b'\x1e\xff\xff',
+    lifetime=10, attempts=1 )
+  p._issueRequests( now() )
+  p._expireRequests( now()+0.05 )
+  assert isinstance(w[0],Exception), w
+  # The late reply must not be taken for the reply to the next request
+  ping = p.request( 1, Dynamixel.CMD_PING )
+  t1 = now()+0.5
+  while not ping and now() < t1:
+    p.update()
+  assert ping and not isinstance(ping[0],Exception), ping
+
+def test_heartbeats_bounded():
+  p = simProtocol()
+  for k in range(500):
+    p.bus.send_cmd_sync( 1, Dynamixel.CMD_READ_DATA, b'\x24\x02' )
+  # Nobody called live(); pending work is still bounded by the node count
+  assert len(p.heartbeats._fresh) <= len(SERVOS), len(p.heartbeats._fresh)
+  assert 1 in p.heartbeats.live( 1.0, now() )
+
+def test_topology_cache( tmp_path='/tmp' ):
+  from os import path, remove
+  import json
+  fn = path.join(str(tmp_path),'ckbot-topology-test.json')
+  if path.exists(fn):
+    remove(fn)
+  p = simProtocol()
+  p.topology = fn
+  assert sorted(p.scan(timeout=0.2)) == sorted(SERVOS)
+  models = dict(p.models)
+  assert models[3] == 0x1d and models[1] == 0x0136, models
+  # Cached models are checked: claim node 3 is an MX64 and node 1 an MX28
+  with open(fn,'r') as f:
+    tbl = json.load(f)
+  for ent in tbl.values():
+    ent['3'], ent['1'] = ent['1'], ent['3']
+  with open(fn,'w') as f:
+    json.dump(tbl,f)
+  p.models.clear()
+  p.scan(timeout=0.2)
+  assert p.models == models, p.models
+  remove(fn)
+
+def test_bustrace_roundtrip( tmp_path='/tmp' ):
+  from os import path, remove
+  import json
+  from ckbot import bustrace
+  p = simProtocol()
+  # A small ring, so the exports must unwrap it
+  tr = bustrace.BusTrace(size=4,baudrate=1000000).attach(p.bus)
+  for nid in (1,2,3):
+    assert p.bus.send_cmd_sync( nid, Dynamixel.CMD_PING, b'' ) is not None
+  assert p.bus.send_cmd_sync( 9, Dynamixel.CMD_PING, b'', timeout=0.01, retries=1 ) is None
+  r = p.bus.send_cmd_sync( 4, Dynamixel.CMD_READ_DATA, b'\x24\x02' )
+  assert r is not None
+  assert tr.count == 5 and len(tr) == 4
+  recs = list(tr)
+  assert [ (nid,cmd,outcome) for _,_,nid,cmd,_,_,_,outcome in recs ] == [
+    (2,Dynamixel.CMD_PING,bustrace.OK), (3,Dynamixel.CMD_PING,bustrace.OK),
+    (9,Dynamixel.CMD_PING,bustrace.TIMEOUT),
+    (4,Dynamixel.CMD_READ_DATA,bustrace.OK) ], recs
+  # Binary files load back to the same records
+  fn = path.join(str(tmp_path),'ckbot-trace-test.bin')
+  tr.save(fn)
+  assert list(bustrace.BusTrace.load(fn)) == recs
+  remove(fn)
+  # Chrome trace has one event per transaction and a track per node
+  fn = path.join(str(tmp_path),'ckbot-trace-test.json')
+  tr.saveChrome(fn)
+  with open(fn,'r') as f:
+    evts = json.load(f)['traceEvents']
+  remove(fn)
+  xs = [ e for e in evts if e['ph'] == 'X' ]
+  assert len(xs) == len(recs)
+  for e,(t,rtt,nid,cmd,tx,rx,retries,outcome) in zip(xs,recs):
+    assert e['tid'] == nid and e['name'] == bustrace.CMD_NAMES[cmd]
+    assert e['cat'] == bustrace.OUTCOME_NAMES[outcome]
+    assert abs(e['ts']-t*1e6) < 1 and abs(e['dur']-rtt*1e6) < 1
+    assert e['args'] == dict(tx=tx,rx=rx,retries=retries)
+  assert e['args']['retries'] == 0 and xs[2]['args']['retries'] == 1
+  names = dict( (e['tid'],e['args']['name']) for e in evts if e['ph'] == 'M' )
+  assert names == { 2:'node 0x02', 3:'node 0x03', 9:'node 0x09', 4:'node 0x04' }
+
+def test_buscapture_replay( tmp_path='/tmp' ):
+  from os import path, remove
+  from ckbot.buscapture import readCapture, TX, RX
+  fns = [ path.join(str(tmp_path),'ckbot-capture-test%d.ckcap' % k)
+          for k in range(2) ]
+  for fn in fns:
+    if path.exists(fn):
+      remove(fn)
+  def session( bus ):
+    return [ bytes(bus.send_cmd_sync( *c ) or b'') for c in (
+      (1, Dynamixel.CMD_PING, b''),
+      (2, Dynamixel.CMD_READ_DATA, b'\x24\x02'),
+      (3, Dynamixel.CMD_WRITE_DATA, b'\x1e\x00\x02') ) ]
+  def streams( fn ):
+    recs = list(readCapture(fn))
+    return [ b''.join( dat for _,d,dat in recs if d==k ) for k in (TX,RX) ]
+  # Record a session on the simulated servos, once they were scanned
+  p = simProtocol()
+  p.bus.capture(fns[0])
+  rep = session(p.bus)
+  assert all(rep), rep
+  p.bus.capture(None)
+  tx,rx = streams(fns[0])
+  assert tx and rx
+  # Replaying it, while capturing the replay, gives the same replies and
+  #   the same traffic in both directions
+  b = Bus(dict(TYPE='replay', fn=fns[0], speed=0, lockstep=True, capture=fns[1]))
+  assert session(b) == rep
+  assert b.ser.conn.done and b.ser.conn.txCount == len(tx)
+  b.capture(None)
+  assert streams(fns[1]) == [tx,rx]
+  for fn in fns:
+    remove(fn)
+
+def test_asyncbus_read_write():
+  import asyncio, os
+  from ckbot.dynamixel import AsyncBus
+  if not hasattr(os,'openpty'):
+    return # Needs the simulator on a pseudo terminal, to have a descriptor
+  b = AsyncBus(dict(TYPE='dxlsim', servos=SERVOS, pty=True))
+  sim = b.ser.conn.sim
+  async def run():
+    assert await b.ping(1) is not None
+    assert await b.ping(9, timeout=0.01, retries=1) is None
+    assert await b.mem_write( 2, MX64Mem.goal_position, b'\x00\x03' ) is not None
+    # Commands on the same bus are serialized, and each gets its reply
+    res = await asyncio.gather( *[ b.mem_read( nid, MX64Mem.goal_position, 2 )
+                                   for nid in sorted(SERVOS) ] )
+    return [ bytes(r) for r in res ]
+  try:
+    res = asyncio.run( asyncio.wait_for( run(), 5 ) )
+  finally:
+    b.ser.close()
+    b.ser.conn.simPty.stop()
+  goals = [ bytes(sim.servo(nid).mem[0x1e:0x20]) for nid in sorted(SERVOS) ]
+  assert res == goals and res[1] == b'\x00\x03', (res,goals)
+
+def test_busthread_marshals_bus_writes():
+  from threading import current_thread
+  from ckbot import pololu
+  from ckbot.logical import Cluster
+  p = pololu.Protocol( bus=pololu.Bus(dict(TYPE='loop')), nodes={0x10:0} )
+  c = Cluster(arch=p)
+  writers = []
+  write = p.bus.ser.write
+  def recWrite( msg ):
+    writers.append(current_thread())
+    return write(msg)
+  p.bus.ser.write = recWrite
+  bt = c.startBusThread()
+  try:
+    p.bus.write((0x84,0,0x70,0x2E))
+    p.send_cmd(0xFF,0x10,(127,))
+  finally:
+    c.stopBusThread()
+  assert writers == [bt,bt], writers
+  assert 'write' not in p.bus.__dict__, "bus methods restored"
+
+def test_busthread_watch_never_waits():
+  from time import sleep
+  from ckbot import pololu
+  from ckbot.logical import Cluster
+  p = pololu.Protocol( bus=pololu.Bus(dict(TYPE='loop')), nodes={0x10:0} )
+  c = Cluster(arch=p)
+  bt = c.startBusThread()
+  try:
+    # The first poll is held up on the bus thread; the reader is not
+    gate = []
+    def get():
+      while not gate:
+        sleep(0.001)
+      return 42
+    latest = bt.watch('x', get, period=0.01)
+    t0 = now()
+    assert latest() is None
+    assert now()-t0 < 0.05
+    gate.append(1)
+    t1 = now()+1
+    while latest() is None and now()<t1:
+      sleep(0.005)
+    assert latest() == 42
+  finally:
+    gate.append(1)
+    c.stopBusThread()
+
+def test_multiprotocol_drops_stale_nodes():
+  from ckbot.multiprotocol import MultiProtocol
+  from ckbot.ckmodule import AbstractProtocol
+  class Sub( AbstractProtocol ):
+    def update( self, t=None ):
+      pass
+  subs = [ Sub(), Sub() ]
+  mp = MultiProtocol( *subs, parallel=False )
+  t0 = now()
+  subs[0].heartbeats.update({ 1:(t0,), 2:(t0,) })
+  subs[1].heartbeats.update({ 1:(t0,) })
+  mp.update(t0)
+  xn = [ mp.nim.mapI2X(subs[0],1), mp.nim.mapI2X(subs[0],2),
+         mp.nim.mapI2X(subs[1],1) ]
+  assert set(mp.heartbeats) == set(xn), mp.heartbeats
+  assert mp.heartbeats.live(1.0,t0) == frozenset(xn)
+  # A node leaving a sub-protocol leaves the merged table and live set
+  del subs[0].heartbeats[2]
+  mp.update(t0)
+  assert set(mp.heartbeats) == set([xn[0],xn[2]]), mp.heartbeats
+  assert mp.heartbeats.live(1.0,t0) == frozenset([xn[0],xn[2]])
+  # ...and may come back
+  subs[0].heartbeats[2] = (t0+0.5,)
+  mp.update(t0+0.5)
+  assert mp.heartbeats.live(1.0,t0+0.5) == frozenset(xn)
+  assert mp.heartbeats.live(1.0,t0+1.2) == frozenset([xn[1]])
+
+def test_crc7():
+  from ckbot.pololu import Bus as PololuBus, crc7, crc7_update
+  # Example from the Maestro user manual
+  assert crc7(b'\x83\x01') == 0x17
+  assert crc7_update(crc7(b'\x83'),b'\x01') == 0x17
+  b = PololuBus(dict(TYPE='loop',echo=True),crc_enabled=True)
+  cmd = bytes([0x9F,3,0,1,2,3,4,5,6])
+  b.write(cmd)
+  out = b.ser.read(100)
+  assert out == cmd+bytes([crc7(cmd)]), out
+
+def test_wixel_frame_times():
+  from time import sleep
+  from ckbot.polowixel import Bus as WixelBus
+  frame = b'\xff\xff' + bytes(12)
+  # Configured period: frames of one read are spaced by it
+  b = WixelBus(dict(TYPE='loop'),frame_period=0.01)
+  b.ser.feed(frame*3)
+  ts = [ t for t,f in b.poll(12) ]
+  assert all( abs(t1-t0-0.01)<1e-6 for t0,t1 in zip(ts,ts[1:]) ), ts
+  # Estimated period: 3 frames every 30ms read as 10ms apart, not back to back
+  b = WixelBus(dict(TYPE='loop'))
+  for k in range(8):
+    b.ser.feed(frame*3)
+    ts = [ t for t,f in b.poll(12) ]
+    sleep(0.03)
+  assert 0.008 < b.estPeriod < 0.015, b.estPeriod
+  assert all( 0.008 < t1-t0 < 0.015 for t0,t1 in zip(ts,ts[1:]) ), ts
+
+def test_pololu_reads_one_write():
+  from ckbot import pololu
+  for batch in (False,True):
+    b = pololu.Bus(dict(TYPE='loop',echo=True),crc_enabled=True,batch=batch)
+    p = pololu.Protocol( bus=b, nodes={0x10:0,0x11:1,0x12:2}, readback=True )
+    b.flushTx()
+    b.ser.read(100)
+    w0 = b.txWrites
+    proms = [ p.request_pos(nid) for nid in (0x10,0x11,0x12) ]
+    p.update(now())
+    assert b.txWrites-w0 == 1, (batch,b.txWrites-w0)
+    out = b.ser.read(100)
+    cmds = [ bytes([pololu.CMD_GET_POSITION,ch]) for ch in range(3) ]
+    assert out == b''.join( c+bytes([pololu.crc7(c)]) for c in cmds ), out
+    # Replies are matched in order
+    b.ser.feed(b'\x70\x17\x00\x10\x40\x1f')
+    p.update(now())
+    assert [ pr[0] for pr in proms ] == [6000,4096,8000], proms
+
+def test_pololu_get_pos_async():
+  from ckbot import pololu
+  for readback in (False,True):
+    b = pololu.Bus(dict(TYPE='loop',echo=True))
+    p = pololu.Protocol( bus=b, nodes={0x10:0}, readback=readback )
+    m = pololu.ServoModule( 0x10, 'PolServoModule', p.generatePNA(0x10) )
+    if not readback:
+      # Resolved promise, even before the position is known
+      pr = m.get_pos_async()
+      assert isinstance(pr[0],pololu.ProtocolError), pr
+    m.set_pos(4500)
+    pr = m.get_pos_async()
+    if readback:
+      b.ser.read(100)
+      p.update(now())
+      b.ser.read(100)
+      b.ser.feed(pack('<H',pololu.ProtocolNodeAdaptor.ssc2qus(m._deg2pol(4500))))
+      p.update(now())
+    assert abs( m.async_parse(pr) - 4500 ) < 100, (readback,pr)
+
+def test_pololu_channel_range():
+  from ckbot import pololu
+  # Channel 1 maps MiniSSC-II positions to 1000..2000us, as set on the Maestro
+  rng = {1:(1000.,2000.)}
+  got = {}
+  for batch in (False,True):
+    b = pololu.Bus(dict(TYPE='loop',echo=True))
+    p = pololu.Protocol( bus=b, nodes={0x10:0,0x11:1}, batch=batch, ranges=rng )
+    ms = [ pololu.ServoModule( nid, 'PolServoModule', p.generatePNA(nid) )
+           for nid in (0x10,0x11) ]
+    b.ser.read(100)
+    for m in ms:
+      m.set_pos(4500)
+    p.update(now())
+    got[batch] = bytearray(b.ser.read(100))
+    # Believed positions convert back with the same range
+    for m in ms:
+      assert abs( m.async_parse(m.get_pos_async()) - 4500 ) < 100
+  ssc = pololu.ServoModule._deg2pol(4500)
+  assert got[False] == bytearray([0xFF,0,ssc,0xFF,1,ssc]), got[False]
+  # Batched, each channel gets the pulse width its MiniSSC-II mapping gives
+  qus = [ pololu.ProtocolNodeAdaptor.ssc2qus(ssc,r)
+          for r in (pololu.SSC_DEFAULT_RANGE,rng[1]) ]
+  assert qus[1] == int(4*(1000+ssc*1000/254.)+0.5), qus
+  assert got[True] == bytearray([pololu.CMD_SET_MULTIPLE_TARGETS,2,0,
+    qus[0]&0x7F,qus[0]>>7,qus[1]&0x7F,qus[1]>>7]), got[True]
+
+def test_crgroup():
+  from ckbot import polowixel, pololu
+  p = polowixel.Protocol( port=dict(TYPE='loop',echo=True),
+    nodes={0x40:0,0x41:1,0x42:2} )
+  grp = p.crGroup()
+  if grp is None:
+    return # No NumPy
+  ms = [ polowixel.ServoModuleCR( nid, 'PolServoModuleCR', p.generatePNA(nid) )
+         for nid in (0x40,0x41,0x42) ]
+  # Frames reach the group arrays as they reach the node adaptors
+  t0 = now()
+  for k,msg in enumerate([(1500,200,2900),(1600,1000,2800),(400,1200,2600)]):
+    grp.feed( msg, t0+0.02*k )
+    for m in ms:
+      m.pna.feedPos( msg[p.nodes[m.node_id]], t0+0.02*k )
+  for k,m in enumerate(ms):
+    assert abs(grp.sPos[k]-m.pna.relpos) < 1e-9
+    assert abs(grp.sVel[k]-m.pna.relvel) < 1e-6
+    assert (grp.lb[k],grp.ub[k]) == (m.pna.lb,m.pna.ub)
+    m.live, m.slack, m.goalPos = True, False, 0.1*k
+  # One write, with a CRC7 byte for every MiniSSC-II command
+  p.bus.crc_enabled = True
+  p.bus.ser.read(100)
+  w0 = p.bus.txWrites
+  assert grp.step() == 3
+  assert p.bus.txWrites-w0 == 1
+  out = p.bus.ser.read(100)
+  assert len(out) == 3*4, out
+  for k in range(0,len(out),4):
+    assert out[k] == 0xFF and out[k+3] == pololu.crc7(out[k:k+3]), out
+  # Removed modules keep their state, others are reindexed
+  assert grp.remove(ms[0]) and not grp.remove(ms[0])
+  assert ms[0].goalPos == 0 and not ms[0].live
+  assert [ m._ix for m in grp.mods ] == [0,1] and len(grp.goalPos) == 2
+  assert abs(ms[2].goalPos-0.2) < 1e-9
+  # Re-created modules and re-discovered nodes replace their old entries
+  m1 = polowixel.ServoModuleCR( 0x41, 'PolServoModuleCR', p.pnas[0x41] )
+  assert grp.mods == [ms[2],m1], grp.mods
+  p.generatePNA(0x42)
+  assert grp.mods == [m1] and len(grp.live) == 1
+
+if __name__=="__main__":
+  for nm,fun in sorted(globals().items()):
+    if nm.startswith('test_') and callable(fun):
+      fun()
+      print("%s ok" % nm)
@@ -21,7 +21,7 @@ class TstApp( JoyApp ):
   def onStop(self):
     p= self.tst.tp[0]
     for t in self.tst.tp[1:]:
-      print "TS %.9f %.8f"%(t,t-p)
+      print("TS %.9f %.8f"%(t,t-p))
       p = t
 
   def onEvent(self,evt):